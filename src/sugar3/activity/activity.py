@@ -51,6 +51,7 @@ STABLE.
 import gettext
 import logging
 import os
+import struct
 import time
 from hashlib import sha1
 from functools import partial
@@ -76,6 +77,7 @@ from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
 from sugar3 import util
 from sugar3.presence import presenceservice
 from sugar3.activity.activityservice import ActivityService
+from sugar3.activity import launchtrace
 from sugar3.graphics import style
 from sugar3.graphics.window import Window
 from sugar3.graphics.alert import Alert
@@ -93,10 +95,25 @@ J_DBUS_SERVICE = 'org.laptop.Journal'
 J_DBUS_PATH = '/org/laptop/Journal'
 J_DBUS_INTERFACE = 'org.laptop.Journal'
 
+N_DBUS_SERVICE = 'org.freedesktop.Notifications'
+N_DBUS_PATH = '/org/freedesktop/Notifications'
+N_DBUS_INTERFACE = 'org.freedesktop.Notifications'
+
 CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
 
 PREVIEW_SIZE = style.zoom(300), style.zoom(225)
 
+# Sizes of the previews made when the preview_mips property of the
+# activity is set, smallest first. PREVIEW_SIZE goes to the 'preview'
+# metadata field, the other ones to 'preview-mips'.
+PREVIEW_MIP_SIZES = [(style.zoom(80), style.zoom(60)),
+                     PREVIEW_SIZE,
+                     (style.zoom(600), style.zoom(450))]
+
+_PREVIEW_MIPS_MAGIC = 'SPM1'
+_PREVIEW_MIPS_HEADER = '>4sH'
+_PREVIEW_MIPS_ENTRY = '>HHI'
+
 
 class _ActivitySession(GObject.GObject):
 
@@ -224,9 +241,12 @@ class Activity(Window, Gtk.Container):
         # For internal use only, use can_close() if you want to perform extra
         # checks before actually closing
         '_closing': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+        # Emitted when the presence lookup started in deferred sharing mode
+        # has finished, shared_activity may still be None afterwards
+        'shared-activity-ready': (GObject.SignalFlags.RUN_FIRST, None, ([])),
     }
 
-    def __init__(self, handle, create_jobject=True):
+    def __init__(self, handle, create_jobject=True, defer_sharing=False):
         """Initialise the Activity
 
         handle -- sugar3.activity.activityhandle.ActivityHandle
@@ -238,6 +258,12 @@ class Activity(Window, Gtk.Container):
             define if it should create a journal object if we are
             not resuming
 
+        defer_sharing -- boolean
+            if True, don't wait for the presence service before
+            returning; shared_activity will be set later and the
+            'shared-activity-ready' signal emitted when the lookup
+            has finished
+
         Side effects:
 
             Sets the gdk screen DPI setting (resolution) to the
@@ -256,6 +282,9 @@ class Activity(Window, Gtk.Container):
             the base class __init()__ before doing Activity specific things.
 
         """
+        trace = launchtrace.get_trace()
+        trace.begin('theme-setup')
+
         # Stuff that needs to be done early
         icons_path = os.path.join(get_bundle_path(), 'icons')
         Gtk.IconTheme.get_default().append_search_path(icons_path)
@@ -273,6 +302,8 @@ class Activity(Window, Gtk.Container):
         settings.set_property('gtk-font-name',
                               '%s %f' % (style.FONT_FACE, style.FONT_SIZE))
 
+        trace.end('theme-setup')
+
         Window.__init__(self)
 
         if 'SUGAR_ACTIVITY_ROOT' in os.environ:
@@ -297,9 +328,14 @@ class Activity(Window, Gtk.Container):
         self._active = False
         self._activity_id = handle.activity_id
         self.shared_activity = None
+        self._sharing_lookup = None
         self._join_id = None
         self._updating_jobject = False
         self._closing = False
+        self._detached_close = False
+        self._detached_closing = False
+        self._keep_failed_dialog = True
+        self._preview_mips = False
         self._quit_requested = False
         self._deleting = False
         self._max_participants = 0
@@ -317,13 +353,15 @@ class Activity(Window, Gtk.Container):
         self.sugar_accel_group = accel_group
         self.add_accel_group(accel_group)
 
-        self._bus = ActivityService(self)
+        with trace.span('activity-service'):
+            self._bus = ActivityService(self)
         self._owns_file = False
 
         share_scope = SCOPE_PRIVATE
 
         if handle.object_id:
-            self._jobject = datastore.get(handle.object_id)
+            with trace.span('datastore-get'):
+                self._jobject = datastore.get(handle.object_id)
 
             if 'share-scope' in self._jobject.metadata:
                 share_scope = self._jobject.metadata['share-scope']
@@ -340,31 +378,46 @@ class Activity(Window, Gtk.Container):
 
         if handle.object_id is None and create_jobject:
             logging.debug('Creating a jobject.')
-            self._jobject = self._initialize_journal_object()
+            with trace.span('datastore-create'):
+                self._jobject = self._initialize_journal_object()
 
+        trace.begin('presence')
         if handle.invited:
-            wait_loop = GObject.MainLoop()
-            self._client_handler = _ClientHandler(
-                self.get_bundle_id(),
-                partial(self.__got_channel_cb, wait_loop))
-            # FIXME: The current API requires that self.shared_activity is set
-            # before exiting from __init__, so we wait until we have got the
-            # shared activity. http://bugs.sugarlabs.org/ticket/2168
-            wait_loop.run()
+            if defer_sharing:
+                self._client_handler = _ClientHandler(
+                    self.get_bundle_id(),
+                    partial(self.__got_channel_cb, None))
+            else:
+                wait_loop = GObject.MainLoop()
+                self._client_handler = _ClientHandler(
+                    self.get_bundle_id(),
+                    partial(self.__got_channel_cb, wait_loop))
+                # FIXME: The current API requires that self.shared_activity is
+                # set before exiting from __init__, so we wait until we have
+                # got the shared activity.
+                # http://bugs.sugarlabs.org/ticket/2168
+                wait_loop.run()
         else:
             pservice = presenceservice.get_instance()
-            mesh_instance = pservice.get_activity(self._activity_id,
-                                                  warn_if_none=False)
-            self._set_up_sharing(mesh_instance, share_scope)
+            if defer_sharing:
+                self._sharing_lookup = pservice.get_activity_async(
+                    self._activity_id,
+                    reply_handler=partial(self.__got_mesh_instance_cb,
+                                          share_scope),
+                    error_handler=partial(self.__get_mesh_instance_error_cb,
+                                          share_scope))
+            else:
+                mesh_instance = pservice.get_activity(self._activity_id,
+                                                      warn_if_none=False)
+                self._set_up_sharing(mesh_instance, share_scope)
+        trace.end('presence')
 
         if not create_jobject:
             self.set_title(get_bundle_name())
             return
 
         if self.shared_activity is not None:
-            self._jobject.metadata['title'] = self.shared_activity.props.name
-            self._jobject.metadata['icon-color'] = \
-                self.shared_activity.props.color
+            self._update_jobject_from_shared_activity()
         else:
             self._jobject.metadata.connect('updated',
                                            self.__jobject_updated_cb)
@@ -397,6 +450,11 @@ class Activity(Window, Gtk.Container):
 
         return jobject
 
+    def _update_jobject_from_shared_activity(self):
+        self._jobject.metadata['title'] = self.shared_activity.props.name
+        self._jobject.metadata['icon-color'] = \
+            self.shared_activity.props.color
+
     def __jobject_updated_cb(self, jobject):
         if self.get_title() == jobject['title']:
             return
@@ -439,10 +497,28 @@ class Activity(Window, Gtk.Container):
         if handle_type == CONNECTION_HANDLE_TYPE_ROOM:
             connection_name = connection_path.replace('/', '.')[1:]
             bus = dbus.SessionBus()
+            if wait_loop is None:
+                # Cancelled by _complete_close() like the other lookups
+                self._sharing_lookup = bus.call_async(
+                    connection_name, channel_path, PROPERTIES_IFACE, 'Get',
+                    'ss', (CHANNEL, 'TargetHandle'),
+                    reply_handler=partial(self.__got_room_handle_cb,
+                                          connection_path),
+                    error_handler=partial(self.__get_mesh_instance_error_cb,
+                                          SCOPE_PRIVATE))
+                return
             channel = bus.get_object(connection_name, channel_path)
             room_handle = channel.Get(CHANNEL, 'TargetHandle')
             mesh_instance = pservice.get_activity_by_handle(connection_path,
                                                             room_handle)
+        elif wait_loop is None:
+            self._sharing_lookup = pservice.get_activity_async(
+                self._activity_id,
+                reply_handler=partial(self.__got_mesh_instance_cb,
+                                      SCOPE_PRIVATE),
+                error_handler=partial(self.__get_mesh_instance_error_cb,
+                                      SCOPE_PRIVATE))
+            return
         else:
             mesh_instance = pservice.get_activity(self._activity_id,
                                                   warn_if_none=False)
@@ -450,6 +526,35 @@ class Activity(Window, Gtk.Container):
         self._set_up_sharing(mesh_instance, SCOPE_PRIVATE)
         wait_loop.quit()
 
+    def __got_room_handle_cb(self, connection_path, room_handle):
+        if self._sharing_lookup is None:
+            # The activity was closed meanwhile
+            return
+        pservice = presenceservice.get_instance()
+        self._sharing_lookup = pservice.get_activity_by_handle_async(
+            connection_path, room_handle,
+            reply_handler=partial(self.__got_mesh_instance_cb,
+                                  SCOPE_PRIVATE),
+            error_handler=partial(self.__get_mesh_instance_error_cb,
+                                  SCOPE_PRIVATE))
+
+    def __got_mesh_instance_cb(self, share_scope, mesh_instance):
+        logging.debug('Activity.__got_mesh_instance_cb %r', mesh_instance)
+        self._sharing_ready(mesh_instance, share_scope)
+
+    def __get_mesh_instance_error_cb(self, share_scope, err):
+        logging.error('Looking up the shared activity failed: %s', err)
+        # Like when it's not found, an activity that was shared is
+        # shared again
+        self._sharing_ready(None, share_scope)
+
+    def _sharing_ready(self, mesh_instance, share_scope):
+        self._sharing_lookup = None
+        self._set_up_sharing(mesh_instance, share_scope)
+        if self.shared_activity is not None and self._jobject is not None:
+            self._update_jobject_from_shared_activity()
+        self.emit('shared-activity-ready')
+
     def get_active(self):
         return self._active
 
@@ -472,6 +577,41 @@ class Activity(Window, Gtk.Container):
         type=int, default=0, getter=get_max_participants,
         setter=set_max_participants)
 
+    def get_detached_close(self):
+        return self._detached_close
+
+    def set_detached_close(self, detached_close):
+        self._detached_close = detached_close
+
+    # When set, close() hides the window as soon as the activity state
+    # has been captured and the datastore transfer completes in background
+    detached_close = GObject.property(
+        type=bool, default=False, getter=get_detached_close,
+        setter=set_detached_close)
+
+    def get_keep_failed_dialog(self):
+        return self._keep_failed_dialog
+
+    def set_keep_failed_dialog(self, keep_failed_dialog):
+        self._keep_failed_dialog = keep_failed_dialog
+
+    # When a detached close fails to save, show the window again with the
+    # keep error dialog instead of a notification of the shell
+    keep_failed_dialog = GObject.property(
+        type=bool, default=True, getter=get_keep_failed_dialog,
+        setter=set_keep_failed_dialog)
+
+    def get_preview_mips(self):
+        return self._preview_mips
+
+    def set_preview_mips(self, preview_mips):
+        self._preview_mips = preview_mips
+
+    # When set, save() stores a preview for each of PREVIEW_MIP_SIZES
+    preview_mips = GObject.property(
+        type=bool, default=False, getter=get_preview_mips,
+        setter=set_preview_mips)
+
     def get_id(self):
         """Returns the activity id of the current instance of your activity.
 
@@ -620,8 +760,11 @@ class Activity(Window, Gtk.Container):
         if self._quit_requested:
             self._session.will_quit(self, False)
         if self._closing:
-            self._show_keep_failed_dialog()
-            self._closing = False
+            if self._detached_closing and not self._keep_failed_dialog:
+                self._report_keep_failure()
+            else:
+                self._show_keep_failed_dialog()
+                self._closing = False
         raise RuntimeError('Error saving activity object to datastore: %s',
                            err)
 
@@ -646,6 +789,27 @@ class Activity(Window, Gtk.Container):
         window and draws on that. Then we create a cairo image surface with
         the desired preview size and scale the canvas surface on that.
         """
+        screenshot = self._get_screenshot()
+        if screenshot is None:
+            return None
+
+        return self._scale_screenshot(screenshot, PREVIEW_SIZE)
+
+    def get_previews(self):
+        """Returns a list of (width, height, png data) tuples, one for each
+        size in PREVIEW_MIP_SIZES.
+
+        The canvas is drawn only once and scaled down to every size.
+        """
+        screenshot = self._get_screenshot()
+        if screenshot is None:
+            return None
+
+        return [(width, height, self._scale_screenshot(screenshot,
+                                                       (width, height)))
+                for width, height in PREVIEW_MIP_SIZES]
+
+    def _get_screenshot(self):
         if self.canvas is None or not hasattr(self.canvas, 'get_window'):
             return None
 
@@ -666,7 +830,11 @@ class Activity(Window, Gtk.Container):
         self.canvas.draw(cr)
         del cr
 
-        preview_width, preview_height = PREVIEW_SIZE
+        return screenshot_surface, canvas_width, canvas_height
+
+    def _scale_screenshot(self, screenshot, size):
+        screenshot_surface, canvas_width, canvas_height = screenshot
+        preview_width, preview_height = size
         preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
                                              preview_width, preview_height)
         cr = cairo.Context(preview_surface)
@@ -726,9 +894,22 @@ class Activity(Window, Gtk.Container):
             self.metadata['buddies_id'] = json.dumps(buddies_dict.keys())
             self.metadata['buddies'] = json.dumps(self._get_buddies())
 
-        preview = self.get_preview()
-        if preview is not None:
-            self.metadata['preview'] = dbus.ByteArray(preview)
+        previews = None
+        if self._preview_mips:
+            previews = self.get_previews()
+        if previews:
+            mips = []
+            for width, height, data in previews:
+                if (width, height) == PREVIEW_SIZE:
+                    self.metadata['preview'] = dbus.ByteArray(data)
+                else:
+                    mips.append((width, height, data))
+            self.metadata['preview-mips'] = \
+                dbus.ByteArray(pack_preview_mips(mips))
+        else:
+            preview = self.get_preview()
+            if preview is not None:
+                self.metadata['preview'] = dbus.ByteArray(preview)
 
         if not self.metadata.get('activity_id', ''):
             self.metadata['activity_id'] = self.get_id()
@@ -744,6 +925,12 @@ class Activity(Window, Gtk.Container):
                 self._owns_file = True
                 self._jobject.file_path = file_path
 
+        if self._detached_closing:
+            # The state has been captured, the user doesn't need to wait
+            # for the datastore
+            self.hide()
+            Gdk.flush()
+
         # Cannot call datastore.write async for creates:
         # https://dev.laptop.org/ticket/3071
         if self._jobject.object_id is None:
@@ -883,8 +1070,39 @@ class Activity(Window, Gtk.Container):
         self.add_alert(alert)
         alert.connect('response', self._keep_failed_dialog_response_cb)
 
+        if self._detached_closing:
+            self._detached_closing = False
+            self.show()
         self.reveal()
 
+    def _report_keep_failure(self):
+        logging.debug('Activity._report_keep_failure')
+        self._closing = True
+        try:
+            bus = dbus.SessionBus()
+            obj = bus.get_object(N_DBUS_SERVICE, N_DBUS_PATH)
+            notifications = dbus.Interface(obj, N_DBUS_INTERFACE)
+            notifications.Notify(
+                get_bundle_name(), 0, '', _('Keep error'),
+                _('Keep error: all changes will be lost'),
+                dbus.Array([], signature='s'),
+                dbus.Dictionary({}, signature='sv'), -1,
+                reply_handler=self.__notify_keep_failure_cb,
+                error_handler=self.__notify_keep_failure_error_cb)
+        except dbus.DBusException:
+            logging.exception('Cannot notify the keep failure')
+            self._closing = False
+            self._show_keep_failed_dialog()
+
+    def __notify_keep_failure_cb(self, notification_id):
+        self._complete_close()
+
+    def __notify_keep_failure_error_cb(self, err):
+        # The user must be told, fall back to the dialog
+        logging.error('Cannot notify the keep failure: %s', err)
+        self._closing = False
+        self._show_keep_failed_dialog()
+
     def _keep_failed_dialog_response_cb(self, alert, response_id):
         self.remove_alert(alert)
         if response_id == Gtk.ResponseType.OK:
@@ -907,7 +1125,10 @@ class Activity(Window, Gtk.Container):
             except:
                 # pylint: disable=W0702
                 logging.exception('Error saving activity object to datastore')
-                self._show_keep_failed_dialog()
+                if self._detached_closing and not self._keep_failed_dialog:
+                    self._report_keep_failure()
+                else:
+                    self._show_keep_failed_dialog()
                 return False
 
         self._closing = True
@@ -915,6 +1136,11 @@ class Activity(Window, Gtk.Container):
         return True
 
     def _complete_close(self):
+        if self._sharing_lookup is not None:
+            # Don't let a late reply reach the destroyed activity
+            self._sharing_lookup.cancel()
+            self._sharing_lookup = None
+
         self.destroy()
 
         if self.shared_activity:
@@ -933,6 +1159,9 @@ class Activity(Window, Gtk.Container):
         Activities should not override this method, but should implement
         write_file() to do any state saving instead. If the application wants
         to control wether it can close, it should override can_close().
+
+        If the detached_close property is set, the window is hidden as soon
+        as write_file() has returned and the save completes in background.
         """
         if not self.can_close():
             return
@@ -941,6 +1170,7 @@ class Activity(Window, Gtk.Container):
         self.emit('_closing')
 
         if not self._closing:
+            self._detached_closing = self._detached_close and not skip_save
             if not self._prepare_close(skip_save):
                 return
 
@@ -1059,6 +1289,80 @@ def get_activity_root():
         raise RuntimeError('No SUGAR_ACTIVITY_ROOT set.')
 
 
+def pack_preview_mips(previews):
+    """Pack a list of (width, height, png data) tuples in a string
+
+    The result can be stored in the 'preview-mips' metadata field and read
+    back with unpack_preview_mips().
+    """
+    header = [struct.pack(_PREVIEW_MIPS_HEADER, _PREVIEW_MIPS_MAGIC,
+                          len(previews))]
+    for width, height, data in previews:
+        header.append(struct.pack(_PREVIEW_MIPS_ENTRY, width, height,
+                                  len(data)))
+    return ''.join(header + [str(data) for width_, height_, data in previews])
+
+
+def unpack_preview_mips(packed):
+    """Return the list of (width, height, png data) tuples packed by
+    pack_preview_mips(), smallest first
+
+    Raises ValueError if packed is not a valid preview mips string.
+    """
+    packed = str(packed)
+    offset = struct.calcsize(_PREVIEW_MIPS_HEADER)
+    if len(packed) < offset:
+        raise ValueError('Preview mips too short')
+    magic, count = struct.unpack_from(_PREVIEW_MIPS_HEADER, packed)
+    if magic != _PREVIEW_MIPS_MAGIC:
+        raise ValueError('Unknown preview mips format')
+
+    entry_size = struct.calcsize(_PREVIEW_MIPS_ENTRY)
+    data_offset = offset + count * entry_size
+    if len(packed) < data_offset:
+        raise ValueError('Preview mips too short')
+
+    previews = []
+    for i_ in range(count):
+        width, height, length = struct.unpack_from(_PREVIEW_MIPS_ENTRY,
+                                                   packed, offset)
+        offset += entry_size
+        data = packed[data_offset:data_offset + length]
+        if len(data) != length:
+            raise ValueError('Preview mips too short')
+        data_offset += length
+        previews.append((width, height, data))
+
+    previews.sort(key=lambda preview: preview[0] * preview[1])
+    return previews
+
+
+def select_preview(metadata, width, height):
+    """Return the png data of the preview of an entry to draw at a size
+
+    The smallest preview that is not smaller than width x height is
+    picked among the 'preview-mips' metadata field and the 'preview' one,
+    which has the PREVIEW_SIZE preview, or the largest one if none is big
+    enough. Returns None if the entry has no preview.
+    """
+    previews = []
+    if metadata.get('preview-mips'):
+        try:
+            previews = unpack_preview_mips(metadata['preview-mips'])
+        except ValueError:
+            logging.exception('Error while loading the preview mips')
+    if metadata.get('preview'):
+        previews.append(PREVIEW_SIZE + (metadata['preview'], ))
+    previews.sort(key=lambda preview: preview[0] * preview[1])
+
+    preview_data = None
+    for preview_width, preview_height, data in previews:
+        preview_data = data
+        if preview_width >= width and preview_height >= height:
+            break
+    return preview_data
+
+
 def show_object_in_journal(object_id):
     bus = dbus.SessionBus()
     obj = bus.get_object(J_DBUS_SERVICE, J_DBUS_PATH)
@@ -23,11 +23,13 @@ the moment there is no reason to stabilize this API.
 """
 
 import logging
+import json
 
 import dbus
 from gi.repository import GObject
 
 from sugar3.activity.activityhandle import ActivityHandle
+from sugar3.activity import launchtrace
 from sugar3 import util
 from sugar3 import env
 from sugar3.datastore import datastore
@@ -91,6 +93,9 @@ def get_environment(activity):
     environ['SUGAR_BUNDLE_PATH'] = activity.get_path()
     environ['SUGAR_BUNDLE_ID'] = activity.get_bundle_id()
     environ['SUGAR_ACTIVITY_ROOT'] = activity_root
+    # Spare the activity process from parsing the bundle again
+    environ['SUGAR_BUNDLE_INFO'] = json.dumps(activity.get_info_record(),
+                                              separators=(',', ':'))
     environ['PATH'] = bin_path + ':' + environ['PATH']
 
     if activity.get_path().startswith(env.get_user_activities_path()):
@@ -186,12 +191,15 @@ class ActivityCreationHandler(GObject.GObject):
         self._bundle = bundle
         self._service_name = bundle.get_bundle_id()
         self._handle = handle
+        self._trace = launchtrace.LaunchTrace(process_name='shell')
+        self._trace.mark('launch-requested', bundle_id=self._service_name)
 
         bus = dbus.SessionBus()
         bus_object = bus.get_object(_SHELL_SERVICE, _SHELL_PATH)
         self._shell = dbus.Interface(bus_object, _SHELL_IFACE)
 
         if handle.activity_id is not None and handle.object_id is None:
+            self._trace.begin('datastore-find')
             datastore.find({'activity_id': self._handle.activity_id},
                            reply_handler=self._find_object_reply_handler,
                            error_handler=self._find_object_error_handler)
@@ -212,12 +220,15 @@ class ActivityCreationHandler(GObject.GObject):
         if self._handle.activity_id is None:
             self._handle.activity_id = create_activity_id()
 
+        self._trace.begin('notify-launch')
         self._shell.NotifyLaunch(
             self._service_name, self._handle.activity_id,
-            reply_handler=self._no_reply_handler,
+            reply_handler=self._notify_launch_reply_handler,
             error_handler=self._notify_launch_error_handler)
 
         environ = get_environment(self._bundle)
+        if self._trace.enabled:
+            environ[launchtrace.LAUNCH_ID_ENV] = self._trace.launch_id
         (log_path, log_file) = open_log_file(self._bundle)
         command = get_command(self._bundle, self._handle.activity_id,
                               self._handle.object_id, self._handle.uri,
@@ -248,13 +259,15 @@ class ActivityCreationHandler(GObject.GObject):
             log_file.write(' '.join(command) + '\n\n')
 
         dev_null = file('/dev/null', 'r')
-        child = subprocess.Popen([str(s) for s in command],
-                                 env=environ,
-                                 cwd=str(self._bundle.get_path()),
-                                 close_fds=True,
-                                 stdin=dev_null.fileno(),
-                                 stdout=log_file.fileno(),
-                                 stderr=log_file.fileno())
+        with self._trace.span('spawn'):
+            child = subprocess.Popen([str(s) for s in command],
+                                     env=environ,
+                                     cwd=str(self._bundle.get_path()),
+                                     close_fds=True,
+                                     stdin=dev_null.fileno(),
+                                     stdout=log_file.fileno(),
+                                     stderr=log_file.fileno())
+        self._trace.flush()
 
         GObject.child_watch_add(child.pid,
                                 _child_watch_cb,
@@ -267,8 +280,14 @@ class ActivityCreationHandler(GObject.GObject):
     def _notify_launch_failure_error_handler(self, err):
         logging.error('Notify launch failure failed %s', err)
 
+    def _notify_launch_reply_handler(self):
+        self._trace.end('notify-launch')
+        self._trace.flush()
+
     def _notify_launch_error_handler(self, err):
         logging.debug('Notify launch failed %s', err)
+        self._trace.end('notify-launch')
+        self._trace.flush()
 
     def _activate_reply_handler(self, activated):
         if not activated:
@@ -289,6 +308,7 @@ class ActivityCreationHandler(GObject.GObject):
             error_handler=self._notify_launch_failure_error_handler)
 
     def _find_object_reply_handler(self, jobjects, count):
+        self._trace.end('datastore-find')
         if count > 0:
             if count > 1:
                 logging.debug('Multiple objects has the same activity_id.')
@@ -297,6 +317,7 @@ class ActivityCreationHandler(GObject.GObject):
 
     def _find_object_error_handler(self, err):
         logging.error('Datastore find failed %s', err)
+        self._trace.end('datastore-find')
         self._launch_activity()
 
 
@@ -0,0 +1,211 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Activity launch timeline tracing
+
+Tracing is enabled by setting SUGAR_LAUNCH_TRACE in the environment of the
+shell, either to 1 or to the directory where traces should be written. Every
+process taking part to a launch records named spans and appends them to
+a per-process events file; the launch id is passed to the activity process
+through SUGAR_LAUNCH_ID. Each flush() merges all the events recorded so far
+for the launch into <launch id>.json, in the Chrome trace event format, so
+that the whole launch can be loaded in chrome://tracing as one timeline.
+
+UNSTABLE.
+"""
+
+import ctypes
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sugar3 import env
+from sugar3 import util
+
+
+TRACE_ENV = 'SUGAR_LAUNCH_TRACE'
+LAUNCH_ID_ENV = 'SUGAR_LAUNCH_ID'
+
+_CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_clock_gettime():
+    for name in ('librt.so.1', 'libc.so.6'):
+        try:
+            clock_gettime = ctypes.CDLL(name).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        return clock_gettime
+    return None
+
+_clock_gettime = _get_clock_gettime()
+
+
+def get_timestamp():
+    """Return a monotonic timestamp in microseconds
+
+    CLOCK_MONOTONIC is shared by all the processes of the system, so
+    timestamps taken by the shell and by the activity can be compared.
+    """
+    if _clock_gettime is not None:
+        spec = _Timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(spec)) == 0:
+            return spec.tv_sec * 1000000 + spec.tv_nsec / 1000
+    return int(time.time() * 1000000)
+
+
+def is_enabled():
+    return bool(os.environ.get(TRACE_ENV))
+
+
+def get_trace_dir():
+    trace_dir = os.environ.get(TRACE_ENV)
+    if not trace_dir or trace_dir == '1':
+        trace_dir = env.get_logs_path('launch-traces')
+    return trace_dir
+
+
+class LaunchTrace(object):
+    """Records the spans of one activity launch in the current process"""
+
+    def __init__(self, launch_id=None, process_name=None):
+        self.enabled = is_enabled()
+        if launch_id is None:
+            launch_id = util.unique_id()
+        self.launch_id = launch_id
+        self._process_name = process_name
+        self._process_name_written = False
+        self._events = []
+        self._open_spans = {}
+        self._lock = threading.Lock()
+
+    def _add_event(self, event):
+        event['pid'] = os.getpid()
+        event['tid'] = threading.currentThread().ident
+        event['cat'] = 'launch'
+        with self._lock:
+            self._events.append(event)
+
+    def begin(self, name, **args):
+        """Start the span called name"""
+        if not self.enabled:
+            return
+        self._open_spans[name] = (get_timestamp(), args)
+
+    def end(self, name):
+        """Finish the span called name, started with begin()"""
+        if not self.enabled or name not in self._open_spans:
+            return
+        start, args = self._open_spans.pop(name)
+        self._add_event({'name': name, 'ph': 'X', 'ts': start,
+                         'dur': get_timestamp() - start, 'args': args})
+
+    @contextmanager
+    def span(self, name, **args):
+        """Record the time spent in the with block as the span name"""
+        self.begin(name, **args)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def mark(self, name, **args):
+        """Record an instant event"""
+        if not self.enabled:
+            return
+        self._add_event({'name': name, 'ph': 'i', 's': 'p',
+                         'ts': get_timestamp(), 'args': args})
+
+    def flush(self):
+        """Write the events recorded so far and update the merged trace"""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            events = self._events
+            self._events = []
+
+        trace_dir = get_trace_dir()
+        try:
+            if not os.path.isdir(trace_dir):
+                os.makedirs(trace_dir)
+
+            # The metadata event is only needed once per process
+            if self._process_name is not None and \
+                    not self._process_name_written:
+                events.append({'name': 'process_name', 'ph': 'M',
+                               'pid': os.getpid(),
+                               'args': {'name': self._process_name}})
+
+            events_path = os.path.join(trace_dir, '%s.%d.events' %
+                                       (self.launch_id, os.getpid()))
+            with open(events_path, 'a') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+            self._process_name_written = True
+
+            self._merge(trace_dir)
+        except (IOError, OSError):
+            logging.exception('Cannot write the launch trace')
+
+    def _merge(self, trace_dir):
+        prefix = self.launch_id + '.'
+        merged = []
+        for name in sorted(os.listdir(trace_dir)):
+            if not name.startswith(prefix) or not name.endswith('.events'):
+                continue
+            with open(os.path.join(trace_dir, name)) as f:
+                for line in f:
+                    try:
+                        merged.append(json.loads(line))
+                    except ValueError:
+                        # Another process may be writing it right now
+                        continue
+
+        merged.sort(key=lambda event: event.get('ts', 0))
+
+        trace_path = os.path.join(trace_dir, self.launch_id + '.json')
+        temp_path = trace_path + '.%d.tmp' % os.getpid()
+        with open(temp_path, 'w') as f:
+            json.dump({'traceEvents': merged,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'launch_id': self.launch_id}}, f)
+        os.rename(temp_path, trace_path)
+
+
+_trace = None
+
+
+def get_trace():
+    """Return the trace of the launch this process takes part in
+
+    The launch id is taken from SUGAR_LAUNCH_ID, as set by the activity
+    factory.
+    """
+    global _trace
+    if _trace is None:
+        _trace = LaunchTrace(os.environ.get(LAUNCH_ID_ENV),
+                             process_name='activity')
+    return _trace
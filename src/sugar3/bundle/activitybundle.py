@@ -21,19 +21,47 @@ UNSTABLE.
 """
 
 from ConfigParser import ConfigParser
+from contextlib import contextmanager
 from locale import normalize
 import os
-import shutil
 import tempfile
 import logging
 
 from sugar3 import env
 from sugar3.bundle.bundle import Bundle, \
-    MalformedBundleException, NotInstalledException
+    MalformedBundleException, NotInstalledException, move_to_trash
 from sugar3.bundle.bundleversion import NormalizedVersion
 from sugar3.bundle.bundleversion import InvalidVersionError
 
 
+# Maps the keys of the info record to the ActivityBundle attributes
+_INFO_RECORD_FIELDS = {
+    'bundle_id': '_bundle_id',
+    'name': '_name',
+    'exec': 'bundle_exec',
+    'mime_types': '_mime_types',
+    'show_launcher': '_show_launcher',
+    'tags': '_tags',
+    'icon': '_icon',
+    'activity_version': '_activity_version',
+    'summary': '_summary',
+}
+
+_INFO_RECORD_VERSION = 1
+
+
+def _to_str(value):
+    # json gives back unicode strings, ConfigParser gives utf-8 str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_to_str(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((_to_str(key), _to_str(item))
+                    for key, item in value.items())
+    return value
+
+
 def _expand_lang(locale):
     # Private method from gettext.py
     locale = normalize(locale)
@@ -83,6 +111,128 @@ def _expand_lang(locale):
     return ret
 
 
+# The batch of installations in progress, see batch_install()
+_batch = None
+
+
+class _InstallBatch(object):
+
+    def __init__(self):
+        self.actions = []
+        self.mime_dirs = set()
+        self.callbacks = []
+
+    def run(self):
+        for function, args in self.actions:
+            try:
+                function(*args)
+            except (OSError, RuntimeError), e:
+                logging.error('Cannot complete a batched installation: %s', e)
+
+
+@contextmanager
+def batch_install(callback=None):
+    """Batch the installation and removal of several activity bundles
+
+    Inside the block, ActivityBundle.install(), install_mime_type() and
+    uninstall() defer linking the mime types and their icons to the end
+    of the block, where update-mime-database runs once for the whole
+    batch instead of once per bundle.
+
+        with batch_install():
+            for bundle in bundles:
+                bundle.install()
+
+    The deferred links are made in the order they were requested, errors
+    are logged instead of raised.
+
+    callback -- if given, update-mime-database runs asynchronously and
+        callback(success) is called from the main loop when it's done,
+        otherwise the end of the block waits for it
+
+    Batches can be nested, the outermost one does the work.
+    """
+    global _batch
+
+    if _batch is not None:
+        if callback is not None:
+            _batch.callbacks.append(callback)
+        yield
+        return
+
+    batch = _InstallBatch()
+    _batch = batch
+    try:
+        yield
+    finally:
+        _batch = None
+        batch.run()
+        if callback is None:
+            success = True
+            for mime_dir in batch.mime_dirs:
+                success = _update_mime_database(mime_dir) and success
+            for batch_callback in batch.callbacks:
+                batch_callback(success)
+        else:
+            _update_mime_databases_async(batch.mime_dirs,
+                                         [callback] + batch.callbacks)
+
+
+def _run_or_defer(function, *args):
+    if _batch is None:
+        function(*args)
+    else:
+        _batch.actions.append((function, args))
+
+
+def _update_mime_database(mime_dir):
+    if _batch is not None:
+        _batch.mime_dirs.add(mime_dir)
+        return True
+    return os.spawnlp(os.P_WAIT, 'update-mime-database',
+                      'update-mime-database', mime_dir) == 0
+
+
+def _update_mime_databases_async(mime_dirs, callbacks):
+    # Only needed here, the bundle modules are also used by bundlebuilder
+    from gi.repository import GLib
+    from gi.repository import GObject
+
+    pending = set()
+    results = []
+
+    def done():
+        success = all(results)
+        for callback in callbacks:
+            callback(success)
+        return False
+
+    def child_watch_cb(pid, condition, user_data):
+        pending.discard(pid)
+        results.append(os.WIFEXITED(condition) and
+                       os.WEXITSTATUS(condition) == 0)
+        if not pending:
+            done()
+
+    for mime_dir in mime_dirs:
+        # Only the child watch reaps the process, subprocess could reap
+        # it first when it cleans up its own children
+        flags = GLib.SpawnFlags.SEARCH_PATH | \
+            GLib.SpawnFlags.DO_NOT_REAP_CHILD
+        try:
+            pid, stdin_, stdout_, stderr_ = GLib.spawn_async(
+                ['update-mime-database', mime_dir], flags=flags)
+        except GLib.GError, e:
+            logging.error('Cannot run update-mime-database: %s', e)
+            results.append(False)
+            continue
+        pending.add(pid)
+        GObject.child_watch_add(pid, child_watch_cb, None)
+
+    if not pending:
+        GObject.idle_add(done)
+
+
 class ActivityBundle(Bundle):
     """A Sugar activity bundle
 
@@ -95,7 +245,13 @@ class ActivityBundle(Bundle):
     _unzipped_extension = '.activity'
     _infodir = 'activity'
 
-    def __init__(self, path, translated=True):
+    def __init__(self, path, translated=True, info_record=None):
+        """Create the bundle for path
+
+        info_record -- a dict returned by get_info_record() for the same
+            bundle. If it's still valid, the activity.info and the
+            activity.linfo files are not parsed again.
+        """
         Bundle.__init__(self, path)
         self.activity_class = None
         self.bundle_exec = None
@@ -108,16 +264,98 @@ class ActivityBundle(Bundle):
         self._tags = None
         self._activity_version = '0'
         self._summary = None
+        self._info = None
+        self._translations = {}
+        self._languages = None
+
+        if info_record is not None and \
+                self._load_info_record(info_record, translated):
+            return
 
         info_file = self.get_file('activity/activity.info')
         if info_file is None:
             raise MalformedBundleException('No activity.info file')
         self._parse_info(info_file)
+        self._info = dict((key, getattr(self, attr))
+                          for key, attr in _INFO_RECORD_FIELDS.items())
 
         if translated:
-            linfo_file = self._get_linfo_file()
+            self._languages = self._get_languages()
+            lang, linfo_file = self._get_linfo_file()
             if linfo_file:
-                self._parse_linfo(linfo_file)
+                translation = self._parse_linfo(linfo_file)
+                self._apply_translation(translation)
+                self._translations[lang] = translation
+
+    def _get_info_mtime(self):
+        info_path = os.path.join(self._path, 'activity', 'activity.info')
+        return os.stat(info_path).st_mtime
+
+    def get_info_record(self, all_languages=False):
+        """Return the parsed metadata of the bundle as a dict
+
+        The record can be serialized with json and handed to another
+        process, which can pass it to the ActivityBundle constructor to
+        avoid parsing the bundle again. It's bound to the path and to the
+        modification time of activity.info and to the languages that were
+        used to translate it.
+
+        all_languages -- include the activity.linfo files of all the
+            locales, so that the record stays valid in any language
+        """
+        if self._zip_file is not None:
+            raise NotInstalledException
+
+        languages = self._languages
+        translations = self._translations
+        if all_languages and languages != '*':
+            languages = '*'
+            translations = self._get_all_translations()
+
+        return {
+            'version': _INFO_RECORD_VERSION,
+            'path': self._path,
+            'mtime': self._get_info_mtime(),
+            'languages': languages,
+            'info': self._info,
+            'translations': translations,
+        }
+
+    def _load_info_record(self, record, translated):
+        if self._zip_file is not None:
+            return False
+
+        try:
+            if record['version'] != _INFO_RECORD_VERSION or \
+                    _to_str(record['path']) != self._path or \
+                    record['mtime'] != self._get_info_mtime():
+                return False
+
+            languages = _to_str(record['languages'])
+            if translated and languages != '*' and \
+                    languages != self._get_languages():
+                return False
+
+            info = _to_str(record['info'])
+            # Only the translation that gets applied is converted
+            translations = record['translations']
+            for key, attr in _INFO_RECORD_FIELDS.items():
+                setattr(self, attr, info[key])
+        except (KeyError, TypeError, OSError):
+            logging.debug('Ignoring invalid info record for %s', self._path)
+            return False
+
+        self._info = info
+        self._translations = translations
+        self._languages = languages
+
+        if translated:
+            for lang in self._get_languages():
+                if lang in translations:
+                    self._apply_translation(_to_str(translations[lang]))
+                    break
+
+        return True
 
     def _parse_info(self, info_file):
         cp = ConfigParser()
@@ -179,7 +417,7 @@ class ActivityBundle(Bundle):
         if cp.has_option(section, 'summary'):
             self._summary = cp.get(section, 'summary')
 
-    def _get_linfo_file(self):
+    def _get_languages(self):
         # Using method from gettext.py, first find languages from environ
         languages = []
         for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
@@ -195,29 +433,57 @@ class ActivityBundle(Bundle):
                 if nelang not in nelangs:
                     nelangs.append(nelang)
 
-        # Finally, select a language
-        for lang in nelangs:
+        return nelangs
+
+    def _get_linfo_file(self):
+        # Select the first language that has an activity.linfo file
+        for lang in self._get_languages():
             linfo_path = os.path.join('locale', lang, 'activity.linfo')
             linfo_file = self.get_file(linfo_path)
             if linfo_file is not None:
-                return linfo_file
-        return None
+                return lang, linfo_file
+        return None, None
+
+    def _get_all_translations(self):
+        translations = {}
+        try:
+            langs = os.listdir(os.path.join(self._path, 'locale'))
+        except OSError:
+            return translations
+
+        for lang in langs:
+            linfo_path = os.path.join('locale', lang, 'activity.linfo')
+            linfo_file = self.get_file(linfo_path)
+            if linfo_file is not None:
+                translations[lang] = self._parse_linfo(linfo_file)
+        return translations
 
     def _parse_linfo(self, linfo_file):
         cp = ConfigParser()
         cp.readfp(linfo_file)
 
         section = 'Activity'
+        translation = {}
 
         if cp.has_option(section, 'name'):
-            self._name = cp.get(section, 'name')
+            translation['name'] = cp.get(section, 'name')
 
         if cp.has_option(section, 'summary'):
-            self._summary = cp.get(section, 'summary')
+            translation['summary'] = cp.get(section, 'summary')
 
         if cp.has_option(section, 'tags'):
             tag_list = cp.get(section, 'tags').strip(';')
-            self._tags = [tag.strip() for tag in tag_list.split(';')]
+            translation['tags'] = [tag.strip() for tag in tag_list.split(';')]
+
+        return translation
+
+    def _apply_translation(self, translation):
+        if 'name' in translation:
+            self._name = translation['name']
+        if 'summary' in translation:
+            self._summary = translation['summary']
+        if 'tags' in translation:
+            self._tags = translation['tags']
 
     def get_locale_path(self):
         """Get the locale path inside the (installed) activity bundle."""
@@ -283,10 +549,16 @@ class ActivityBundle(Bundle):
         """Get whether there should be a visible launcher for the activity"""
         return self._show_launcher
 
-    def install(self):
+    def install(self, deduplicate=False):
+        """Install the bundle in the user activities directory
+
+        deduplicate -- share the files that are identical with the other
+            bundles installed with deduplication, see
+            sugar3.bundle.objectstore
+        """
         install_dir = env.get_user_activities_path()
 
-        self._unzip(install_dir)
+        self._unzip(install_dir, deduplicate)
 
         install_path = os.path.join(install_dir, self._zip_root_dir)
         self.install_mime_type(install_path)
@@ -307,9 +579,8 @@ class ActivityBundle(Bundle):
                 os.makedirs(mime_pkg_dir)
             installed_mime_path = os.path.join(mime_pkg_dir,
                                                '%s.xml' % self._bundle_id)
-            self._symlink(mime_path, installed_mime_path)
-            os.spawnlp(os.P_WAIT, 'update-mime-database',
-                       'update-mime-database', mime_dir)
+            _run_or_defer(self._symlink, mime_path, installed_mime_path)
+            _update_mime_database(mime_dir)
 
         mime_types = self.get_mime_types()
         if mime_types is not None:
@@ -324,10 +595,10 @@ class ActivityBundle(Bundle):
                                               mime_type.replace('/', '-'))
                 svg_file = mime_icon_base + '.svg'
                 info_file = mime_icon_base + '.icon'
-                self._symlink(svg_file,
+                _run_or_defer(self._symlink, svg_file,
                               os.path.join(installed_icons_dir,
                                            os.path.basename(svg_file)))
-                self._symlink(info_file,
+                _run_or_defer(self._symlink, info_file,
                               os.path.join(installed_icons_dir,
                                            os.path.basename(info_file)))
 
@@ -343,6 +614,19 @@ class ActivityBundle(Bundle):
             os.unlink(dst)
         os.symlink(src, dst)
 
+    def _remove_link(self, path):
+        if os.path.lexists(path):
+            os.remove(path)
+
+    def _remove_icon_links(self, installed_icons_dir, install_path):
+        if not os.path.isdir(installed_icons_dir):
+            return
+        for f in os.listdir(installed_icons_dir):
+            path = os.path.join(installed_icons_dir, f)
+            if os.path.islink(path) and \
+               os.readlink(path).startswith(install_path):
+                os.remove(path)
+
     def uninstall(self, force=False, delete_profile=False):
         install_path = self.get_path()
 
@@ -358,28 +642,31 @@ class ActivityBundle(Bundle):
         mime_dir = os.path.join(xdg_data_home, 'mime')
         installed_mime_path = os.path.join(mime_dir, 'packages',
                                            '%s.xml' % self._bundle_id)
-        if os.path.exists(installed_mime_path):
+        if _batch is not None:
+            # The link may still be pending in the batch
+            mime_path = os.path.join(install_path, 'activity',
+                                     'mimetypes.xml')
+            if os.path.isfile(mime_path) or \
+                    os.path.lexists(installed_mime_path):
+                _run_or_defer(self._remove_link, installed_mime_path)
+                _update_mime_database(mime_dir)
+        elif os.path.exists(installed_mime_path):
             os.remove(installed_mime_path)
-            os.spawnlp(os.P_WAIT, 'update-mime-database',
-                       'update-mime-database', mime_dir)
+            _update_mime_database(mime_dir)
 
         mime_types = self.get_mime_types()
         if mime_types is not None:
             installed_icons_dir = \
                 os.path.join(xdg_data_home,
                              'icons/sugar/scalable/mimetypes')
-            if os.path.isdir(installed_icons_dir):
-                for f in os.listdir(installed_icons_dir):
-                    path = os.path.join(installed_icons_dir, f)
-                    if os.path.islink(path) and \
-                       os.readlink(path).startswith(install_path):
-                        os.remove(path)
+            _run_or_defer(self._remove_icon_links, installed_icons_dir,
+                          install_path)
 
         if delete_profile:
             bundle_profile_path = env.get_profile_path(self._bundle_id)
             if os.path.exists(bundle_profile_path):
                 os.chmod(bundle_profile_path, 0775)
-                shutil.rmtree(bundle_profile_path, ignore_errors=True)
+                move_to_trash(bundle_profile_path)
 
         self._uninstall(install_path)
 
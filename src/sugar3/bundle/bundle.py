@@ -21,10 +21,42 @@ UNSTABLE.
 """
 
 import os
+import errno
+import hashlib
+import stat
+import time
 import logging
 import shutil
-import StringIO
+import subprocess
+import tempfile
+import threading
 import zipfile
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from sugar3 import env
+from sugar3 import dispatch
+from sugar3.bundle.objectstore import ObjectStore
+
+
+# Sent while a bundle is extracted, with the bundle as sender and the
+# extracted and total keyword arguments, in bytes
+extract_progress = dispatch.Signal()
+
+# Members at least this big are decompressed in a thread pool
+_PARALLEL_MEMBER_SIZE = 1024 * 1024
+_EXTRACT_THREADS = 4
+_EXTRACT_CHUNK_SIZE = 64 * 1024
+_PROGRESS_INTERVAL = 0.1
+
+# Hidden directories left in the install directories by a trash entry on
+# another file system, or by an extraction, see _rename_to_trash() and
+# Bundle._unzip(). These prefixes are reserved to them, they are in use
+# until they are this old.
+_TRASH_PREFIX = '.sugar-trash-'
+_INSTALL_PREFIX = '.sugar-install-'
+_LEFTOVER_MAX_AGE = 3600
 
 
 class AlreadyInstalledException(Exception):
@@ -51,6 +83,192 @@ class MalformedBundleException(Exception):
     pass
 
 
+# Trash entries waiting for the reclaim worker, see move_to_trash()
+_trash_entries = deque()
+_trash_pending = set()
+_trash_lock = threading.Lock()
+_trash_worker = None
+_trash_scanned = False
+
+
+def _get_trash_path():
+    return env.get_profile_path('trash')
+
+
+def _rename_to_trash(path):
+    # Returns the new path, inside a trash entry of its own
+    trash_path = _get_trash_path()
+    try:
+        os.makedirs(trash_path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    entry = tempfile.mkdtemp(dir=trash_path)
+    trashed_path = os.path.join(entry, os.path.basename(path))
+    try:
+        os.rename(path, trashed_path)
+    except OSError, e:
+        os.rmdir(entry)
+        if e.errno != errno.EXDEV:
+            raise
+        # The trash is on another file system, stay next to path
+        entry = tempfile.mkdtemp(prefix=_TRASH_PREFIX,
+                                 dir=os.path.dirname(path))
+        trashed_path = os.path.join(entry, os.path.basename(path))
+        try:
+            os.rename(path, trashed_path)
+        except OSError:
+            os.rmdir(entry)
+            raise
+    return trashed_path
+
+
+def _find_trash():
+    # What previous sessions left in the trash and the install directories
+    found = []
+    trash_path = _get_trash_path()
+    try:
+        names = os.listdir(trash_path)
+    except OSError:
+        names = []
+    for name in names:
+        found.append(os.path.join(trash_path, name))
+
+    now = time.time()
+    for install_dir in (env.get_user_activities_path(),
+                        env.get_user_library_path()):
+        try:
+            names = os.listdir(install_dir)
+        except OSError:
+            continue
+        for name in names:
+            if not name.startswith((_TRASH_PREFIX, _INSTALL_PREFIX)):
+                continue
+            path = os.path.join(install_dir, name)
+            try:
+                stat_result = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(stat_result.st_mode) and \
+                    now - stat_result.st_mtime >= _LEFTOVER_MAX_AGE:
+                found.append(path)
+    return found
+
+
+def _queue_entry(entry):
+    # Called with _trash_lock held
+    if entry not in _trash_pending:
+        _trash_pending.add(entry)
+        _trash_entries.append(entry)
+
+
+def _reclaim(entry):
+    global _trash_worker
+    global _trash_scanned
+
+    with _trash_lock:
+        _queue_entry(entry)
+        if _trash_worker is None:
+            scan = not _trash_scanned
+            _trash_scanned = True
+
+            # Otherwise, with older PyGObject, the thread doesn't run
+            # while the main loop is idle
+            from gi.repository import GObject
+            GObject.threads_init()
+
+            _trash_worker = threading.Thread(target=_reclaim_worker,
+                                             args=(scan, ))
+            _trash_worker.daemon = True
+            _trash_worker.start()
+
+
+def _reclaim_worker(scan):
+    global _trash_worker
+
+    # The module globals are cleared while the interpreter exits, what
+    # isn't deleted by then is resumed by reclaim_trash()
+    lock = _trash_lock
+    entries = _trash_entries
+    pending = _trash_pending
+    remove_tree = _remove_tree
+    collect_objects = _collect_objects
+
+    if scan:
+        # The first worker of the session also picks up what the
+        # previous ones didn't delete
+        found = _find_trash()
+        with lock:
+            for entry in found:
+                _queue_entry(entry)
+
+    while True:
+        with lock:
+            if not entries:
+                # Exit when idle, a new worker is started when needed
+                _trash_worker = None
+                return
+            entry = entries.popleft()
+        try:
+            remove_tree(entry)
+        finally:
+            with lock:
+                pending.discard(entry)
+        if not entries:
+            # Deduplicated bundles may have been the last users of objects
+            collect_objects()
+
+
+def _collect_objects():
+    store = ObjectStore()
+    if store.exists():
+        store.collect()
+
+
+def _remove_tree(path):
+    # With the idle I/O scheduling class, not to slow down the session
+    try:
+        returncode = subprocess.call(['ionice', '-c', '3', 'rm', '-rf',
+                                      path], close_fds=True)
+    except OSError:
+        returncode = None
+    if returncode != 0 and os.path.lexists(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def move_to_trash(path):
+    """Remove path, returning as soon as it's out of the way
+
+    path is renamed into the trash of the profile and deleted later by a
+    worker thread, with a low I/O priority. Raises OSError if path can't
+    be moved.
+    """
+    _reclaim(os.path.dirname(_rename_to_trash(path)))
+
+
+def reclaim_trash(wait=False):
+    """Delete what is left in the trash in the background
+
+    Deletions interrupted by the end of a previous session are resumed,
+    as well as the hidden directories left in the install directories
+    by interrupted installations. This is also done the first time
+    something is moved to the trash.
+
+    wait -- block until the trash is empty
+    """
+    global _trash_scanned
+
+    with _trash_lock:
+        _trash_scanned = True
+    for entry in _find_trash():
+        _reclaim(entry)
+
+    worker = _trash_worker
+    if wait and worker is not None:
+        worker.join()
+
+
 class Bundle(object):
     """A Sugar activity, content module, etc.
 
@@ -69,6 +287,9 @@ class Bundle(object):
         self._path = path
         self._zip_root_dir = None
         self._zip_file = None
+        # Directories of the zip file, with their root dir prefix
+        self._zip_dirs = None
+        self._install_stats = None
         self._installation_time = os.stat(path).st_mtime
 
         if not os.path.isdir(self._path):
@@ -103,12 +324,18 @@ class Bundle(object):
                     'directory whose name ends with %r' %
                     self._unzipped_extension)
 
+        self._zip_dirs = set()
         for file_name in file_names:
             if not file_name.startswith(self._zip_root_dir):
                 raise MalformedBundleException(
                     'All files in the bundle must be inside a single ' +
                     'top-level directory')
 
+            directory = os.path.dirname(file_name)
+            while directory and directory not in self._zip_dirs:
+                self._zip_dirs.add(directory)
+                directory = os.path.dirname(directory)
+
     def get_file(self, filename):
         f = None
 
@@ -121,8 +348,8 @@ class Bundle(object):
         else:
             path = os.path.join(self._zip_root_dir, filename)
             try:
-                data = self._zip_file.read(path)
-                f = StringIO.StringIO(data)
+                # Decompressed as it is read
+                f = self._zip_file.open(path)
             except KeyError:
                 logging.debug('%s not found.', filename)
 
@@ -146,11 +373,8 @@ class Bundle(object):
             path = os.path.join(self._path, filename)
             return os.path.isdir(path)
         else:
-            path = os.path.join(self._zip_root_dir, filename, "")
-            for f in self._zip_file.namelist():
-                if f.startswith(path):
-                    return True
-            return False
+            path = os.path.join(self._zip_root_dir, filename).rstrip('/')
+            return path in self._zip_dirs
 
     def get_path(self):
         """Get the bundle path."""
@@ -161,24 +385,213 @@ class Bundle(object):
         installed."""
         return self._installation_time
 
-    def _unzip(self, install_dir):
+    def get_install_stats(self):
+        """Get statistics about the last installation of this bundle
+
+        Returns None if it wasn't installed, a dict otherwise, with the
+        keys time (seconds), files and size (bytes) of the installed
+        regular files, deduplicated_files and deduplicated_size, the
+        part of them that was already in the object store.
+        """
+        return self._install_stats
+
+    def _unzip(self, install_dir, deduplicate=False):
+        """Extract the bundle to install_dir, replacing a previous install
+
+        The bundle is extracted into a temporary directory next to its
+        final place and renamed into it once complete, so a failed or
+        interrupted extraction never leaves a partial install behind.
+
+        deduplicate -- take the regular files from the object store, see
+            sugar3.bundle.objectstore
+        """
         if self._zip_file is None:
             raise AlreadyInstalledException
 
+        start = time.time()
         if not os.path.isdir(install_dir):
             os.mkdir(install_dir, 0775)
 
-        # zipfile provides API that in theory would let us do this
-        # correctly by hand, but handling all the oddities of
-        # Windows/UNIX mappings, extension attributes, deprecated
-        # features, etc makes it impractical.
-        if os.spawnlp(os.P_WAIT, 'unzip', 'unzip', '-o', self._path,
-                      '-x', 'mimetype', '-d', install_dir):
-            # clean up install dir after failure
-            shutil.rmtree(os.path.join(install_dir, self._zip_root_dir),
-                          ignore_errors=True)
-            # indicate failure.
-            raise ZipExtractException
+        store = None
+        if deduplicate:
+            store = ObjectStore()
+            if not store.can_link_to(install_dir):
+                logging.warning('Cannot deduplicate %s, the object store '
+                                'is on another file system', self._path)
+                store = None
+
+        temp_dir = tempfile.mkdtemp(prefix=_INSTALL_PREFIX, dir=install_dir)
+        try:
+            try:
+                stats = self._extract(temp_dir, store)
+            except (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error,
+                    IOError, OSError, ValueError, RuntimeError), e:
+                raise ZipExtractException('Error extracting %s: %s' %
+                                          (self._path, e))
+            self._replace_dir(os.path.join(temp_dir, self._zip_root_dir),
+                              os.path.join(install_dir, self._zip_root_dir))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        stats['time'] = time.time() - start
+        self._install_stats = stats
+        logging.debug('Installed %s in %.2f s, %d of %d files deduplicated, '
+                      '%d bytes saved', self._path, stats['time'],
+                      stats['deduplicated_files'], stats['files'],
+                      stats['deduplicated_size'])
+
+    def _replace_dir(self, new_path, path):
+        if not os.path.lexists(path):
+            os.rename(new_path, path)
+            return
+
+        old_path = _rename_to_trash(path)
+        try:
+            os.rename(new_path, path)
+        except OSError:
+            os.rename(old_path, path)
+            os.rmdir(os.path.dirname(old_path))
+            raise
+        _reclaim(os.path.dirname(old_path))
+
+    def _extract(self, dest_dir, store=None):
+        infos = [info for info in self._zip_file.infolist()
+                 if info.filename != 'mimetype']
+        progress = _ExtractProgress(self, sum(info.file_size
+                                              for info in infos))
+        stats = {'files': 0, 'size': 0,
+                 'deduplicated_files': 0, 'deduplicated_size': 0}
+
+        def add_stats(info, deduplicated):
+            stats['files'] += 1
+            stats['size'] += info.file_size
+            if deduplicated:
+                stats['deduplicated_files'] += 1
+                stats['deduplicated_size'] += info.file_size
+
+        large_infos = []
+        # Created last, like unzip does, so that no member is written
+        # through a symbolic link of the bundle
+        link_infos = []
+        for info in infos:
+            path = self._get_extract_path(dest_dir, info.filename)
+            mode = info.external_attr >> 16
+            if info.filename.endswith('/'):
+                if not os.path.isdir(path):
+                    self._check_extract_dir(dest_dir, path)
+                    os.makedirs(path)
+            elif stat.S_ISLNK(mode):
+                link_infos.append((info, path))
+            elif info.file_size >= _PARALLEL_MEMBER_SIZE:
+                large_infos.append((info, path))
+            else:
+                add_stats(info, self._extract_file(info, path, dest_dir,
+                                                   progress, store))
+            progress.update()
+
+        if large_infos:
+            pool = ThreadPool(min(_EXTRACT_THREADS, len(large_infos)))
+            try:
+                results = [pool.apply_async(self._extract_file,
+                                            args + (dest_dir, progress,
+                                                    store))
+                           for args in large_infos]
+                for (info, path_), result in zip(large_infos, results):
+                    while not result.ready():
+                        result.wait(_PROGRESS_INTERVAL)
+                        progress.update()
+                    # Raises the exception of the worker, if any
+                    add_stats(info, result.get())
+            finally:
+                pool.terminate()
+                pool.join()
+
+        for info, path in link_infos:
+            self._extract_symlink(info, path, dest_dir)
+            progress.add(info.file_size)
+        progress.finish()
+        return stats
+
+    def _get_extract_path(self, dest_dir, name):
+        parts = [part for part in name.split('/') if part]
+        if name.startswith('/') or '..' in parts or not parts:
+            raise ZipExtractException('Unsafe path %r in %s' %
+                                      (name, self._path))
+        return os.path.join(dest_dir, *parts)
+
+    def _check_extract_dir(self, dest_dir, path):
+        # The textual checks don't see where the symbolic links lead
+        real_dest_dir = os.path.realpath(dest_dir)
+        directory = os.path.realpath(os.path.dirname(path))
+        if not (directory + '/').startswith(real_dest_dir + '/'):
+            raise ZipExtractException('Path %r in %s leads out of the '
+                                      'bundle' % (path, self._path))
+
+    def _make_parent_dir(self, dest_dir, path):
+        self._check_extract_dir(dest_dir, path)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def _extract_file(self, info, path, dest_dir, progress, store=None):
+        # Returns whether the file was in the object store already
+        self._make_parent_dir(dest_dir, path)
+        if store is None:
+            target_path = path
+            f = open(path, 'wb')
+        else:
+            fd, target_path = store.create_temp()
+            f = os.fdopen(fd, 'wb')
+            digest = hashlib.sha1()
+
+        # ZipExtFile checks the CRC of the data when it reaches the end
+        source = self._zip_file.open(info)
+        try:
+            with f:
+                while True:
+                    data = source.read(_EXTRACT_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    if store is not None:
+                        digest.update(data)
+                    progress.add(len(data))
+        except:
+            if store is not None:
+                os.unlink(target_path)
+            raise
+        finally:
+            source.close()
+
+        mode = (info.external_attr >> 16) & 0777
+        if store is not None:
+            # Shared files must not be written to
+            mode = ((mode or 0644) | stat.S_IRUSR) & ~0222
+            os.chmod(target_path, mode)
+        elif mode:
+            os.chmod(path, mode | stat.S_IRUSR | stat.S_IWUSR)
+        # A shared file keeps the time of the bundle that stored it first
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        os.utime(target_path, (mtime, mtime))
+
+        if store is None:
+            return False
+        return store.commit(target_path, digest.hexdigest(), mode, path)
+
+    def _extract_symlink(self, info, path, dest_dir):
+        target = self._zip_file.read(info)
+        link_dir = os.path.dirname(info.filename)
+        resolved = os.path.normpath(os.path.join(link_dir, target))
+        if os.path.isabs(target) or \
+                not (resolved + '/').startswith(self._zip_root_dir + '/'):
+            raise ZipExtractException('Symbolic link %r in %s points out of '
+                                      'the bundle' % (info.filename,
+                                                      self._path))
+        self._make_parent_dir(dest_dir, path)
+        os.symlink(target, path)
 
     def _zip(self, bundle_path):
         if self._zip_file is not None:
@@ -194,13 +607,37 @@ class Bundle(object):
             if ext != self._unzipped_extension:
                 raise InvalidPathException
 
-        for root, dirs, files in os.walk(install_path, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                path = os.path.join(root, name)
-                if os.path.islink(path):
-                    os.remove(path)
-                else:
-                    os.rmdir(path)
-        os.rmdir(install_path)
+        move_to_trash(install_path)
+
+
+class _ExtractProgress(object):
+    """Count the bytes extracted by several threads, send extract_progress
+
+    add() can be called from any thread. The signal is only sent from the
+    thread that calls update() or finish(), update() sends it at most
+    every _PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, bundle, total):
+        self._bundle = bundle
+        self._total = total
+        self._extracted = 0
+        self._lock = threading.Lock()
+        self._last_sent = 0
+
+    def add(self, count):
+        with self._lock:
+            self._extracted += count
+
+    def update(self):
+        now = time.time()
+        if now - self._last_sent >= _PROGRESS_INTERVAL:
+            self._last_sent = now
+            self._send()
+
+    def finish(self):
+        self._send()
+
+    def _send(self):
+        extract_progress.send(self._bundle, extracted=self._extracted,
+                              total=self._total)
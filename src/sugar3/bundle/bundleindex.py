@@ -0,0 +1,197 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Persistent index of the installed activity bundles
+
+The index keeps the info records of the installed ActivityBundles in a
+single json file, so that enumerating the installed activities doesn't
+need to parse any activity.info or activity.linfo file that didn't
+change since the last time.
+
+    index = BundleIndex()
+    for bundle in index.get_bundles(env.get_user_activities_path()):
+        ...
+    index.save()
+
+UNSTABLE.
+"""
+
+import os
+import errno
+import json
+import logging
+
+from sugar3 import env
+from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.bundle import MalformedBundleException
+
+
+_INDEX_VERSION = 2
+
+
+def _get_linfo_mtimes(path):
+    """Return the modification times of the activity.linfo files of the
+    bundle at path, by language"""
+    mtimes = {}
+    locale_path = os.path.join(path, 'locale')
+    try:
+        langs = os.listdir(locale_path)
+    except OSError:
+        return mtimes
+    for lang in langs:
+        try:
+            linfo_stat = os.stat(os.path.join(locale_path, lang,
+                                              'activity.linfo'))
+        except OSError:
+            continue
+        mtimes[lang] = linfo_stat.st_mtime
+    return mtimes
+
+
+class BundleIndex(object):
+    """Cache of the parsed metadata of the installed activity bundles
+
+    The records are keyed by bundle path. A record is used as long as the
+    modification times of the bundle directory, of its activity.info and
+    of its activity.linfo files didn't change, otherwise the bundle is
+    parsed again. The records hold
+    the translations of all the locales of the bundle, so they stay valid
+    when the language changes.
+    """
+
+    def __init__(self, index_path=None):
+        if index_path is None:
+            index_path = env.get_profile_path('bundle-index.json')
+        self._index_path = index_path
+        self._records = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.warning('Cannot read the bundle index %s: %s',
+                                self._index_path, e)
+            return
+        except ValueError:
+            logging.warning('Ignoring corrupted bundle index %s',
+                            self._index_path)
+            return
+
+        if not isinstance(index, dict) or \
+                index.get('version') != _INDEX_VERSION:
+            return
+
+        for path, entry in index.get('bundles', {}).iteritems():
+            self._records[path.encode('utf-8')] = entry
+
+    def save(self):
+        """Write the index back to disk, if it changed"""
+        if not self._dirty:
+            return
+
+        temp_path = self._index_path + '.%d.tmp' % os.getpid()
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'version': _INDEX_VERSION,
+                           'bundles': self._records}, f)
+            os.rename(temp_path, self._index_path)
+        except (IOError, OSError), e:
+            logging.warning('Cannot write the bundle index %s: %s',
+                            self._index_path, e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self._dirty = False
+
+    def get_bundle(self, path, translated=True):
+        """Return the ActivityBundle installed at path
+
+        The bundle is built from the index if its entry is still valid,
+        it's parsed and its entry is updated otherwise. Raises
+        MalformedBundleException if path isn't a valid activity bundle.
+        """
+        try:
+            bundle_mtime = os.stat(path).st_mtime
+        except OSError:
+            self.remove(path)
+            raise MalformedBundleException('Cannot access %s' % path)
+        linfo_mtimes = _get_linfo_mtimes(path)
+
+        entry = self._records.get(path)
+        if entry is not None and entry['mtime'] == bundle_mtime and \
+                entry['linfo_mtimes'] == linfo_mtimes:
+            bundle = ActivityBundle(path, translated,
+                                    info_record=entry['record'])
+            # The bundle parses itself again if activity.info changed
+            # in place, the languages tell which way it went
+            if bundle._languages == '*':
+                return bundle
+        else:
+            bundle = ActivityBundle(path, translated)
+
+        try:
+            record = bundle.get_info_record(all_languages=True)
+        except (IOError, OSError), e:
+            logging.warning('Cannot index the bundle %s: %s', path, e)
+            return bundle
+
+        self._records[path] = {'mtime': bundle_mtime,
+                               'linfo_mtimes': linfo_mtimes,
+                               'record': record}
+        self._dirty = True
+        return bundle
+
+    def get_bundles(self, directory, translated=True):
+        """Return the ActivityBundles installed in directory
+
+        Entries of bundles that were removed from directory are dropped
+        from the index.
+        """
+        try:
+            names = os.listdir(directory)
+        except OSError, e:
+            logging.warning('Cannot list the bundles of %s: %s',
+                            directory, e)
+            names = []
+
+        bundles = []
+        paths = set()
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            # Hidden directories are left by installations in progress
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            paths.add(path)
+            try:
+                bundles.append(self.get_bundle(path, translated))
+            except MalformedBundleException, e:
+                logging.debug('Skipping %s: %s', path, e)
+
+        for path in self._records.keys():
+            if os.path.dirname(path) == directory and path not in paths:
+                self.remove(path)
+
+        return bundles
+
+    def remove(self, path):
+        """Drop the entry of the bundle installed at path"""
+        if self._records.pop(path, None) is not None:
+            self._dirty = True
@@ -60,7 +60,7 @@ class ContentBundle(Bundle):
             raise MalformedBundleException('No library.info file')
         self._parse_info(info_file)
 
-        if self.get_file(self._activity_start) is None:
+        if not self.is_file(self._activity_start):
             raise MalformedBundleException(
                 'Content bundle %s does not have start page %s' %
                 (self._path, self._activity_start))
@@ -153,9 +153,9 @@ class ContentBundle(Bundle):
     def get_tags(self):
         return None
 
-    def install(self):
+    def install(self, deduplicate=False):
         install_path = env.get_user_library_path()
-        self._unzip(install_path)
+        self._unzip(install_path, deduplicate)
         return os.path.join(install_path, self._zip_root_dir)
 
     def uninstall(self, force=False, delete_profile=False):
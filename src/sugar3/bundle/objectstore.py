@@ -0,0 +1,179 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Content addressed store for the files of installed bundles
+
+Bundles installed with deduplication get their regular files from the
+store: every distinct content is kept once, named after its sha1 and
+mode, and hard linked into each bundle directory that contains it. The
+files of the store are read only, writing into one would change it in
+all the bundles that share it.
+
+An object is unused when the store holds its only link, collect()
+deletes those.
+
+UNSTABLE.
+"""
+
+import os
+import errno
+import time
+import logging
+import tempfile
+
+from sugar3 import env
+
+
+_TEMP_DIR = 'tmp'
+# Temporary files older than this are left over by interrupted installs
+_TEMP_MAX_AGE = 3600
+
+
+class ObjectStore(object):
+
+    def __init__(self, path=None):
+        if path is None:
+            path = env.get_profile_path('objects')
+        self._path = path
+        self._temp_path = os.path.join(path, _TEMP_DIR)
+
+    def get_path(self):
+        return self._path
+
+    def exists(self):
+        return os.path.isdir(self._path)
+
+    def can_link_to(self, directory):
+        """Whether the objects can be hard linked into directory"""
+        self._make_dir(self._temp_path)
+        return os.stat(self._temp_path).st_dev == os.stat(directory).st_dev
+
+    def create_temp(self):
+        """Return the file descriptor and the path of a new temporary file
+
+        The file is meant to be passed to commit() once written.
+        """
+        self._make_dir(self._temp_path)
+        return tempfile.mkstemp(dir=self._temp_path)
+
+    def commit(self, temp_path, digest, mode, path):
+        """Move temp_path to path, sharing it with the store
+
+        digest is the sha1 hex digest of the content of temp_path and mode
+        its permissions. If the store has the object already, it's linked
+        to path and temp_path is deleted, otherwise temp_path becomes the
+        object. Returns whether the object was stored already.
+        """
+        object_path = os.path.join(self._path, digest[:2],
+                                   '%s-%o' % (digest[2:], mode))
+        while True:
+            self._make_dir(os.path.dirname(object_path))
+            try:
+                os.link(temp_path, object_path)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    # The directory was collected in the meantime
+                    continue
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                os.rename(temp_path, path)
+                return False
+
+            try:
+                os.link(object_path, path)
+            except OSError, e:
+                # The object was collected in the meantime
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                os.unlink(temp_path)
+                return True
+
+    def collect(self):
+        """Delete the objects that no bundle uses anymore
+
+        Returns the number of bytes freed.
+        """
+        freed = 0
+        now = time.time()
+        for prefix, name, stat_result in self._walk():
+            path = os.path.join(self._path, prefix, name)
+            if prefix == _TEMP_DIR:
+                if now - stat_result.st_mtime < _TEMP_MAX_AGE:
+                    continue
+            elif stat_result.st_nlink > 1:
+                continue
+            try:
+                os.unlink(path)
+            except OSError, e:
+                logging.warning('Cannot remove %s: %s', path, e)
+                continue
+            freed += stat_result.st_size
+
+        for prefix in self._list(self._path):
+            if prefix != _TEMP_DIR:
+                try:
+                    os.rmdir(os.path.join(self._path, prefix))
+                except OSError:
+                    # Not empty
+                    pass
+
+        if freed:
+            logging.debug('Freed %d bytes from the object store', freed)
+        return freed
+
+    def get_stats(self):
+        """Return the number of objects, their size, and the size saved
+
+        The saved size is what the bundles would take in addition if they
+        had their own copy of the objects they share.
+        """
+        count = 0
+        size = 0
+        saved = 0
+        for prefix, name_, stat_result in self._walk():
+            if prefix == _TEMP_DIR:
+                continue
+            count += 1
+            size += stat_result.st_size
+            # One link is the store's, one is the first bundle's
+            saved += stat_result.st_size * max(stat_result.st_nlink - 2, 0)
+        return count, size, saved
+
+    def _walk(self):
+        for prefix in self._list(self._path):
+            prefix_path = os.path.join(self._path, prefix)
+            for name in self._list(prefix_path):
+                try:
+                    stat_result = os.lstat(os.path.join(prefix_path, name))
+                except OSError:
+                    continue
+                yield prefix, name, stat_result
+
+    def _list(self, path):
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+
+    def _make_dir(self, path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
@@ -57,22 +57,32 @@ def _get_data_store():
 
 
 def __datastore_created_cb(object_id):
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
-    updated.send(None, object_id=object_id, metadata=metadata)
+    _changed.send_deferred(None, object_id=object_id)
 
 
 def __datastore_updated_cb(object_id):
+    _changed.send_deferred(None, object_id=object_id)
+
+
+def __changed_cb(signal, sender, object_id, **kwargs):
+    # A burst of Updated signals for the same entry results in one
+    # metadata request and one updated emission per main loop iteration
     metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
     updated.send(None, object_id=object_id, metadata=metadata)
 
 
 def __datastore_deleted_cb(object_id):
+    # The entry is gone, a queued update would come after the deletion
+    _changed.cancel_deferred(None, object_id)
     deleted.send(None, object_id=object_id)
 
 created = dispatch.Signal()
 deleted = dispatch.Signal()
 updated = dispatch.Signal()
 
+_changed = dispatch.Signal(coalesce_key='object_id')
+_changed.connect(__changed_cb, weak=False)
+
 _get_data_store()
 
 
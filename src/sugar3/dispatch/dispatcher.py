@@ -1,4 +1,6 @@
+import logging
 import weakref
+from collections import OrderedDict
 try:
     set
 except NameError:
@@ -8,6 +10,9 @@ from sugar3.dispatch import saferef
 
 WEAKREF_TYPES = (weakref.ReferenceType, saferef.BoundMethodWeakref)
 
+# Above this many cached senders, the whole cache is dropped
+_MAX_CACHED_SENDERS = 256
+
 
 def _make_id(target):
     if hasattr(target, 'im_func'):
@@ -19,19 +24,50 @@ class Signal(object):
     """Base class for all signals
 
     Internal attributes:
-        receivers -- { receriverkey (id) : weakref(receiver) }
+        _receivers -- { lookupkey : (sequence, senderkey, weakref(receiver)) }
+        _sender_receivers -- { senderkey : set(lookupkey) }
+        _reference_keys -- { id(weakref(receiver)) : set(lookupkey) }
+        _cache -- { senderkey : ((receiver, is_weak), ...) }
+        _deferred -- { queuekey : (sender, named) }, in emission order
+
+    Counters of the deferred emissions:
+        deferred_count -- emissions queued by send_deferred()
+        coalesced_count -- emissions merged into an already queued one
+        flushed_count -- emissions actually delivered to the receivers
     """
 
-    def __init__(self, providing_args=None):
+    def __init__(self, providing_args=None, coalesce_key=None):
         """providing_args -- A list of the arguments
                        this signal can pass along in
                        a send() call.
+        coalesce_key -- the name of the argument identifying the emissions
+                       that send_deferred() can merge, or None to deliver
+                       every deferred emission.
         """
-        self.receivers = []
+        self._receivers = {}
+        self._sender_receivers = {}
+        self._reference_keys = {}
+        self._cache = {}
+        self._sequence = 0
+        self._deferred = OrderedDict()
+        self._deferred_sid = None
+        self._deferred_sequence = 0
+        self.coalesce_key = coalesce_key
+        self.deferred_count = 0
+        self.coalesced_count = 0
+        self.flushed_count = 0
         if providing_args is None:
             providing_args = []
         self.providing_args = set(providing_args)
 
+    @property
+    def receivers(self):
+        """List of (lookupkey, receiver) pairs, in connection order"""
+        entries = sorted(self._receivers.iteritems(),
+                         key=lambda entry: entry[1][0])
+        return [(lookup_key, receiver)
+                for lookup_key, (seq_, senderkey_, receiver) in entries]
+
     def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
         """Connect receiver to sender for signal
 
@@ -69,15 +105,19 @@ class Signal(object):
         else:
             lookup_key = (_make_id(receiver), _make_id(sender))
 
+        if lookup_key in self._receivers:
+            return
+
         if weak:
             receiver = saferef.safeRef(
                 receiver, onDelete=self._remove_receiver)
 
-        for r_key, _ in self.receivers:
-            if r_key == lookup_key:
-                break
-        else:
-            self.receivers.append((lookup_key, receiver))
+        senderkey = lookup_key[1]
+        self._sequence += 1
+        self._receivers[lookup_key] = (self._sequence, senderkey, receiver)
+        self._sender_receivers.setdefault(senderkey, set()).add(lookup_key)
+        self._reference_keys.setdefault(id(receiver), set()).add(lookup_key)
+        self._cache.clear()
 
     def disconnect(self, receiver=None, sender=None, weak=True,
                    dispatch_uid=None):
@@ -102,9 +142,25 @@ class Signal(object):
         else:
             lookup_key = (_make_id(receiver), _make_id(sender))
 
-        for idx, (r_key, _) in enumerate(self.receivers):
-            if r_key == lookup_key:
-                del self.receivers[idx]
+        self._remove_key(lookup_key)
+
+    def _remove_key(self, lookup_key):
+        entry = self._receivers.pop(lookup_key, None)
+        if entry is None:
+            return
+        seq_, senderkey, receiver = entry
+
+        keys = self._sender_receivers[senderkey]
+        keys.discard(lookup_key)
+        if not keys:
+            del self._sender_receivers[senderkey]
+
+        keys = self._reference_keys[id(receiver)]
+        keys.discard(lookup_key)
+        if not keys:
+            del self._reference_keys[id(receiver)]
+
+        self._cache.clear()
 
     def send(self, sender, **named):
         """Send signal from sender to all connected receivers.
@@ -123,7 +179,7 @@ class Signal(object):
         """
 
         responses = []
-        if not self.receivers:
+        if not self._receivers:
             return responses
 
         for receiver in self._live_receivers(_make_id(sender)):
@@ -151,7 +207,7 @@ class Signal(object):
         """
 
         responses = []
-        if not self.receivers:
+        if not self._receivers:
             return responses
 
         # Call each receiver with whatever arguments it can accept.
@@ -165,6 +221,83 @@ class Signal(object):
                 responses.append((receiver, response))
         return responses
 
+    def send_deferred(self, sender, **named):
+        """Queue the emission of the signal to the next main loop iteration
+
+        sender -- the sender of the signal
+            Either a specific object or None.
+
+        named -- named arguments which will be passed to receivers.
+
+        Emissions from the same sender with the same value for the
+        coalesce_key argument are merged while queued, only the arguments
+        of the last one are delivered. Emissions with an unhashable value
+        are not merged. The receivers are called as with send_robust(),
+        errors are logged.
+
+        returns None
+        """
+        queue_key = self._get_queue_key(sender, named)
+        if queue_key is None:
+            self._deferred_sequence += 1
+            queue_key = self._deferred_sequence
+
+        self.deferred_count += 1
+        if queue_key in self._deferred:
+            self.coalesced_count += 1
+        self._deferred[queue_key] = (sender, named)
+
+        if self._deferred_sid is None:
+            # Imported here so that dispatch can be used without GLib
+            from gi.repository import GLib
+            self._deferred_sid = GLib.idle_add(self.__deferred_idle_cb)
+
+    def cancel_deferred(self, sender, key):
+        """Drop the queued emission of sender with key as coalesce_key
+
+        returns whether such an emission was queued
+        """
+        queue_key = self._get_queue_key(sender, {self.coalesce_key: key})
+        if queue_key is None or queue_key not in self._deferred:
+            return False
+        del self._deferred[queue_key]
+        return True
+
+    def _get_queue_key(self, sender, named):
+        if self.coalesce_key is None or self.coalesce_key not in named:
+            return None
+        queue_key = (_make_id(sender), named[self.coalesce_key])
+        try:
+            hash(queue_key)
+        except TypeError:
+            return None
+        return queue_key
+
+    def flush_deferred(self):
+        """Deliver the queued emissions now"""
+        if self._deferred_sid is not None:
+            from gi.repository import GLib
+            GLib.source_remove(self._deferred_sid)
+            self._deferred_sid = None
+        self._flush_deferred()
+
+    def __deferred_idle_cb(self):
+        self._deferred_sid = None
+        self._flush_deferred()
+        return False
+
+    def _flush_deferred(self):
+        # Emissions queued by the receivers go to the next iteration
+        deferred = self._deferred
+        self._deferred = OrderedDict()
+
+        for sender, named in deferred.itervalues():
+            self.flushed_count += 1
+            for receiver, response in self.send_robust(sender, **named):
+                if isinstance(response, Exception):
+                    logging.error('Error in %r receiving a deferred signal: '
+                                  '%s', receiver, response)
+
     def _live_receivers(self, senderkey):
         """Filter sequence of receivers to get resolved, live receivers
 
@@ -172,26 +305,39 @@ class Signal(object):
         and resolves them, then returning only live
         receivers.
         """
+        try:
+            receivers = self._cache[senderkey]
+        except KeyError:
+            receivers = self._get_receivers(senderkey)
+
+        for receiver, is_weak in receivers:
+            if is_weak:
+                # Dereference the weak reference.
+                receiver = receiver()
+                if receiver is not None:
+                    yield receiver
+            else:
+                yield receiver
+
+    def _get_receivers(self, senderkey):
+        """Build and cache the ordered receivers for senderkey"""
         none_senderkey = _make_id(None)
 
-        for (receiverkey, r_senderkey), receiver in self.receivers:
-            if r_senderkey == none_senderkey or r_senderkey == senderkey:
-                if isinstance(receiver, WEAKREF_TYPES):
-                    # Dereference the weak reference.
-                    receiver = receiver()
-                    if receiver is not None:
-                        yield receiver
-                else:
-                    yield receiver
+        keys = list(self._sender_receivers.get(none_senderkey, ()))
+        if senderkey != none_senderkey:
+            keys.extend(self._sender_receivers.get(senderkey, ()))
+
+        entries = sorted(self._receivers[key] for key in keys)
+        receivers = tuple((receiver, isinstance(receiver, WEAKREF_TYPES))
+                          for seq_, senderkey_, receiver in entries)
+
+        if len(self._cache) >= _MAX_CACHED_SENDERS:
+            self._cache.clear()
+        self._cache[senderkey] = receivers
+        return receivers
 
     def _remove_receiver(self, receiver):
         """Remove dead receivers from connections."""
 
-        to_remove = []
-        for key, connected_receiver in self.receivers:
-            if connected_receiver == receiver:
-                to_remove.append(key)
-        for key in to_remove:
-            for idx, (r_key, _) in enumerate(self.receivers):
-                if r_key == key:
-                    del self.receivers[idx]
+        for key in list(self._reference_keys.get(id(receiver), ())):
+            self._remove_key(key)
@@ -30,6 +30,7 @@ import dbus
 
 from sugar3.datastore import datastore
 from sugar3.activity.activity import PREVIEW_SIZE
+from sugar3.activity.activity import select_preview
 
 
 J_DBUS_SERVICE = 'org.laptop.Journal'
@@ -74,6 +75,10 @@ def get_preview_pixbuf(preview_data, width=-1, height=-1):
             png_width = surface.get_width()
             png_height = surface.get_height()
 
+            if png_width == width and png_height == height:
+                return Gdk.pixbuf_get_from_surface(surface, 0, 0,
+                                                   width, height)
+
             preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
                                                  width, height)
             cr = cairo.Context(preview_surface)
@@ -98,6 +103,31 @@ def get_preview_pixbuf(preview_data, width=-1, height=-1):
     return pixbuf
 
 
+def get_preview_pixbuf_from_metadata(metadata, width=-1, height=-1):
+    """Retrieve a pixbuf of the preview of an entry at the given size
+
+    If the entry has been saved with several preview sizes, the smallest
+    preview that is not smaller than the requested size is used, otherwise
+    this is the same as get_preview_pixbuf(metadata.get('preview', '')).
+
+    Keyword arguments:
+    metadata -- the metadata dictionary
+    width -- the pixbuf width, if is not set, the default width will be used
+    height -- the pixbuf width, if is not set, the default height will be used
+
+    Return: a Pixbuf or None if couldn't create it
+
+    """
+    if width == -1:
+        width = PREVIEW_SIZE[0]
+
+    if height == -1:
+        height = PREVIEW_SIZE[1]
+
+    preview_data = select_preview(metadata, width, height)
+    return get_preview_pixbuf(preview_data or '', width, height)
+
+
 class ObjectChooser(object):
 
     def __init__(self, parent=None, what_filter=None, filter_type=None,
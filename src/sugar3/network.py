@@ -20,15 +20,27 @@ STABLE.
 """
 
 import os
+import errno
+import stat
+import socket
 import threading
 import urllib
-import fcntl
+import urllib2
+import urlparse
+import httplib
+import heapq
+import collections
 import tempfile
+import ctypes
+import email.utils
+from cStringIO import StringIO
 
 from gi.repository import GObject
 import SimpleHTTPServer
 import SocketServer
 
+from sugar3 import util
+
 
 __authinfos = {}
 
@@ -45,22 +57,148 @@ def _del_authinfo():
     del __authinfos[threading.currentThread()]
 
 
+def _get_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+
+    try:
+        libc_sendfile = ctypes.CDLL('libc.so.6', use_errno=True).sendfile64
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+
+    return sendfile
+
+# sendfile(out_fd, in_fd, offset, count), copies count bytes of in_fd from
+# offset to out_fd without going through userspace, or None if unavailable
+_sendfile = _get_sendfile()
+
+# Bodies of the small files served by ChunkedGlibHTTPRequestHandler, keyed
+# by _get_cache_key() so that modified files are read again
+_file_cache = util.LRU(64)
+
+
+def _get_etag(fs):
+    # A strong validator, so it must change whenever the content may have:
+    # a file replaced or rewritten within the same second and at the same
+    # size still gets a new inode or modification time
+    return '"%x-%x-%x"' % (fs.st_ino, int(fs.st_mtime * 1e6), fs.st_size)
+
+
+def _get_cache_key(path, fs):
+    # The same fields as _get_etag(), a cached body must never be sent
+    # with the ETag of another content
+    return (path, fs.st_ino, fs.st_mtime, fs.st_size)
+
+
+def _strip_weak(tag):
+    if tag.startswith('W/'):
+        return tag[2:]
+    return tag
+
+
+def _parse_range(value, size):
+    """Parse the value of a Range header for a body of size bytes
+
+    Returns (start, end), end excluded, or None if the header is malformed
+    or asks for several ranges, in which case the whole body should be
+    sent. Raises ValueError if the range cannot be satisfied.
+    """
+    unit, sep_, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first or last):
+        return None
+    if first and not first.isdigit() or last and not last.isdigit():
+        return None
+
+    if not first:
+        # Suffix range, the last bytes of the body
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('Unsatisfiable range %r' % value)
+        return max(size - length, 0), size
+
+    start = int(first)
+    end = size
+    if last:
+        if int(last) < start:
+            return None
+        end = min(int(last) + 1, size)
+    if start >= size:
+        raise ValueError('Unsatisfiable range %r' % value)
+    return start, end
+
+
+def _parse_content_range(value):
+    """Parse the value of a Content-Range header
+
+    Returns (start, end, total), end excluded. start and end are None for
+    the 'bytes */total' form of 416 responses, total is None when the
+    server does not know it. Raises ValueError if the value is malformed.
+    """
+    unit, sep_, spec = value.strip().partition(' ')
+    if unit != 'bytes':
+        raise ValueError('Unknown range unit in %r' % value)
+    byte_range, sep, total = spec.strip().partition('/')
+    if not sep:
+        raise ValueError('Malformed Content-Range %r' % value)
+    total = None if total == '*' else int(total)
+    if byte_range == '*':
+        return None, None, total
+    first, sep_, last = byte_range.partition('-')
+    return int(first), int(last) + 1, total
+
+
 class GlibTCPServer(SocketServer.TCPServer):
     """GlibTCPServer
 
     Integrate socket accept into glib mainloop.
+
+    Handlers that send a response body in chunks register it with
+    add_transfer(). At most max_transfers bodies are sent at once, the
+    others wait for their turn, and the connections that can be written
+    to get one chunk each in turn.
     """
 
     allow_reuse_address = True
     request_queue_size = 20
+    max_transfers = 16
 
-    def __init__(self, server_address, RequestHandlerClass):
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_transfers=None):
         SocketServer.TCPServer.__init__(self, server_address,
                                         RequestHandlerClass)
         self.socket.setblocking(0)  # Set nonblocking
 
+        if max_transfers is not None:
+            self.max_transfers = max_transfers
+        self._transfers = set()
+        self._waiting = collections.deque()
+        self._ready = collections.deque()
+        self._pump_sid = 0
+
         # Watch the listener socket for data
-        GObject.io_add_watch(self.socket, GObject.IO_IN, self._handle_accept)
+        self._accept_sid = GObject.io_add_watch(self.socket, GObject.IO_IN,
+                                                self._handle_accept)
+
+    def server_close(self):
+        """Stop accepting connections and close the listener socket"""
+        if self._accept_sid:
+            GObject.source_remove(self._accept_sid)
+            self._accept_sid = 0
+        SocketServer.TCPServer.server_close(self)
 
     def _handle_accept(self, source, condition):
         """Process incoming data on the server's socket by doing an accept()
@@ -81,33 +219,304 @@ class GlibTCPServer(SocketServer.TCPServer):
         # when done
         pass
 
+    def add_transfer(self, handler):
+        """Start sending the body of handler, or queue it"""
+        if len(self._transfers) < self.max_transfers:
+            self._transfers.add(handler)
+            handler.watch_writable()
+        else:
+            self._waiting.append(handler)
+
+    def remove_transfer(self, handler):
+        """Forget about handler, its body was sent or it failed"""
+        if handler in self._transfers:
+            self._transfers.remove(handler)
+        elif handler in self._waiting:
+            self._waiting.remove(handler)
+        if handler in self._ready:
+            self._ready.remove(handler)
+
+        while self._waiting and len(self._transfers) < self.max_transfers:
+            handler = self._waiting.popleft()
+            self._transfers.add(handler)
+            handler.watch_writable()
+
+    def set_writable(self, handler):
+        """Called by handler when its socket can be written to"""
+        self._ready.append(handler)
+        if not self._pump_sid:
+            self._pump_sid = GObject.idle_add(self.__pump_cb)
+
+    def __pump_cb(self):
+        # One chunk for each connection that was ready when the round
+        # started, the others get theirs in the next round
+        ready = self._ready
+        self._ready = collections.deque()
+        for handler in ready:
+            if handler in self._transfers:
+                handler.send_chunk()
+
+        if self._ready:
+            return True
+        self._pump_sid = 0
+        return False
+
+
+class _RequestReader(object):
+    """Buffered reader of the requests sent on a socket
+
+    Unlike the file object of socket.makefile(), it tells whether the
+    next request was pipelined and is buffered already.
+    """
+
+    def __init__(self, sock, bufsize=8192):
+        self._sock = sock
+        self._bufsize = bufsize
+        self._buffer = ''
+
+    def has_buffered_data(self):
+        return bool(self._buffer)
+
+    def _recv(self):
+        while True:
+            try:
+                return self._sock.recv(self._bufsize)
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def readline(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        end = self._buffer.find('\n')
+        while end < 0 and (size < 0 or length < size):
+            data = self._recv()
+            if not data:
+                break
+            index = data.find('\n')
+            if index >= 0:
+                end = length + index
+            chunks.append(data)
+            length += len(data)
+
+        data = ''.join(chunks)
+        if end >= 0:
+            end += 1
+        else:
+            end = length
+        if size >= 0:
+            end = min(end, size)
+        self._buffer = data[end:]
+        return data[:end]
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            data = self._recv()
+            if not data:
+                break
+            chunks.append(data)
+            length += len(data)
+
+        data = ''.join(chunks)
+        if size < 0:
+            size = length
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._buffer = ''
+
 
 class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     """RequestHandler class that integrates with Glib mainloop.  It writes
        the specified file to the client in chunks, returning control to the
        mainloop between chunks.
+
+       Regular files are sent with sendfile() on a non blocking socket,
+       the size of the chunks then follows the room left in the socket
+       buffer, between CHUNK_SIZE and MAX_CHUNK_SIZE.
+
+       HTTP/1.1 connections are kept open for the next requests, for up
+       to KEEP_ALIVE_TIMEOUT seconds.
+
+       Files up to CACHE_MAX_FILE_SIZE bytes are kept in memory, up to 64
+       of them for all the handlers of the process, and sent from there
+       on a non blocking socket too.
     """
 
     CHUNK_SIZE = 4096
+    MAX_CHUNK_SIZE = 4 * 1024 * 1024
+    USE_SENDFILE = True
+    KEEP_ALIVE_TIMEOUT = 15
+    CACHE_MAX_FILE_SIZE = 256 * 1024
+
+    protocol_version = 'HTTP/1.1'
 
     def __init__(self, request, client_address, server):
         self._file = None
         self._srcid = 0
+        self._timeout_sid = 0
+        self._send_cb = None
+        self._condition = 0
+        self._responded = False
+        # Body of self._file when it comes from _file_cache
+        self._body = None
+        self._status = None
+        self._length_sent = False
+        # Part of self._file to send, from send_head()
+        self._offset = 0
+        self._end = None
+        self._chunk_size = self.CHUNK_SIZE
         SimpleHTTPServer.SimpleHTTPRequestHandler.__init__(
             self, request, client_address, server)
 
     def log_request(self, code='-', size='-'):
         pass
 
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        self.rfile.close()
+        self.rfile = _RequestReader(self.connection)
+
+    def handle(self):
+        """Handle the first request, the next ones come from the mainloop"""
+        self._handle_request()
+
+    def _handle_request(self):
+        self.close_connection = 1
+        self._responded = False
+        self._status = None
+        self._length_sent = False
+        try:
+            self.handle_one_request()
+        except socket.error:
+            self.close_connection = 1
+            self._responded = False
+        if not self._responded:
+            # Nothing to read anymore, or a request that was not served
+            # by one of our do_ methods
+            self._cleanup()
+
+    def send_response(self, code, message=None):
+        self._status = code
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(
+            self, code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self._length_sent = True
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_header(
+            self, keyword, value)
+
     def do_GET(self):
         """Serve a GET request."""
+        self._responded = True
         self._file = self.send_head()
         if self._file:
-            self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
-                                               GObject.IO_ERR,
-                                               self._send_next_chunk)
+            self._send_cb = self._send_next_chunk
+            if self._body is not None and self._end is not None:
+                self.connection.setblocking(0)
+                self._send_cb = self._send_memory_chunk
+            elif self._can_sendfile(self._file):
+                self._chunk_size = 16 * self.CHUNK_SIZE
+                self.connection.setblocking(0)
+                self._send_cb = self._sendfile_next_chunk
+            self.server.add_transfer(self)
         else:
+            self._finish_response()
+
+    def do_HEAD(self):
+        """Serve a HEAD request."""
+        self._responded = True
+        f = self.send_head()
+        if f:
+            f.close()
+        self._finish_response()
+
+    def watch_writable(self):
+        self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
+                                           GObject.IO_ERR,
+                                           self.__writable_cb)
+
+    def __writable_cb(self, source, condition):
+        self._srcid = 0
+        self._condition = condition
+        self.server.set_writable(self)
+        return False
+
+    def send_chunk(self):
+        if self._send_cb(self.wfile, self._condition):
+            self.watch_writable()
+
+    def _can_sendfile(self, f):
+        if not self.USE_SENDFILE or _sendfile is None or self._end is None:
+            return False
+        try:
+            fileno = f.fileno()
+        except AttributeError:
+            # list_directory() returns a StringIO
+            return False
+        return stat.S_ISREG(os.fstat(fileno).st_mode)
+
+    def _sendfile_next_chunk(self, source, condition):
+        if condition & GObject.IO_ERR:
+            self._cleanup()
+            return False
+        if not (condition & GObject.IO_OUT):
+            self._cleanup()
+            return False
+
+        count = min(self._chunk_size, self._end - self._offset)
+        try:
+            sent = _sendfile(self.wfile.fileno(), self._file.fileno(),
+                             self._offset, count)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
             self._cleanup()
+            return False
+
+        self._offset += sent
+        if sent == 0 and count > 0:
+            # The file was truncated, the response cannot be completed
+            self._cleanup()
+            return False
+        if self._offset >= self._end:
+            self._finish_response()
+            return False
+
+        # A full chunk went through, there may be room for more next time
+        if sent == count:
+            self._chunk_size = min(self._chunk_size * 2, self.MAX_CHUNK_SIZE)
+        else:
+            self._chunk_size = max(sent, self.CHUNK_SIZE)
+        return True
+
+    def _send_memory_chunk(self, source, condition):
+        if condition & GObject.IO_ERR:
+            self._cleanup()
+            return False
+        if not (condition & GObject.IO_OUT):
+            self._cleanup()
+            return False
+
+        count = min(self._chunk_size, self._end - self._offset)
+        try:
+            sent = self.connection.send(buffer(self._body, self._offset,
+                                               count))
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            self._cleanup()
+            return False
+
+        self._offset += sent
+        if self._offset >= self._end:
+            self._finish_response()
+            return False
+        return True
 
     def _send_next_chunk(self, source, condition):
         if condition & GObject.IO_ERR:
@@ -116,24 +525,90 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if not (condition & GObject.IO_OUT):
             self._cleanup()
             return False
-        data = self._file.read(self.CHUNK_SIZE)
+        size = self._chunk_size
+        if self._end is not None:
+            size = min(size, self._end - self._offset)
+        data = self._file.read(size)
         count = os.write(self.wfile.fileno(), data)
-        if count != len(data) or len(data) != self.CHUNK_SIZE:
+        self._offset += count
+        if count != len(data):
+            self._cleanup()
+            return False
+        if self._offset == self._end or \
+                self._end is None and len(data) != size:
+            self._finish_response()
+            return False
+        if len(data) != size:
+            # The file was truncated, the response cannot be completed
             self._cleanup()
             return False
         return True
 
-    def _cleanup(self):
+    def _finish_response(self):
+        """The response was sent, wait for the next request if any"""
+        if self._status != 304 and \
+                (self._end is None or not self._length_sent):
+            # The client can only find the end of the body when the
+            # connection is closed
+            self.close_connection = 1
+        if self.close_connection:
+            self._cleanup()
+            return
+
+        self._close_file()
+        self.connection.setblocking(1)
+        self.wfile.flush()
+        if self.rfile.has_buffered_data():
+            # The next request was pipelined and is buffered already in
+            # rfile, the socket may not become readable again
+            self._srcid = GObject.idle_add(self.__next_request_cb)
+        else:
+            self._srcid = GObject.io_add_watch(
+                self.connection, GObject.IO_IN | GObject.IO_ERR |
+                GObject.IO_HUP, self.__next_request_cb)
+            self._timeout_sid = GObject.timeout_add_seconds(
+                self.KEEP_ALIVE_TIMEOUT, self.__keep_alive_timeout_cb)
+
+    def __next_request_cb(self, source=None, condition=0):
+        self._srcid = 0
+        if self._timeout_sid:
+            GObject.source_remove(self._timeout_sid)
+            self._timeout_sid = 0
+        if condition & GObject.IO_ERR:
+            self._cleanup()
+        else:
+            self._handle_request()
+        return False
+
+    def __keep_alive_timeout_cb(self):
+        self._timeout_sid = 0
+        self._cleanup()
+        return False
+
+    def _close_file(self):
         if self._file:
             self._file.close()
             self._file = None
+        self._body = None
         if self._srcid > 0:
             GObject.source_remove(self._srcid)
             self._srcid = 0
+        self._send_cb = None
+        self.server.remove_transfer(self)
+
+    def _cleanup(self):
+        self._close_file()
+        if self._timeout_sid:
+            GObject.source_remove(self._timeout_sid)
+            self._timeout_sid = 0
         if not self.wfile.closed:
-            self.wfile.flush()
+            try:
+                self.wfile.flush()
+            except socket.error:
+                pass
         self.wfile.close()
         self.rfile.close()
+        self.connection.close()
 
     def finish(self):
         """Close the sockets when we're done, not before"""
@@ -150,41 +625,149 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         None, in which case the caller has nothing further to do.
 
         ** [dcbw] modified to send Content-disposition filename too
+
+        Single byte ranges are honoured, with a 206 Partial Content
+        response, unless the If-Range header does not match the ETag.
+        If-None-Match and If-Modified-Since get a 304 Not Modified
+        response when the file did not change.
         """
+        self._offset = 0
+        self._end = None
+        self._body = None
+        self._chunk_size = self.CHUNK_SIZE
+
         path = self.translate_path(self.path)
-        if not path or not os.path.exists(path):
+        fs = self._stat(path)
+        if fs is None:
             self.send_error(404, 'File not found')
             return None
 
-        f = None
-        if os.path.isdir(path):
+        if stat.S_ISDIR(fs.st_mode):
             for index in 'index.html', 'index.htm':
                 index = os.path.join(path, index)
-                if os.path.exists(index):
+                fs = self._stat(index)
+                if fs is not None:
                     path = index
                     break
             else:
                 return self.list_directory(path)
         ctype = self.guess_type(path)
+
+        etag = _get_etag(fs)
+        last_modified = self.date_time_string(fs.st_mtime)
+        if self._is_not_modified(etag, fs.st_mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return None
+
         try:
-            # Always read in binary mode. Opening files in text mode may cause
-            # newline translations, making the actual size of the content
-            # transmitted *less* than the content-length!
-            f = open(path, 'rb')
+            f, fs = self._open(path, fs)
         except IOError:
             self.send_error(404, 'File not found')
             return None
-        self.send_response(200)
+        size = fs.st_size
+        etag = _get_etag(fs)
+        last_modified = self.date_time_string(fs.st_mtime)
+
+        byte_range = None
+        if 'Range' in self.headers:
+            if_range = self.headers.get('If-Range')
+            if if_range is None or if_range in (etag, last_modified):
+                try:
+                    byte_range = _parse_range(self.headers['Range'], size)
+                except ValueError:
+                    f.close()
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return None
+
+        if byte_range is None:
+            self._offset, self._end = 0, size
+            self.send_response(200)
+        else:
+            self._offset, self._end = byte_range
+            f.seek(self._offset)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (self._offset, self._end - 1, size))
         self.send_header('Content-type', ctype)
-        self.send_header('Content-Length', str(os.fstat(f.fileno())[6]))
+        self.send_header('Content-Length', str(self._end - self._offset))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
         self.send_header('Content-Disposition', 'attachment; filename="%s"' %
                          os.path.basename(path))
         self.end_headers()
         return f
 
+    def _stat(self, path):
+        if not path:
+            return None
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _is_not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # If-None-Match uses the weak comparison
+            tags = [_strip_weak(tag.strip())
+                    for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(mtime) <= email.utils.mktime_tz(date)
+        return False
+
+    def _open(self, path, fs):
+        """Return a file object for path and its stat result
+
+        The bodies of small files are served from memory.
+        """
+        key = _get_cache_key(path, fs)
+        if key in _file_cache:
+            self._body = _file_cache[key]
+            self._chunk_size = 16 * self.CHUNK_SIZE
+            return StringIO(self._body), fs
+
+        # Always read in binary mode. Opening files in text mode may cause
+        # newline translations, making the actual size of the content
+        # transmitted *less* than the content-length!
+        f = open(path, 'rb')
+        fs = os.fstat(f.fileno())
+        if not stat.S_ISREG(fs.st_mode) or \
+                fs.st_size > self.CACHE_MAX_FILE_SIZE:
+            return f, fs
+
+        body = f.read()
+        if len(body) != fs.st_size:
+            # Modified while we were reading it, do not cache it
+            f.seek(0)
+            return f, os.fstat(f.fileno())
+        f.close()
+
+        _file_cache[_get_cache_key(path, fs)] = body
+        self._body = body
+        self._chunk_size = 16 * self.CHUNK_SIZE
+        return StringIO(body), fs
+
 
 class GlibURLDownloader(GObject.GObject):
-    """Grabs a URL in chunks, returning to the mainloop after each chunk"""
+    """Grabs a URL in worker threads, the signals are emitted in the mainloop
+
+    Connecting and reading never block the mainloop. When the server
+    supports byte ranges, files bigger than 2 * MIN_SEGMENT_SIZE are split
+    in up to SEGMENTS ranges downloaded in parallel. progress is emitted
+    at most every PROGRESS_INTERVAL ms.
+    """
 
     __gsignals__ = {
         'finished': (GObject.SignalFlags.RUN_FIRST, None,
@@ -195,10 +778,14 @@ class GlibURLDownloader(GObject.GObject):
                      ([GObject.TYPE_PYOBJECT])),
     }
 
-    CHUNK_SIZE = 4096
+    CHUNK_SIZE = 64 * 1024
+    SEGMENTS = 4
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    PROGRESS_INTERVAL = 100
 
-    def __init__(self, url, destdir=None):
+    def __init__(self, url, destdir=None, connection_pool=None):
         self._url = url
+        self._connection_pool = connection_pool
         if not destdir:
             destdir = tempfile.gettempdir()
         self._destdir = destdir
@@ -206,29 +793,55 @@ class GlibURLDownloader(GObject.GObject):
         self._fname = None
         self._outf = None
         self._suggested_fname = None
-        self._info = None
         self._written = 0
+        self._reported = None
+        self._total = None
+        self._etag = None
+        self._keep_partial = False
+        self._has_destfile = False
+
+        # Protects the writes to self._outf, self._written and the state
+        # of the worker threads
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._running = 0
+        self._error = None
         GObject.GObject.__init__(self)
 
-    def start(self, destfile=None, destfd=None):
-        self._info = urllib.urlopen(self._url)
-        self._outf = None
-        self._fname = None
+    def start(self, destfile=None, destfd=None, resume=False, etag=None):
+        """Start the download
+
+        destfile -- path of the file to download to, a temporary file is
+            created if None
+        destfd -- file descriptor of destfile, if it is already open
+        resume -- if destfile already holds the beginning of the download,
+            only ask the server for the rest and append it. The partial
+            file is kept if the download fails.
+        etag -- ETag of the file being resumed, see get_etag(). If the
+            file changed on the server since, it is downloaded again from
+            the start.
+        """
         if destfd and not destfile:
             raise ValueError('Must provide destination file too when'
                              ' specifying file descriptor')
+
+        offset = 0
         if destfile:
+            self._has_destfile = True
             self._suggested_fname = os.path.basename(destfile)
             self._fname = os.path.abspath(os.path.expanduser(destfile))
             if destfd:
                 # Use the user-supplied destination file descriptor
                 self._outf = destfd
             else:
-                self._outf = os.open(self._fname, os.O_RDWR |
-                                     os.O_TRUNC | os.O_CREAT, 0644)
+                self._outf = os.open(self._fname, os.O_RDWR | os.O_CREAT,
+                                     0644)
+                if not resume:
+                    os.ftruncate(self._outf, 0)
+            if resume:
+                self._keep_partial = True
+                offset = os.fstat(self._outf).st_size
         else:
-            fname = self._get_filename_from_headers(self._info.headers)
-            self._suggested_fname = fname
             garbage_, path = urllib.splittype(self._url)
             garbage_, path = urllib.splithost(path or "")
             path, garbage_ = urllib.splitquery(path or "")
@@ -237,16 +850,27 @@ class GlibURLDownloader(GObject.GObject):
             (self._outf, self._fname) = tempfile.mkstemp(suffix=suffix,
                                                          dir=self._destdir)
 
-        fcntl.fcntl(self._info.fp.fileno(), fcntl.F_SETFD, os.O_NDELAY)
-        self._srcid = GObject.io_add_watch(self._info.fp.fileno(),
-                                           GObject.IO_IN | GObject.IO_ERR,
-                                           self._read_next_chunk)
+        self._written = offset
+        self._srcid = GObject.timeout_add(self.PROGRESS_INTERVAL,
+                                          self.__progress_cb)
+        self._start_worker(self._download, offset, etag)
 
     def cancel(self):
         if self._srcid == 0:
             raise RuntimeError('Download already canceled or stopped')
         self.cleanup(remove=True)
 
+    def get_etag(self):
+        """ETag of the file, to resume the download later
+
+        Known once the server answered, None before or if it sent none.
+        """
+        return self._etag
+
+    def get_total_size(self):
+        """Size of the whole file, or None if the server did not tell"""
+        return self._total
+
     def _get_filename_from_headers(self, headers):
         if 'Content-Disposition' not in headers:
             return None
@@ -263,46 +887,463 @@ class GlibURLDownloader(GObject.GObject):
             fname = fname[:len(fname) - 1]
         return fname
 
-    def _read_next_chunk(self, source, condition):
-        if condition & GObject.IO_ERR:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file.')
-            return False
-        elif not (condition & GObject.IO_IN):
-            # shouldn't get here, but...
-            return True
+    def _get_content_length(self, headers):
+        length = headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            return None
+        return int(length)
 
+    def _start_worker(self, function, *args):
+        with self._lock:
+            self._running += 1
+        # Otherwise, with older PyGObject, the thread doesn't run while
+        # the main loop is idle
+        GObject.threads_init()
+        thread = threading.Thread(target=self._run_worker,
+                                  args=(function, ) + args)
+        thread.daemon = True
+        thread.start()
+
+    def _run_worker(self, function, *args):
         try:
-            data = self._info.fp.read(self.CHUNK_SIZE)
-            count = os.write(self._outf, data)
-            self._written += len(data)
+            function(*args)
+        except Exception, err:
+            with self._lock:
+                if self._error is None and not self._cancelled.is_set():
+                    self._error = 'Error downloading file: %r' % err
+            self._cancelled.set()
+
+        with self._lock:
+            self._running -= 1
+            done = self._running == 0
+        if done:
+            GObject.idle_add(self.__done_cb)
+
+    def _urlopen(self, headers):
+        scheme = urlparse.urlsplit(self._url).scheme
+        if self._connection_pool is None or scheme not in ('http', 'https'):
+            return urllib2.urlopen(urllib2.Request(self._url, headers=headers))
+        return self._connection_pool.urlopen(self._url, headers)
+
+    def _open(self, offset, etag):
+        """Ask for the bytes of the file from offset on
+
+        Returns the response, None if the file is already complete, and
+        the offset the response starts at, 0 if the server sends the whole
+        file.
+        """
+        headers = {}
+        if offset or self.SEGMENTS > 1:
+            # Also tells whether the server supports ranges
+            headers['Range'] = 'bytes=%d-' % offset
+            if etag is not None:
+                headers['If-Range'] = etag
+        try:
+            response = self._urlopen(headers)
+        except urllib2.HTTPError, e:
+            if e.code != 416:
+                raise
+            content_range = e.info().get('Content-Range')
+            if content_range is not None and \
+                    _parse_content_range(content_range)[2] == offset:
+                self._total = offset
+                return None, offset
+            # The partial file does not match what the server has
+            response = self._urlopen({})
+
+        if response.getcode() != 206:
+            # Ranges not supported, or the file changed
+            self._total = self._get_content_length(response.info())
+            return response, 0
 
-            # error writing data to file?
-            if count < len(data):
-                self.cleanup(remove=True)
-                self.emit('error', 'Error writing to download file.')
-                return False
+        start, end_, total = _parse_content_range(
+            response.info()['Content-Range'])
+        if start != offset:
+            raise IOError('Server sent the range from %d, not %d' %
+                          (start, offset))
+        self._total = total
+        return response, offset
 
+    def _download(self, offset, etag):
+        response, offset = self._open(offset, etag)
+        if response is None:
+            return
+
+        headers = response.info()
+        self._etag = headers.get('ETag')
+        if not self._has_destfile:
+            self._suggested_fname = self._get_filename_from_headers(headers)
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            if self._keep_partial:
+                os.ftruncate(self._outf, offset)
+            self._written = offset
+
+        end = self._total
+        if response.getcode() == 206 and end is not None:
+            segments = self._split(offset, end)
+            end = segments[0][1]
+            for start, segment_end in segments[1:]:
+                self._start_worker(self._download_segment, start,
+                                   segment_end)
+        self._read(response, offset, end)
+
+    def _split(self, start, end):
+        count = min(self.SEGMENTS, (end - start) / self.MIN_SEGMENT_SIZE)
+        count = max(count, 1)
+        size = (end - start) / count
+        bounds = [start + i * size for i in range(count)] + [end]
+        return zip(bounds[:-1], bounds[1:])
+
+    def _download_segment(self, start, end):
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        if self._etag is not None:
+            headers['If-Range'] = self._etag
+        response = self._urlopen(headers)
+        if response.getcode() != 206:
+            raise IOError('Server did not send the range %d-%d' %
+                          (start, end - 1))
+        self._read(response, start, end)
+
+    def _read(self, response, position, end):
+        """Copy the body of response to the file, from position on"""
+        try:
+            while not self._cancelled.is_set():
+                size = self.CHUNK_SIZE
+                if end is not None:
+                    size = min(size, end - position)
+                    if size == 0:
+                        break
+                data = response.read(size)
+                if not data:
+                    break
+                self._write(position, data)
+                position += len(data)
+        finally:
+            response.close()
+
+        if end is not None and position != end and \
+                not self._cancelled.is_set():
+            raise IOError('Download interrupted at %d of %d bytes' %
+                          (position, end))
+
+    def _write(self, position, data):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            os.lseek(self._outf, position, os.SEEK_SET)
+            while data:
+                count = os.write(self._outf, data)
+                data = data[count:]
+                position += count
+                self._written += count
+
+    def __progress_cb(self):
+        if self._written != self._reported:
+            self._reported = self._written
             self.emit('progress', self._written)
+        return True
 
-            # done?
-            if len(data) < self.CHUNK_SIZE:
-                self.cleanup()
-                self.emit('finished', self._fname, self._suggested_fname)
-                return False
-        except Exception, err:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file: %r' % err)
+    def __done_cb(self):
+        if self._srcid == 0:
+            # Cancelled
             return False
-        return True
+
+        self.__progress_cb()
+        if self._error is not None:
+            self.cleanup(remove=not self._keep_partial)
+            self.emit('error', self._error)
+        else:
+            self.cleanup()
+            self.emit('finished', self._fname, self._suggested_fname)
+        return False
 
     def cleanup(self, remove=False):
+        self._cancelled.set()
         if self._srcid > 0:
             GObject.source_remove(self._srcid)
             self._srcid = 0
-        del self._info
-        self._info = None
-        os.close(self._outf)
+        with self._lock:
+            if self._outf is not None:
+                os.close(self._outf)
+                self._outf = None
         if remove:
             os.remove(self._fname)
-        self._outf = None
+
+
+class _PooledResponse(object):
+    """Response of a pooled connection, with the interface of urllib2's"""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def getcode(self):
+        return self._response.status
+
+    def info(self):
+        return self._response.msg
+
+    def read(self, size=None):
+        return self._response.read(size)
+
+    def close(self):
+        if self._connection is None:
+            return
+        # The connection can only be reused once the body was read
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+
+class ConnectionPool(object):
+    """Keeps HTTP connections open to reuse them for the next requests
+
+    max_idle_per_host -- number of idle connections kept per host
+    timeout -- socket timeout of the connections, in seconds
+
+    The pool can be used from several threads.
+    """
+
+    def __init__(self, max_idle_per_host=4, timeout=60):
+        self._max_idle_per_host = max_idle_per_host
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (connection, reused) for the (scheme, netloc) key"""
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop(), True
+
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc,
+                                           timeout=self._timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self._timeout), False
+
+    def put(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self._max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def urlopen(self, url, headers):
+        """GET url on a pooled connection
+
+        Returns a response with the getcode(), info(), read() and close()
+        methods of urllib2 responses, and raises urllib2.HTTPError for
+        error statuses. Redirections are followed by urllib2.
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            connection, reused = self.get(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # The server may have closed an idle connection
+                if reused:
+                    continue
+                raise
+            break
+
+        pooled_response = _PooledResponse(self, key, connection, response)
+        if response.status in (301, 302, 303, 307):
+            response.read()
+            pooled_response.close()
+            request = urllib2.Request(url, headers=headers)
+            return urllib2.urlopen(request)
+        if response.status >= 400:
+            response.read()
+            pooled_response.close()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        return pooled_response
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class DownloadManager(GObject.GObject):
+    """Runs queued downloads with bounded concurrency, by priority
+
+    max_transfers -- number of downloads running at once
+    max_per_host -- number of downloads running at once per host
+    segments -- number of parallel segments of each download, see
+        GlibURLDownloader.SEGMENTS
+
+    The downloads share keep-alive HTTP connections. progress is emitted
+    with the bytes written and the sizes known so far of all the downloads
+    added since the queue was last empty, drained when it becomes empty.
+    """
+
+    __gsignals__ = {
+        'progress': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT])),
+        'drained': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+    }
+
+    def __init__(self, max_transfers=4, max_per_host=2, segments=1,
+                 destdir=None):
+        GObject.GObject.__init__(self)
+        self._max_transfers = max_transfers
+        self._max_per_host = max_per_host
+        self._segments = segments
+        self._destdir = destdir
+        self._connection_pool = ConnectionPool(max_idle_per_host=max_per_host)
+
+        # Heaps of (-priority, sequence, downloader) per host
+        self._queues = {}
+        self._sequence = 0
+        self._queued = {}
+        self._running = {}
+        self._per_host = {}
+        self._written = {}
+        self._totals = {}
+        self._finished_bytes = 0
+        self._finished_total = 0
+        self._busy = False
+
+    def add(self, url, destfile=None, priority=0, resume=False, etag=None):
+        """Queue the download of url, higher priorities start first
+
+        Returns the GlibURLDownloader, not started yet, to connect to its
+        signals. See GlibURLDownloader.start() for the other parameters.
+        """
+        downloader = GlibURLDownloader(url, self._destdir,
+                                       self._connection_pool)
+        downloader.SEGMENTS = self._segments
+        downloader.connect('progress', self.__progress_cb)
+        downloader.connect('finished', self.__finished_cb)
+        downloader.connect('error', self.__error_cb)
+
+        host = urlparse.urlsplit(url).netloc
+        self._busy = True
+        self._queued[downloader] = (host, destfile, resume, etag)
+        heapq.heappush(self._queues.setdefault(host, []),
+                       (-priority, self._sequence, downloader))
+        self._sequence += 1
+        self._schedule()
+        return downloader
+
+    def cancel(self, downloader):
+        """Remove a queued download, or stop a running one"""
+        if downloader in self._queued:
+            # Left in the heap of its host, skipped by _pop_next()
+            del self._queued[downloader]
+        elif downloader in self._running:
+            downloader.cancel()
+            self._release(downloader)
+        self._schedule()
+
+    def get_pending(self):
+        """Number of downloads queued or running"""
+        return len(self._queued) + len(self._running)
+
+    def close(self):
+        """Cancel all the downloads and close the idle connections"""
+        # Empty the queue first, cancelling a running download would
+        # start the next queued one otherwise
+        self._queued = {}
+        self._queues = {}
+        for downloader in self._running.keys():
+            self.cancel(downloader)
+        self._schedule()
+        self._connection_pool.close()
+
+    def _schedule(self):
+        while len(self._running) < self._max_transfers:
+            downloader = self._pop_next()
+            if downloader is None:
+                break
+            self._start(downloader)
+
+        if not self._queued and not self._running:
+            self._queues = {}
+            if self._busy:
+                self._busy = False
+                self._written = {}
+                self._totals = {}
+                self._finished_bytes = 0
+                self._finished_total = 0
+                self.emit('drained')
+
+    def _pop_next(self):
+        """Pop the first queued download of the hosts below max_per_host"""
+        best = None
+        for host, queue in self._queues.items():
+            while queue and queue[0][2] not in self._queued:
+                # Cancelled
+                heapq.heappop(queue)
+            if not queue:
+                del self._queues[host]
+                continue
+            if self._per_host.get(host, 0) >= self._max_per_host:
+                continue
+            if best is None or queue[0] < self._queues[best][0]:
+                best = host
+
+        if best is None:
+            return None
+        return heapq.heappop(self._queues[best])[2]
+
+    def _start(self, downloader):
+        host, destfile, resume, etag = self._queued.pop(downloader)
+        self._running[downloader] = host
+        self._per_host[host] = self._per_host.get(host, 0) + 1
+        self._written[downloader] = 0
+        try:
+            downloader.start(destfile, resume=resume, etag=etag)
+        except (IOError, OSError), err:
+            self._release(downloader)
+            downloader.emit('error', 'Error downloading file: %r' % err)
+
+    def _release(self, downloader):
+        host = self._running.pop(downloader)
+        self._per_host[host] -= 1
+        if not self._per_host[host]:
+            del self._per_host[host]
+
+        self._finished_bytes += self._written.pop(downloader, 0)
+        self._finished_total += self._totals.pop(downloader, 0)
+
+    def __progress_cb(self, downloader, written):
+        self._written[downloader] = written
+        total = downloader.get_total_size()
+        if total is not None:
+            self._totals[downloader] = total
+        self.emit('progress',
+                  self._finished_bytes + sum(self._written.values()),
+                  self._finished_total + sum(self._totals.values()))
+
+    def __finished_cb(self, downloader, path, suggested_name):
+        if downloader in self._running:
+            self._release(downloader)
+            self._schedule()
+
+    def __error_cb(self, downloader, error):
+        if downloader in self._running:
+            self._release(downloader)
+            self._schedule()
@@ -35,11 +35,12 @@ from telepathy.interfaces import CHANNEL, \
     CONNECTION, \
     PROPERTIES_INTERFACE
 from telepathy.constants import CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES, \
+    CONNECTION_STATUS_DISCONNECTED, \
     HANDLE_TYPE_ROOM, \
     HANDLE_TYPE_CONTACT, \
     PROPERTY_FLAG_WRITE
 
-from sugar3.presence.buddy import Buddy
+from sugar3.presence.buddy import get_buddy
 
 CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
 CONN_INTERFACE_BUDDY_INFO = 'org.laptop.Telepathy.BuddyInfo'
@@ -306,19 +307,44 @@ class Activity(GObject.GObject):
         self._resolve_handles(members, reply_cb=self._add_initial_buddies)
 
     def _resolve_handles(self, input_handles, reply_cb):
-        def get_handle_owners_cb(handles):
+        cache = _get_handle_cache(self.telepathy_conn)
+        channel_path = self.telepathy_text_chan.object_path
+
+        def inspect_handles_cb(owners, handles, contact_ids):
+            cache.add_contact_ids(handles, contact_ids)
+            reply_cb([cache.get_contact_id(owner) for owner in owners])
+
+        def get_handle_owners_cb(owners):
+            handles = [owner for owner in set(owners)
+                       if cache.get_contact_id(owner) is None]
+            if not handles:
+                reply_cb([cache.get_contact_id(owner) for owner in owners])
+                return
+
             self.telepathy_conn.InspectHandles(
                 HANDLE_TYPE_CONTACT, handles,
-                reply_handler=reply_cb,
+                reply_handler=partial(inspect_handles_cb, owners, handles),
                 error_handler=self.__error_handler_cb,
                 dbus_interface=CONNECTION)
 
+        def got_handle_owners_cb(handles, owners):
+            cache.add_owners(channel_path, handles, owners)
+            get_handle_owners_cb([cache.get_owner(channel_path, handle)
+                                  for handle in input_handles])
+
         if self._text_channel_group_flags & \
                 CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES:
 
+            handles = [handle for handle in set(input_handles)
+                       if cache.get_owner(channel_path, handle) is None]
+            if not handles:
+                got_handle_owners_cb([], [])
+                return
+
             group = self.telepathy_text_chan[CHANNEL_INTERFACE_GROUP]
-            group.GetHandleOwners(input_handles,
-                                  reply_handler=get_handle_owners_cb,
+            group.GetHandleOwners(handles,
+                                  reply_handler=partial(got_handle_owners_cb,
+                                                        handles),
                                   error_handler=self.__error_handler_cb)
         else:
             get_handle_owners_cb(input_handles)
@@ -350,8 +376,8 @@ class Activity(GObject.GObject):
 
     def _add_buddies(self, contact_ids):
         for contact_id in contact_ids:
+            buddy = self._get_buddy(contact_id)
             if contact_id not in self._buddies:
-                buddy = self._get_buddy(contact_id)
                 self.emit('buddy-joined', buddy)
                 self._buddies[contact_id] = buddy
             if contact_id not in self._joined_buddies:
@@ -359,16 +385,15 @@ class Activity(GObject.GObject):
 
     def _remove_buddies(self, contact_ids):
         for contact_id in contact_ids:
-            if contact_id in self._buddies:
-                buddy = self._get_buddy(contact_id)
+            buddy = self._buddies.pop(contact_id, None)
+            if buddy is not None:
                 self.emit('buddy-left', buddy)
-                del self._buddies[contact_id]
 
     def _get_buddy(self, contact_id):
         if contact_id in self._buddies:
             return self._buddies[contact_id]
         else:
-            return Buddy(self._account_path, contact_id)
+            return get_buddy(self._account_path, contact_id)
 
     def join(self):
         """Join this activity.
@@ -465,6 +490,9 @@ class Activity(GObject.GObject):
 
     # Leaving
     def __text_channel_closed_cb(self):
+        # Its channel specific handles may be reused once it's gone
+        _get_handle_cache(self.telepathy_conn).clear_channel(
+            self.telepathy_text_chan.object_path)
         self._joined = False
         self.emit('joined', False, 'left activity')
 
@@ -474,6 +502,58 @@ class Activity(GObject.GObject):
         self.telepathy_text_chan.Close()
 
 
+class _HandleCache(object):
+    """Remembers the contact ids of the handles resolved on a connection
+
+    Channel specific handles are mapped to their owner handle, and owner
+    handles to the contact id.
+    """
+
+    def __init__(self):
+        self._owners = {}
+        self._contact_ids = {}
+
+    def get_owner(self, channel_path, handle):
+        return self._owners.get((channel_path, handle))
+
+    def add_owners(self, channel_path, handles, owners):
+        for handle, owner in zip(handles, owners):
+            self._owners[(channel_path, handle)] = owner
+
+    def get_contact_id(self, handle):
+        return self._contact_ids.get(handle)
+
+    def add_contact_ids(self, handles, contact_ids):
+        for handle, contact_id in zip(handles, contact_ids):
+            self._contact_ids[handle] = contact_id
+
+    def clear_channel(self, channel_path):
+        """Forget the channel specific handles of a closed channel"""
+        for key in self._owners.keys():
+            if key[0] == channel_path:
+                del self._owners[key]
+
+
+_handle_caches = {}
+
+
+def _get_handle_cache(connection):
+    object_path = connection.object_path
+    if object_path not in _handle_caches:
+        def status_changed_cb(status, reason):
+            # The connection manager keeps the object path when it
+            # reconnects, but not the handles
+            if status == CONNECTION_STATUS_DISCONNECTED:
+                match.remove()
+                _handle_caches.pop(object_path, None)
+
+        match = connection.connect_to_signal('StatusChanged',
+                                             status_changed_cb,
+                                             dbus_interface=CONNECTION)
+        _handle_caches[object_path] = _HandleCache()
+    return _handle_caches[object_path]
+
+
 class _BaseCommand(GObject.GObject):
     __gsignals__ = {
         'finished': (GObject.SignalFlags.RUN_FIRST, None,
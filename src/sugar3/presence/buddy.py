@@ -22,14 +22,18 @@ STABLE.
 """
 
 import logging
+import weakref
+from functools import partial
 
 from gi.repository import GObject
+from gi.repository import GLib
 import dbus
 from gi.repository import GConf
 from telepathy.interfaces import CONNECTION, \
     CONNECTION_INTERFACE_ALIASING, \
     CONNECTION_INTERFACE_CONTACTS
-from telepathy.constants import HANDLE_TYPE_CONTACT
+from telepathy.constants import CONNECTION_STATUS_DISCONNECTED, \
+    HANDLE_TYPE_CONTACT
 
 from sugar3.presence.connectionmanager import get_connection_manager
 
@@ -151,51 +155,64 @@ class Buddy(BaseBuddy):
 
         self._account_path = account_path
         self.contact_id = contact_id
-        self.contact_handle = None
+        self._contact_handle = None
+        self._request_handles_call = None
+        self._get_properties_call = None
+        self._get_attributes_call = None
 
         connection_manager = get_connection_manager()
         connection = connection_manager.get_connection(account_path)
 
-        connection_name = connection.object_path.replace('/', '.')[1:]
+        # The handle and the attributes are requested together with the
+        # ones of the other buddies created in this main loop iteration
+        self._batch = _get_contacts_batch(connection)
+        self._batch.add(self)
 
-        bus = dbus.SessionBus()
-        obj = bus.get_object(connection_name, connection.object_path)
-        handles = obj.RequestHandles(HANDLE_TYPE_CONTACT, [self.contact_id],
-                                     dbus_interface=CONNECTION)
-        self.contact_handle = handles[0]
+    def get_contact_handle(self):
+        if self._contact_handle is None:
+            _logger.debug('%r: Blocking on RequestHandles() because '
+                          'someone wants the contact handle', self)
+            if self._request_handles_call is None:
+                self._batch.flush()
+            if self._request_handles_call is not None:
+                self._request_handles_call.block()
+        return self._contact_handle
+
+    contact_handle = property(get_contact_handle)
+
+    def _set_contact_handle(self, handle, connection_name, object_path):
+        self._request_handles_call = None
+        self._contact_handle = handle
 
+        bus = dbus.SessionBus()
         self._get_properties_call = bus.call_async(
             connection_name,
-            connection.object_path,
+            object_path,
             CONN_INTERFACE_BUDDY_INFO,
             'GetProperties',
             'u',
-            (self.contact_handle,),
+            (self._contact_handle,),
             reply_handler=self.__got_properties_cb,
             error_handler=self.__error_handler_cb,
             utf8_strings=True,
             byte_arrays=True)
 
-        self._get_attributes_call = bus.call_async(
-            connection_name,
-            connection.object_path,
-            CONNECTION_INTERFACE_CONTACTS,
-            'GetContactAttributes',
-            'auasb',
-            ([self.contact_handle], [CONNECTION_INTERFACE_ALIASING],
-             False),
-            reply_handler=self.__got_attributes_cb,
-            error_handler=self.__error_handler_cb)
-
     def __got_properties_cb(self, properties):
         _logger.debug('__got_properties_cb %r', properties)
         self._get_properties_call = None
         self._update_properties(properties)
 
-    def __got_attributes_cb(self, attributes):
-        _logger.debug('__got_attributes_cb %r', attributes)
+    def _got_attributes(self, attributes):
+        _logger.debug('_got_attributes %r', attributes)
         self._get_attributes_call = None
-        self._update_attributes(attributes[self.contact_handle])
+        self._update_attributes(attributes)
+
+    def _request_failed(self):
+        self._request_handles_call = None
+        self._get_attributes_call = None
+        if self._contact_handle is None:
+            # Asked for again by the next get_contact_handle() call
+            self._batch.requeue(self)
 
     def __error_handler_cb(self, error):
         _logger.debug('__error_handler_cb %r', error)
@@ -224,6 +241,9 @@ class Buddy(BaseBuddy):
             self.props.nick = attributes[nick_key]
 
     def do_get_property(self, pspec):
+        if self._contact_handle is None:
+            self.get_contact_handle()
+
         if pspec.name == 'nick' and self._get_attributes_call is not None:
             _logger.debug('%r: Blocking on GetContactAttributes() because '
                           'someone wants property nick', self)
@@ -236,6 +256,125 @@ class Buddy(BaseBuddy):
         return BaseBuddy.do_get_property(self, pspec)
 
 
+class _ContactsBatch(object):
+    """Requests the handles and the attributes of several buddies of one
+    connection at once
+
+    The buddies added during a main loop iteration get their handles from
+    a single RequestHandles() call, and their aliases from a single
+    GetContactAttributes() call.
+    """
+
+    def __init__(self, object_path):
+        self._object_path = object_path
+        self._connection_name = object_path.replace('/', '.')[1:]
+        self._pending = []
+        self._flush_sid = None
+
+    def add(self, buddy):
+        self._pending.append(buddy)
+        if self._flush_sid is None:
+            self._flush_sid = GLib.idle_add(self.__flush_cb)
+
+    def requeue(self, buddy):
+        """Add buddy back after a failed request, without retrying yet"""
+        if buddy not in self._pending:
+            self._pending.append(buddy)
+
+    def __flush_cb(self):
+        self._flush_sid = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Send the requests for the buddies added so far"""
+        if self._flush_sid is not None:
+            GLib.source_remove(self._flush_sid)
+            self._flush_sid = None
+
+        if not self._pending:
+            return
+        buddies = self._pending
+        self._pending = []
+
+        _logger.debug('Requesting handles of %d contacts', len(buddies))
+        bus = dbus.SessionBus()
+        call = bus.call_async(
+            self._connection_name,
+            self._object_path,
+            CONNECTION,
+            'RequestHandles',
+            'uas',
+            (HANDLE_TYPE_CONTACT,
+             [buddy.contact_id for buddy in buddies]),
+            reply_handler=partial(self.__got_handles_cb, buddies),
+            error_handler=partial(self.__error_handler_cb, buddies))
+        for buddy in buddies:
+            buddy._request_handles_call = call
+
+    def __got_handles_cb(self, buddies, handles):
+        for buddy, handle in zip(buddies, handles):
+            buddy._set_contact_handle(handle, self._connection_name,
+                                      self._object_path)
+
+        bus = dbus.SessionBus()
+        call = bus.call_async(
+            self._connection_name,
+            self._object_path,
+            CONNECTION_INTERFACE_CONTACTS,
+            'GetContactAttributes',
+            'auasb',
+            (handles, [CONNECTION_INTERFACE_ALIASING], False),
+            reply_handler=partial(self.__got_attributes_cb, buddies),
+            error_handler=partial(self.__error_handler_cb, buddies))
+        for buddy in buddies:
+            buddy._get_attributes_call = call
+
+    def __got_attributes_cb(self, buddies, attributes):
+        for buddy in buddies:
+            buddy._got_attributes(attributes.get(buddy.contact_handle, {}))
+
+    def __error_handler_cb(self, buddies, error):
+        _logger.debug('__error_handler_cb %r', error)
+        for buddy in buddies:
+            buddy._request_failed()
+
+
+_contacts_batches = {}
+
+# Buddies alive in this process, so that each contact has only one Buddy
+_buddies = weakref.WeakValueDictionary()
+
+
+def get_buddy(account_path, contact_id):
+    """Return the Buddy for contact_id on the account at account_path
+
+    The same object is returned as long as it is referenced somewhere in
+    the process.
+    """
+    key = (account_path, contact_id)
+    buddy = _buddies.get(key)
+    if buddy is None:
+        buddy = Buddy(account_path, contact_id)
+        _buddies[key] = buddy
+    return buddy
+
+
+def _get_contacts_batch(connection):
+    object_path = connection.object_path
+    if object_path not in _contacts_batches:
+        def status_changed_cb(status, reason):
+            if status == CONNECTION_STATUS_DISCONNECTED:
+                match.remove()
+                _contacts_batches.pop(object_path, None)
+
+        match = connection.connect_to_signal('StatusChanged',
+                                             status_changed_cb,
+                                             dbus_interface=CONNECTION)
+        _contacts_batches[object_path] = _ContactsBatch(object_path)
+    return _contacts_batches[object_path]
+
+
 class Owner(BaseBuddy):
 
     __gtype_name__ = 'PresenceOwner'
@@ -21,13 +21,15 @@ STABLE.
 """
 
 import logging
+from functools import partial
 
 from gi.repository import GObject
+from gi.repository import GLib
 import dbus
 import dbus.exceptions
 from dbus import PROPERTIES_IFACE
 
-from sugar3.presence.buddy import Buddy, Owner
+from sugar3.presence.buddy import Owner, get_buddy
 from sugar3.presence.activity import Activity
 from sugar3.presence.connectionmanager import get_connection_manager
 
@@ -44,6 +46,9 @@ ACCOUNT_MANAGER_PATH = '/org/freedesktop/Telepathy/AccountManager'
 
 CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
 
+# Time after which asynchronous lookups give up, in seconds
+LOOKUP_TIMEOUT = 10
+
 
 class PresenceService(GObject.GObject):
     """Provides simplified access to the Telepathy framework to activities"""
@@ -59,7 +64,6 @@ class PresenceService(GObject.GObject):
         GObject.GObject.__init__(self)
 
         self._activity_cache = None
-        self._buddy_cache = {}
 
     def get_activity(self, activity_id, warn_if_none=True):
         """Retrieve single Activity object for the given unique id
@@ -101,6 +105,62 @@ class PresenceService(GObject.GObject):
 
         return None
 
+    def get_activity_async(self, activity_id, reply_handler,
+                           error_handler=None, timeout=LOOKUP_TIMEOUT):
+        """Asynchronously retrieve the Activity object for the given id
+
+        activity_id -- unique ID for the activity
+        reply_handler -- called with the Activity object, or None if no
+            connected account knows about the activity
+        error_handler -- called with the exception if every account failed
+            with an unexpected error, or if the lookup timed out
+        timeout -- time after which the lookup gives up, in seconds
+
+        GetActivity is called on all the connected accounts at once and
+        the first one that finds the activity wins, the calls still
+        pending are then cancelled.
+
+        The handlers are always called from the main loop, never before
+        this method returns. Returns an object whose cancel() method aborts
+        the lookup.
+        """
+        if self._activity_cache is not None:
+            if self._activity_cache.props.id != activity_id:
+                raise RuntimeError('Activities can only access their own'
+                                   ' shared instance')
+            lookup = _Lookup(reply_handler, error_handler, timeout)
+            lookup.finish_later(self._activity_cache)
+            return lookup
+
+        connection_manager = get_connection_manager()
+        connections_per_account = \
+            connection_manager.get_connections_per_account()
+        connections = [(account_path, connection.connection)
+                       for account_path, connection
+                       in connections_per_account.items()
+                       if connection.connected]
+        if not connections:
+            lookup = _Lookup(reply_handler, error_handler, timeout)
+            lookup.finish_later(None)
+            return lookup
+
+        lookup = _ActivityLookup(activity_id, self.__activity_found_cb,
+                                 reply_handler, error_handler, timeout)
+        for account_path, connection in connections:
+            logging.debug('Calling GetActivity on %s', account_path)
+            lookup.call(connection.requested_bus_name, connection.object_path,
+                        CONN_INTERFACE_ACTIVITY_PROPERTIES, 'GetActivity',
+                        's', (activity_id,),
+                        partial(lookup.got_room_handle, account_path,
+                                connection))
+        return lookup
+
+    def __activity_found_cb(self, account_path, connection, room_handle):
+        if self._activity_cache is None:
+            self._activity_cache = Activity(account_path, connection,
+                                            room_handle=room_handle)
+        return self._activity_cache
+
     def get_activity_by_handle(self, connection_path, room_handle):
         if self._activity_cache is not None:
             if self._activity_cache.room_handle != room_handle:
@@ -120,13 +180,39 @@ class PresenceService(GObject.GObject):
             self._activity_cache = activity
             return activity
 
-    def get_buddy(self, account_path, contact_id):
-        if (account_path, contact_id) in self._buddy_cache:
-            return self._buddy_cache[(account_path, contact_id)]
+    def get_activity_by_handle_async(self, connection_path, room_handle,
+                                     reply_handler, error_handler=None,
+                                     timeout=LOOKUP_TIMEOUT):
+        """Asynchronous version of get_activity_by_handle()
+
+        The proxy of the connection is taken from the connection manager,
+        so no D-Bus call is made. reply_handler gets None if the connection
+        is not connected anymore. Returns an object whose cancel() method
+        aborts the lookup, like get_activity_async().
+        """
+        lookup = _Lookup(reply_handler, error_handler, timeout)
+        if self._activity_cache is not None:
+            if self._activity_cache.room_handle != room_handle:
+                raise RuntimeError('Activities can only access their own'
+                                   ' shared instance')
+            lookup.finish_later(self._activity_cache)
+            return lookup
+
+        connection_manager = get_connection_manager()
+        connections_per_account = \
+            connection_manager.get_connections_per_account()
+        for account_path, connection in connections_per_account.items():
+            if connection.connected and \
+                    connection.connection.object_path == connection_path:
+                lookup.finish_later(self.__activity_found_cb(
+                    account_path, connection.connection, room_handle))
+                break
+        else:
+            lookup.finish_later(None)
+        return lookup
 
-        buddy = Buddy(account_path, contact_id)
-        self._buddy_cache[(account_path, contact_id)] = buddy
-        return buddy
+    def get_buddy(self, account_path, contact_id):
+        return get_buddy(account_path, contact_id)
 
     # DEPRECATED
     def get_buddy_by_telepathy_handle(self, tp_conn_name, tp_conn_path,
@@ -165,6 +251,49 @@ class PresenceService(GObject.GObject):
         raise ValueError('Unknown buddy in connection %s with handle %d',
                          tp_conn_path, handle)
 
+    def get_buddy_by_telepathy_handle_async(self, tp_conn_name,
+                                            tp_conn_path, handle,
+                                            reply_handler,
+                                            error_handler=None,
+                                            timeout=LOOKUP_TIMEOUT):
+        """Asynchronously retrieve the Buddy object for a contact handle
+
+        See get_buddy_by_telepathy_handle() for the parameters.
+        reply_handler is called with the Buddy object, or None if no
+        account owns the connection, and error_handler with the exception
+        if a call failed or the lookup timed out.
+
+        The handle is inspected while the account owning the connection
+        is looked up. When the connection is not tracked yet, all the
+        accounts are asked for their connection at once.
+
+        Returns an object whose cancel() method aborts the lookup.
+        """
+        lookup = _BuddyLookup(reply_handler, error_handler, timeout)
+        lookup.call(tp_conn_name, tp_conn_path, CONNECTION, 'InspectHandles',
+                    'uau', (HANDLE_TYPE_CONTACT, [handle]),
+                    lookup.got_contact_ids)
+
+        account_path = \
+            get_connection_manager().get_account_for_connection(tp_conn_path)
+        if account_path is not None:
+            lookup.got_account_path(account_path)
+            return lookup
+
+        lookup.call(ACCOUNT_MANAGER_SERVICE, ACCOUNT_MANAGER_PATH,
+                    PROPERTIES_IFACE, 'Get', 'ss',
+                    (ACCOUNT_MANAGER, 'ValidAccounts'),
+                    partial(self.__got_valid_accounts_cb, lookup,
+                            tp_conn_path))
+        return lookup
+
+    def __got_valid_accounts_cb(self, lookup, tp_conn_path, account_paths):
+        for account_path in account_paths:
+            lookup.call(ACCOUNT_MANAGER_SERVICE, account_path,
+                        PROPERTIES_IFACE, 'Get', 'ss', (ACCOUNT, 'Connection'),
+                        partial(lookup.got_connection_path, account_path,
+                                tp_conn_path))
+
     def get_owner(self):
         """Retrieves the laptop Buddy object."""
         return Owner()
@@ -255,6 +384,161 @@ class PresenceService(GObject.GObject):
         raise NotImplementedError()
 
 
+class _Lookup(object):
+    """Race asynchronous D-Bus calls, the first useful reply wins
+
+    Subclasses call finish() with the result once they have it. The calls
+    still pending at that point are cancelled. If all the calls complete
+    without a result, the first unexpected error is reported, or None if
+    there was none.
+    """
+
+    def __init__(self, reply_handler, error_handler, timeout):
+        self._reply_handler = reply_handler
+        self._error_handler = error_handler
+        self._timeout = timeout
+        self._pending_calls = {}
+        self._error = None
+        self._finished = False
+        self._idle_sid = None
+        self._timeout_sid = GLib.timeout_add(int(timeout * 1000),
+                                             self.__timeout_cb)
+
+    def call(self, bus_name, object_path, interface, method, signature, args,
+             reply_cb):
+        """Call method on the session bus, reply_cb gets the reply"""
+        key = object()
+        bus = dbus.SessionBus()
+        self._pending_calls[key] = bus.call_async(
+            bus_name, object_path, interface, method, signature, args,
+            reply_handler=partial(self.__reply_cb, key, reply_cb),
+            error_handler=partial(self.__error_cb, key),
+            timeout=self._timeout)
+
+    def finish(self, result):
+        if self._finished:
+            return
+        self._stop()
+        self._reply_handler(result)
+
+    def finish_later(self, result):
+        """Like finish(), from the main loop once the caller returned"""
+        if self._finished or self._idle_sid is not None:
+            return
+        self._idle_sid = GLib.idle_add(self.__idle_finish_cb, result)
+
+    def fail(self, error):
+        if self._finished:
+            return
+        self._stop()
+        if self._error_handler is not None:
+            self._error_handler(error)
+        else:
+            _logger.error('Lookup failed: %s', error)
+            self._reply_handler(None)
+
+    def cancel(self):
+        """Abort the lookup, the handlers will not be called"""
+        self._stop()
+
+    def _stop(self):
+        self._finished = True
+        for pending_call in self._pending_calls.values():
+            pending_call.cancel()
+        self._pending_calls.clear()
+        if self._timeout_sid is not None:
+            GLib.source_remove(self._timeout_sid)
+            self._timeout_sid = None
+        if self._idle_sid is not None:
+            GLib.source_remove(self._idle_sid)
+            self._idle_sid = None
+
+    def _is_expected_error(self, error):
+        return False
+
+    def __reply_cb(self, key, reply_cb, *args):
+        del self._pending_calls[key]
+        if self._finished:
+            return
+        reply_cb(*args)
+        self._check_exhausted()
+
+    def __error_cb(self, key, error):
+        del self._pending_calls[key]
+        if self._finished:
+            return
+        if not self._is_expected_error(error) and self._error is None:
+            self._error = error
+        self._check_exhausted()
+
+    def _check_exhausted(self):
+        if self._finished or self._pending_calls:
+            return
+        if self._error is not None:
+            self.fail(self._error)
+        else:
+            self.finish(None)
+
+    def __idle_finish_cb(self, result):
+        self._idle_sid = None
+        self.finish(result)
+        return False
+
+    def __timeout_cb(self):
+        self._timeout_sid = None
+        self.fail(dbus.exceptions.DBusException(
+            'Lookup timed out', name='org.freedesktop.DBus.Error.Timeout'))
+        return False
+
+
+class _ActivityLookup(_Lookup):
+    """Look for an activity on several accounts at once"""
+
+    def __init__(self, activity_id, found_cb, reply_handler, error_handler,
+                 timeout):
+        _Lookup.__init__(self, reply_handler, error_handler, timeout)
+        self._activity_id = activity_id
+        self._found_cb = found_cb
+
+    def got_room_handle(self, account_path, connection, room_handle):
+        self.finish(self._found_cb(account_path, connection, room_handle))
+
+    def _is_expected_error(self, error):
+        name = 'org.freedesktop.Telepathy.Error.NotAvailable'
+        if error.get_dbus_name() == name:
+            logging.debug("There's no shared activity with the id %s",
+                          self._activity_id)
+            return True
+        _logger.error('GetActivity failed: %s', error)
+        return False
+
+
+class _BuddyLookup(_Lookup):
+    """Find the account and the contact id of a contact handle"""
+
+    def __init__(self, reply_handler, error_handler, timeout):
+        _Lookup.__init__(self, reply_handler, error_handler, timeout)
+        self._account_path = None
+        self._contact_id = None
+
+    def got_contact_ids(self, contact_ids):
+        self._contact_id = contact_ids[0]
+        self._check_found()
+
+    def got_account_path(self, account_path):
+        self._account_path = account_path
+        self._check_found()
+
+    def got_connection_path(self, account_path, tp_conn_path,
+                            connection_path):
+        if connection_path == tp_conn_path:
+            self.got_account_path(account_path)
+
+    def _check_found(self):
+        if self._account_path is not None and self._contact_id is not None:
+            self.finish(get_buddy(self._account_path, self._contact_id))
+
+
 _ps = None
 
 
@@ -0,0 +1,314 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Framed message channel on top of a D-Bus tube
+
+Instead of sending one D-Bus message per state change, activities can
+send their messages through a MessageChannel. The messages sent during
+a tick are packed into length-prefixed frames, compressed with zlib when
+they are big enough, and sent as a single D-Bus message to all the
+participants of the tube, or to a single one.
+
+    channel = MessageChannel(tube_connection, 'canvas')
+    channel.connect('message-received', message_received_cb)
+    channel.send(json.dumps(stroke))
+
+UNSTABLE.
+"""
+
+import logging
+import struct
+import zlib
+
+from gi.repository import GObject
+from gi.repository import GLib
+import dbus
+import dbus.service
+
+
+MESSAGE_CHANNEL_IFACE = 'org.laptop.Sugar.MessageChannel'
+MESSAGE_CHANNEL_PATH = '/org/laptop/Sugar/MessageChannel'
+
+FLAG_COMPRESSED = 1
+
+_FRAME_HEADER = '>BI'
+_MESSAGE_HEADER = '>I'
+_FRAME_HEADER_SIZE = struct.calcsize(_FRAME_HEADER)
+_MESSAGE_HEADER_SIZE = struct.calcsize(_MESSAGE_HEADER)
+
+_logger = logging.getLogger('sugar3.presence.tubechannel')
+
+
+def encode_frame(messages, compress_threshold=None):
+    """Pack a list of messages (str) into a frame
+
+    The payload is compressed with zlib when it is at least
+    compress_threshold bytes long and compression makes it smaller.
+    """
+    parts = []
+    for message in messages:
+        parts.append(struct.pack(_MESSAGE_HEADER, len(message)))
+        parts.append(message)
+    payload = ''.join(parts)
+
+    flags = 0
+    if compress_threshold is not None and \
+            len(payload) >= compress_threshold:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_COMPRESSED
+
+    return struct.pack(_FRAME_HEADER, flags, len(payload)) + payload
+
+
+def decode_frame(frame):
+    """Return the list of messages packed in frame by encode_frame()
+
+    Raises ValueError if the frame is malformed.
+    """
+    frame = str(frame)
+    if len(frame) < _FRAME_HEADER_SIZE:
+        raise ValueError('Frame too short')
+    flags, length = struct.unpack_from(_FRAME_HEADER, frame)
+    payload = frame[_FRAME_HEADER_SIZE:]
+    if len(payload) != length:
+        raise ValueError('Frame length mismatch')
+
+    if flags & FLAG_COMPRESSED:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error, e:
+            raise ValueError('Cannot decompress frame: %s' % e)
+
+    messages = []
+    offset = 0
+    while offset < len(payload):
+        if offset + _MESSAGE_HEADER_SIZE > len(payload):
+            raise ValueError('Truncated message header')
+        length, = struct.unpack_from(_MESSAGE_HEADER, payload, offset)
+        offset += _MESSAGE_HEADER_SIZE
+        if offset + length > len(payload):
+            raise ValueError('Truncated message')
+        messages.append(payload[offset:offset + length])
+        offset += length
+    return messages
+
+
+def _split_frames(entries, max_frame_size):
+    """Group a list of (handle, message) into (handle, messages) frames
+
+    Only consecutive messages for the same handle share a frame, so that
+    sending the frames in order keeps the order of the messages. A frame
+    holds messages up to max_frame_size bytes, unless a single message is
+    bigger than that.
+    """
+    frame_handle = None
+    frame_messages = []
+    size = 0
+    for handle, message in entries:
+        message_size = _MESSAGE_HEADER_SIZE + len(message)
+        if frame_messages and (handle != frame_handle or
+                               size + message_size > max_frame_size):
+            yield frame_handle, frame_messages
+            frame_messages = []
+            size = 0
+        frame_handle = handle
+        frame_messages.append(message)
+        size += message_size
+    if frame_messages:
+        yield frame_handle, frame_messages
+
+
+class _FrameObject(dbus.service.Object):
+
+    def __init__(self, connection, object_path, frame_cb):
+        dbus.service.Object.__init__(self, connection, object_path)
+        self._frame_cb = frame_cb
+
+    @dbus.service.signal(MESSAGE_CHANNEL_IFACE, signature='ay')
+    def Frame(self, frame):
+        pass
+
+    @dbus.service.method(MESSAGE_CHANNEL_IFACE, in_signature='ay',
+                         out_signature='', sender_keyword='sender',
+                         byte_arrays=True)
+    def Deliver(self, frame, sender=None):
+        self._frame_cb(frame, sender)
+
+
+class MessageChannel(GObject.GObject):
+    """Sends batches of messages to the participants of a D-Bus tube
+
+    tube_connection -- a TubeConnection, whose participants mapping is
+        used to address a single participant
+    name -- identifies the channel, several channels can share a tube
+    interval -- time between two flushes of the send queue, in ms
+    compress_threshold -- size in bytes above which frames are compressed
+    max_queue -- number of messages that can be queued before send()
+        refuses new ones
+    max_queue_size -- size in bytes of the messages that can be queued
+        before send() refuses new ones
+    max_frame_size -- size in bytes above which the messages of a tick
+        are split in several frames
+
+    The messages are received in the order they were sent, whether they
+    were sent to all the participants or to a single one.
+    """
+
+    __gsignals__ = {
+        'message-received': (GObject.SignalFlags.RUN_FIRST, None,
+                             ([object, object])),
+        'drained': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+    }
+
+    def __init__(self, tube_connection, name='default', interval=20,
+                 compress_threshold=1024, max_queue=4096,
+                 max_queue_size=1024 * 1024, max_frame_size=65536):
+        GObject.GObject.__init__(self)
+
+        self._tube_connection = tube_connection
+        self._interval = interval
+        self._compress_threshold = compress_threshold
+        self._max_queue = max_queue
+        self._max_queue_size = max_queue_size
+        self._max_frame_size = max_frame_size
+
+        # (handle, message) in send order
+        self._queue = []
+        self._queued_size = 0
+        self._blocked = False
+        self._flush_sid = None
+
+        self.messages_sent = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+
+        self._object_path = '%s/%s' % (MESSAGE_CHANNEL_PATH, name)
+        self._object = _FrameObject(tube_connection, self._object_path,
+                                    self.__frame_cb)
+        self._match = tube_connection.add_signal_receiver(
+            self.__frame_signal_cb, 'Frame', MESSAGE_CHANNEL_IFACE,
+            path=self._object_path, sender_keyword='sender',
+            byte_arrays=True)
+
+    def send(self, message, handle=None):
+        """Queue message to be sent at the next tick
+
+        message -- a str
+        handle -- the tube handle of the participant the message is for,
+            or None to send it to all the participants
+
+        Returns False, without queueing the message, if the queue is
+        full. The drained signal is emitted once there is room again. A
+        message bigger than max_queue_size is only accepted when the
+        queue is empty.
+        """
+        if len(self._queue) >= self._max_queue or \
+                (self._queue and self._queued_size + len(message) >
+                 self._max_queue_size):
+            self._blocked = True
+            return False
+
+        self._queue.append((handle, message))
+        self._queued_size += len(message)
+
+        if self._flush_sid is None:
+            self._flush_sid = GLib.timeout_add(self._interval,
+                                               self.__flush_cb)
+        return True
+
+    def get_queued(self):
+        return len(self._queue)
+
+    def get_queued_size(self):
+        return self._queued_size
+
+    def __flush_cb(self):
+        self._flush_sid = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Send the queued messages now"""
+        if self._flush_sid is not None:
+            GLib.source_remove(self._flush_sid)
+            self._flush_sid = None
+
+        queue = self._queue
+        self._queue = []
+        self._queued_size = 0
+
+        for handle, messages in _split_frames(queue, self._max_frame_size):
+            if handle is None:
+                bus_name = None
+            else:
+                bus_name = self._tube_connection.participants.get(handle)
+                if bus_name is None:
+                    _logger.debug('Dropping %d messages for %r, not in the '
+                                  'tube anymore', len(messages), handle)
+                    continue
+
+            frame = encode_frame(messages, self._compress_threshold)
+            self._send_frame(frame, bus_name)
+            self.messages_sent += len(messages)
+            self.frames_sent += 1
+            self.bytes_sent += len(frame)
+
+        if self._blocked:
+            self._blocked = False
+            self.emit('drained')
+
+    def _send_frame(self, frame, bus_name):
+        if bus_name is None:
+            self._object.Frame(dbus.ByteArray(frame))
+        else:
+            self._tube_connection.call_async(
+                bus_name, self._object_path, MESSAGE_CHANNEL_IFACE,
+                'Deliver', 'ay', (dbus.ByteArray(frame),),
+                reply_handler=self.__deliver_cb,
+                error_handler=self.__deliver_error_cb)
+
+    def __deliver_cb(self):
+        pass
+
+    def __deliver_error_cb(self, error):
+        _logger.error('Cannot deliver frame: %s', error)
+
+    def __frame_signal_cb(self, frame, sender=None):
+        if sender == self._tube_connection.get_unique_name():
+            return
+        self.__frame_cb(frame, sender)
+
+    def __frame_cb(self, frame, sender):
+        try:
+            messages = decode_frame(frame)
+        except ValueError, e:
+            _logger.error('Dropping invalid frame from %s: %s', sender, e)
+            return
+
+        handle = self._tube_connection.bus_name_to_handle.get(sender)
+        for message in messages:
+            self.messages_received += 1
+            self.emit('message-received', handle, message)
+
+    def close(self):
+        """Send the queued messages and stop listening"""
+        self.flush()
+        self._match.remove()
+        self._object.remove_from_connection()
@@ -0,0 +1,913 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Stand-in Telepathy stack for exercising sugar3.presence offline
+
+The fake runs in its own process, on a private session bus, and
+implements the subset of the account manager, connection, text channel
+and tubes channel interfaces that sugar3.presence uses. It simulates a
+number of buddies, all sharing the activity FAKE_ACTIVITY_ID, and can
+add latency to every method call.
+
+    presence = FakePresence(buddies=40, latency=10)
+    presence.start()
+    try:
+        # sugar3.presence now talks to the fake
+        ...
+        presence.get_control().Churn(5)
+    finally:
+        presence.stop()
+
+D-Bus tubes are relayed by the fake: the simulated buddies are listed
+as participants of every tube, the messages addressed to them are
+counted and dropped, the other ones are forwarded between the real
+participants.
+
+UNSTABLE.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+from gi.repository import GLib
+import dbus
+import dbus.bus
+import dbus.lowlevel
+import dbus.server
+import dbus.service
+from dbus import PROPERTIES_IFACE
+from dbus.mainloop.glib import DBusGMainLoop
+from telepathy.errors import InvalidHandle, NotAvailable
+from telepathy.interfaces import ACCOUNT, \
+    ACCOUNT_MANAGER, \
+    CHANNEL, \
+    CHANNEL_INTERFACE_GROUP, \
+    CHANNEL_TYPE_TEXT, \
+    CHANNEL_TYPE_TUBES, \
+    CONNECTION, \
+    CONNECTION_INTERFACE_ALIASING, \
+    CONNECTION_INTERFACE_CONTACTS
+from telepathy.constants import CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES, \
+    CONNECTION_STATUS_CONNECTED, \
+    HANDLE_TYPE_CONTACT, \
+    HANDLE_TYPE_ROOM, \
+    TUBE_STATE_OPEN, \
+    TUBE_TYPE_DBUS
+
+
+ACCOUNT_MANAGER_SERVICE = 'org.freedesktop.Telepathy.AccountManager'
+ACCOUNT_MANAGER_PATH = '/org/freedesktop/Telepathy/AccountManager'
+ACCOUNT_PATH = '/org/freedesktop/Telepathy/Account/salut/local_xmpp/fake'
+CONNECTION_PATH = \
+    '/org/freedesktop/Telepathy/Connection/salut/local_xmpp/fake'
+CONNECTION_SERVICE = CONNECTION_PATH.replace('/', '.')[1:]
+
+CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
+CONN_INTERFACE_BUDDY_INFO = 'org.laptop.Telepathy.BuddyInfo'
+
+FAKE_PRESENCE_INTERFACE = 'org.laptop.Sugar.FakePresence'
+FAKE_PRESENCE_PATH = '/org/laptop/Sugar/FakePresence'
+
+FAKE_ACTIVITY_ID = '0123456789abcdef0123456789abcdef01234567'
+
+_SELF_HANDLE = 1
+# Channel specific handles are the owner handle plus this offset
+_CHANNEL_HANDLE_OFFSET = 1000
+
+_logger = logging.getLogger('sugar3.test.fakepresence')
+
+
+def _method(interface, in_signature='', out_signature=''):
+    """Export the decorated method on interface, replying through the
+    reply_cb and error_cb arguments"""
+    return dbus.service.method(interface, in_signature=in_signature,
+                               out_signature=out_signature,
+                               async_callbacks=('reply_cb', 'error_cb'))
+
+
+class _FakeObject(dbus.service.Object):
+
+    def __init__(self, fake, object_path):
+        dbus.service.Object.__init__(self, fake.bus, object_path)
+        self._fake = fake
+
+    def _reply(self, name, reply_cb, *args):
+        self._fake.count(name)
+        self._fake.later(reply_cb, *args)
+
+    def _error(self, name, error_cb, error):
+        self._fake.count(name)
+        self._fake.later(error_cb, error)
+
+
+class _FakeAccountManager(_FakeObject):
+
+    @_method(PROPERTIES_IFACE, 'ss', 'v')
+    def Get(self, interface, name, reply_cb, error_cb):
+        if interface == ACCOUNT_MANAGER and name == 'ValidAccounts':
+            self._reply('AccountManager.Get', reply_cb,
+                        dbus.Array([ACCOUNT_PATH], signature='o'))
+        else:
+            self._error('AccountManager.Get', error_cb,
+                        NotAvailable('No property %s' % name))
+
+
+class _FakeAccount(_FakeObject):
+
+    @_method(PROPERTIES_IFACE, 'ss', 'v')
+    def Get(self, interface, name, reply_cb, error_cb):
+        if name == 'Connection':
+            value = dbus.ObjectPath(CONNECTION_PATH)
+        elif name == 'ConnectionStatus':
+            value = dbus.UInt32(CONNECTION_STATUS_CONNECTED)
+        else:
+            self._error('Account.Get', error_cb,
+                        NotAvailable('No property %s' % name))
+            return
+        self._reply('Account.Get', reply_cb, value)
+
+    @dbus.service.signal(ACCOUNT, signature='a{sv}')
+    def AccountPropertyChanged(self, properties):
+        pass
+
+
+class _Room(object):
+
+    def __init__(self, handle, activity_id):
+        self.handle = handle
+        self.activity_id = activity_id
+        self.properties = {}
+        self.shared = False
+        self.members = []
+        self.local_pending = [_SELF_HANDLE]
+        self.text_channel = None
+        self.tubes_channel = None
+
+
+class _FakeActivityProperties(_FakeObject):
+    """The ActivityProperties interface of the connection
+
+    BuddyInfo has a GetProperties method too, and dbus.service looks
+    methods up by their Python name, so they can't be defined in the same
+    class.
+    """
+
+    @_method(CONN_INTERFACE_ACTIVITY_PROPERTIES, 's', 'u')
+    def GetActivity(self, activity_id, reply_cb, error_cb):
+        room = self.get_room(activity_id)
+        if room is None or not room.shared:
+            self._error('GetActivity', error_cb,
+                        NotAvailable('No activity %s' % activity_id))
+        else:
+            self._reply('GetActivity', reply_cb, room.handle)
+
+    @_method(CONN_INTERFACE_ACTIVITY_PROPERTIES, 'u', 'a{sv}')
+    def GetProperties(self, handle, reply_cb, error_cb):
+        room = self._rooms.get(handle)
+        if room is None:
+            self._error('ActivityProperties.GetProperties', error_cb,
+                        InvalidHandle('Unknown room %s' % handle))
+            return
+        self._reply('ActivityProperties.GetProperties', reply_cb,
+                    dbus.Dictionary(room.properties, signature='sv'))
+
+    @_method(CONN_INTERFACE_ACTIVITY_PROPERTIES, 'ua{sv}')
+    def SetProperties(self, handle, properties, reply_cb, error_cb):
+        room = self._rooms.get(handle)
+        if room is None:
+            self._error('ActivityProperties.SetProperties', error_cb,
+                        InvalidHandle('Unknown room %s' % handle))
+            return
+        room.properties.update(properties)
+        self._reply('ActivityProperties.SetProperties', reply_cb)
+        self.ActivityPropertiesChanged(handle, room.properties)
+
+    @dbus.service.signal(CONN_INTERFACE_ACTIVITY_PROPERTIES,
+                         signature='ua{sv}')
+    def ActivityPropertiesChanged(self, handle, properties):
+        pass
+
+
+class _FakeConnection(_FakeActivityProperties):
+
+    def __init__(self, fake, buddies):
+        _FakeActivityProperties.__init__(self, fake, CONNECTION_PATH)
+
+        self._contact_ids = {_SELF_HANDLE: 'owner@fake'}
+        self._contact_handles = {'owner@fake': _SELF_HANDLE}
+        for i in range(buddies):
+            self._get_contact_handle('buddy%03d@fake' % i)
+
+        self._rooms = {}
+        self._room_handles = {}
+        self._channel_count = 0
+
+        room = self._get_room(FAKE_ACTIVITY_ID)
+        room.shared = True
+        room.members = [handle for handle in self._contact_ids
+                        if handle != _SELF_HANDLE]
+        room.properties = {'id': FAKE_ACTIVITY_ID,
+                           'type': 'org.laptop.FakeActivity',
+                           'name': 'Fake activity',
+                           'color': '#FF0000,#00FF00',
+                           'private': False}
+
+    def _get_contact_handle(self, contact_id):
+        if contact_id not in self._contact_handles:
+            handle = len(self._contact_ids) + 1
+            self._contact_ids[handle] = contact_id
+            self._contact_handles[contact_id] = handle
+        return self._contact_handles[contact_id]
+
+    def _get_room(self, activity_id):
+        if activity_id not in self._room_handles:
+            handle = len(self._rooms) + 1
+            self._rooms[handle] = _Room(handle, activity_id)
+            self._room_handles[activity_id] = handle
+        return self._rooms[self._room_handles[activity_id]]
+
+    def get_room(self, activity_id):
+        return self._rooms.get(self._room_handles.get(activity_id))
+
+    def get_rooms(self):
+        return self._rooms.values()
+
+    def _new_channel_path(self, kind):
+        self._channel_count += 1
+        return '%s/%s%d' % (CONNECTION_PATH, kind, self._channel_count)
+
+    @_method(CONNECTION, '', 'u')
+    def GetSelfHandle(self, reply_cb, error_cb):
+        self._reply('GetSelfHandle', reply_cb, _SELF_HANDLE)
+
+    @_method(PROPERTIES_IFACE, 'ss', 'v')
+    def Get(self, interface, name, reply_cb, error_cb):
+        if interface == CONNECTION and name == 'SelfHandle':
+            self._reply('Get', reply_cb, dbus.UInt32(_SELF_HANDLE))
+        else:
+            self._error('Get', error_cb,
+                        NotAvailable('No property %s' % name))
+
+    @_method(CONNECTION, 'uas', 'au')
+    def RequestHandles(self, handle_type, names, reply_cb, error_cb):
+        if handle_type == HANDLE_TYPE_CONTACT:
+            handles = [self._get_contact_handle(name) for name in names]
+        elif handle_type == HANDLE_TYPE_ROOM:
+            handles = [self._get_room(name).handle for name in names]
+        else:
+            self._error('RequestHandles', error_cb,
+                        NotAvailable('Unsupported handle type'))
+            return
+        self._reply('RequestHandles', reply_cb, handles)
+
+    @_method(CONNECTION, 'uau', 'as')
+    def InspectHandles(self, handle_type, handles, reply_cb, error_cb):
+        try:
+            if handle_type == HANDLE_TYPE_CONTACT:
+                names = [self._contact_ids[handle] for handle in handles]
+            else:
+                names = [self._rooms[handle].activity_id
+                         for handle in handles]
+        except KeyError, e:
+            self._error('InspectHandles', error_cb,
+                        InvalidHandle('Unknown handle %s' % e))
+            return
+        self._reply('InspectHandles', reply_cb, names)
+
+    @_method(CONNECTION, 'suub', 'o')
+    def RequestChannel(self, channel_type, handle_type, handle,
+                       suppress_handler, reply_cb, error_cb):
+        room = self._rooms.get(handle)
+        if handle_type != HANDLE_TYPE_ROOM or room is None:
+            self._error('RequestChannel', error_cb,
+                        InvalidHandle('Unknown room %s' % handle))
+            return
+
+        if channel_type == CHANNEL_TYPE_TEXT:
+            if room.text_channel is None:
+                room.text_channel = _FakeTextChannel(
+                    self._fake, self._new_channel_path('TextChannel'), room)
+            channel = room.text_channel
+        elif channel_type == CHANNEL_TYPE_TUBES:
+            if room.tubes_channel is None:
+                room.tubes_channel = _FakeTubesChannel(
+                    self._fake, self._new_channel_path('TubesChannel'), room)
+            channel = room.tubes_channel
+        else:
+            self._error('RequestChannel', error_cb,
+                        NotAvailable('Unsupported channel type'))
+            return
+        self._reply('RequestChannel', reply_cb,
+                    dbus.ObjectPath(channel.object_path))
+
+    @dbus.service.signal(CONNECTION, signature='uu')
+    def StatusChanged(self, status, reason):
+        pass
+
+    @_method(CONN_INTERFACE_BUDDY_INFO, 'u', 'a{sv}')
+    def GetProperties(self, handle, reply_cb, error_cb):
+        if handle not in self._contact_ids:
+            self._error('BuddyInfo.GetProperties', error_cb,
+                        InvalidHandle('Unknown contact %s' % handle))
+            return
+        properties = {'key': dbus.ByteArray('key-%d' % handle),
+                      'color': '#00FF00,#0000FF',
+                      'ip4-address': '10.0.%d.%d' % (handle / 256,
+                                                     handle % 256)}
+        self._reply('BuddyInfo.GetProperties', reply_cb,
+                    dbus.Dictionary(properties, signature='sv'))
+
+    @_method(CONN_INTERFACE_BUDDY_INFO, 'su')
+    def AddActivity(self, activity_id, handle, reply_cb, error_cb):
+        room = self._rooms.get(handle)
+        if room is None:
+            self._error('AddActivity', error_cb,
+                        InvalidHandle('Unknown room %s' % handle))
+            return
+        room.shared = True
+        self._reply('AddActivity', reply_cb)
+
+    @_method(CONNECTION_INTERFACE_CONTACTS, 'auasb', 'a{ua{sv}}')
+    def GetContactAttributes(self, handles, interfaces, hold, reply_cb,
+                             error_cb):
+        attributes = {}
+        for handle in handles:
+            contact_id = self._contact_ids.get(handle)
+            if contact_id is None:
+                continue
+            contact_attributes = {}
+            if CONNECTION_INTERFACE_ALIASING in interfaces:
+                nick = contact_id.split('@')[0].capitalize()
+                contact_attributes[CONNECTION_INTERFACE_ALIASING +
+                                   '/alias'] = nick
+            attributes[handle] = dbus.Dictionary(contact_attributes,
+                                                 signature='sv')
+        self._reply('GetContactAttributes', reply_cb,
+                    dbus.Dictionary(attributes, signature='ua{sv}'))
+
+
+class _FakeChannel(_FakeObject):
+
+    channel_type = None
+    interfaces = []
+
+    def __init__(self, fake, object_path, room):
+        _FakeObject.__init__(self, fake, object_path)
+        self.room = room
+
+    @_method(CHANNEL, '', 's')
+    def GetChannelType(self, reply_cb, error_cb):
+        self._reply('GetChannelType', reply_cb, self.channel_type)
+
+    @_method(CHANNEL, '', 'as')
+    def GetInterfaces(self, reply_cb, error_cb):
+        self._reply('GetInterfaces', reply_cb,
+                    dbus.Array(self.interfaces, signature='s'))
+
+    @_method(CHANNEL, '', 'uu')
+    def GetHandle(self, reply_cb, error_cb):
+        self._reply('GetHandle', reply_cb, HANDLE_TYPE_ROOM,
+                    self.room.handle)
+
+    @_method(CHANNEL)
+    def Close(self, reply_cb, error_cb):
+        self._reply('Close', reply_cb)
+        self.close()
+
+    def close(self):
+        self.Closed()
+        self.remove_from_connection()
+        self._closed()
+
+    def _closed(self):
+        pass
+
+    @dbus.service.signal(CHANNEL, signature='')
+    def Closed(self):
+        pass
+
+
+class _FakeTextChannel(_FakeChannel):
+
+    channel_type = CHANNEL_TYPE_TEXT
+    interfaces = [CHANNEL_INTERFACE_GROUP]
+
+    def _to_channel(self, handles):
+        if self._fake.channel_specific_handles:
+            return [handle + _CHANNEL_HANDLE_OFFSET for handle in handles]
+        return list(handles)
+
+    def _to_owners(self, handles):
+        if self._fake.channel_specific_handles:
+            return [handle - _CHANNEL_HANDLE_OFFSET for handle in handles]
+        return list(handles)
+
+    def get_group_flags(self):
+        if self._fake.channel_specific_handles:
+            return CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES
+        return 0
+
+    @_method(CHANNEL_INTERFACE_GROUP, '', 'u')
+    def GetSelfHandle(self, reply_cb, error_cb):
+        self._reply('Group.GetSelfHandle', reply_cb,
+                    self._to_channel([_SELF_HANDLE])[0])
+
+    @_method(CHANNEL_INTERFACE_GROUP, '', 'u')
+    def GetGroupFlags(self, reply_cb, error_cb):
+        self._reply('GetGroupFlags', reply_cb, self.get_group_flags())
+
+    @_method(CHANNEL_INTERFACE_GROUP, '', 'auauau')
+    def GetAllMembers(self, reply_cb, error_cb):
+        self._reply('GetAllMembers', reply_cb,
+                    dbus.Array(self._to_channel(self.room.members),
+                               signature='u'),
+                    dbus.Array(self._to_channel(self.room.local_pending),
+                               signature='u'),
+                    dbus.Array([], signature='u'))
+
+    @_method(CHANNEL_INTERFACE_GROUP, 'au', 'au')
+    def GetHandleOwners(self, handles, reply_cb, error_cb):
+        self._reply('GetHandleOwners', reply_cb, self._to_owners(handles))
+
+    @_method(CHANNEL_INTERFACE_GROUP, 'aus')
+    def AddMembers(self, handles, message, reply_cb, error_cb):
+        added = []
+        for handle in self._to_owners(handles):
+            if handle in self.room.local_pending:
+                self.room.local_pending.remove(handle)
+            if handle not in self.room.members:
+                self.room.members.append(handle)
+                added.append(handle)
+        self._reply('AddMembers', reply_cb)
+        if added:
+            self._fake.later(self.members_changed, added, [])
+
+    def _closed(self):
+        self.room.text_channel = None
+        if _SELF_HANDLE in self.room.members:
+            self.room.members.remove(_SELF_HANDLE)
+            self.room.local_pending.append(_SELF_HANDLE)
+
+    def members_changed(self, added, removed):
+        self.MembersChanged('', self._to_channel(added),
+                            self._to_channel(removed), [], [], 0, 0)
+
+    @dbus.service.signal(CHANNEL_INTERFACE_GROUP, signature='sauauauauuu')
+    def MembersChanged(self, message, added, removed, local_pending,
+                       remote_pending, actor, reason):
+        pass
+
+    @dbus.service.signal(CHANNEL_INTERFACE_GROUP, signature='uu')
+    def GroupFlagsChanged(self, added, removed):
+        pass
+
+    def churn(self, count):
+        """Make count buddies leave the room and join it again"""
+        buddies = [handle for handle in self.room.members
+                   if handle != _SELF_HANDLE][:count]
+        for handle in buddies:
+            self.room.members.remove(handle)
+            self.members_changed([], [handle])
+        for handle in buddies:
+            self.room.members.append(handle)
+            self.members_changed([handle], [])
+        return len(buddies)
+
+
+class _FakeTubesChannel(_FakeChannel):
+
+    channel_type = CHANNEL_TYPE_TUBES
+
+    def __init__(self, fake, object_path, room):
+        _FakeChannel.__init__(self, fake, object_path, room)
+        self._tubes = {}
+
+    def _closed(self):
+        self.room.tubes_channel = None
+        for tube in self._tubes.values():
+            tube.close()
+        self._tubes = {}
+
+    def _get_tube(self, tube_id, name, error_cb):
+        tube = self._tubes.get(tube_id)
+        if tube is None:
+            self._error(name, error_cb,
+                        InvalidHandle('Unknown tube %s' % tube_id))
+        return tube
+
+    def _to_channel_handle(self, handle):
+        if self._fake.channel_specific_handles:
+            return handle + _CHANNEL_HANDLE_OFFSET
+        return handle
+
+    @_method(CHANNEL_TYPE_TUBES, 'sa{sv}', 'u')
+    def OfferDBusTube(self, service, parameters, reply_cb, error_cb):
+        tube_id = len(self._tubes) + 1
+        buddies = [self._to_channel_handle(handle)
+                   for handle in self.room.members if handle != _SELF_HANDLE]
+        tube = _TubeRelay(tube_id, buddies,
+                          self._to_channel_handle(_SELF_HANDLE),
+                          self.__dbus_names_changed_cb)
+        tube.service = service
+        tube.parameters = parameters
+        self._tubes[tube_id] = tube
+
+        self._reply('OfferDBusTube', reply_cb, tube_id)
+        self._fake.later(self.NewTube, tube_id,
+                         self._to_channel_handle(_SELF_HANDLE),
+                         TUBE_TYPE_DBUS, service, parameters,
+                         TUBE_STATE_OPEN)
+
+    @_method(CHANNEL_TYPE_TUBES, '', 'a(uuusa{sv}u)')
+    def ListTubes(self, reply_cb, error_cb):
+        tubes = [(tube_id, self._to_channel_handle(_SELF_HANDLE),
+                  TUBE_TYPE_DBUS, tube.service, tube.parameters,
+                  TUBE_STATE_OPEN)
+                 for tube_id, tube in self._tubes.items()]
+        self._reply('ListTubes', reply_cb,
+                    dbus.Array(tubes, signature='(uuusa{sv}u)'))
+
+    @_method(CHANNEL_TYPE_TUBES, 'u', 's')
+    def AcceptDBusTube(self, tube_id, reply_cb, error_cb):
+        tube = self._get_tube(tube_id, 'AcceptDBusTube', error_cb)
+        if tube is not None:
+            self._reply('AcceptDBusTube', reply_cb, tube.address)
+
+    @_method(CHANNEL_TYPE_TUBES, 'u', 's')
+    def GetDBusTubeAddress(self, tube_id, reply_cb, error_cb):
+        tube = self._get_tube(tube_id, 'GetDBusTubeAddress', error_cb)
+        if tube is not None:
+            self._reply('GetDBusTubeAddress', reply_cb, tube.address)
+
+    @_method(CHANNEL_TYPE_TUBES, 'u', 'a(us)')
+    def GetDBusNames(self, tube_id, reply_cb, error_cb):
+        tube = self._get_tube(tube_id, 'GetDBusNames', error_cb)
+        if tube is not None:
+            self._reply('GetDBusNames', reply_cb,
+                        dbus.Array(tube.get_names(), signature='(us)'))
+
+    @_method(CHANNEL_TYPE_TUBES, 'u')
+    def CloseTube(self, tube_id, reply_cb, error_cb):
+        tube = self._tubes.pop(tube_id, None)
+        if tube is None:
+            self._error('CloseTube', error_cb,
+                        InvalidHandle('Unknown tube %s' % tube_id))
+            return
+        tube.close()
+        self._reply('CloseTube', reply_cb)
+        self.TubeClosed(tube_id)
+
+    def __dbus_names_changed_cb(self, tube_id, added, removed):
+        self.DBusNamesChanged(tube_id, dbus.Array(added, signature='(us)'),
+                              dbus.Array(removed, signature='u'))
+
+    @dbus.service.signal(CHANNEL_TYPE_TUBES, signature='uuusa{sv}u')
+    def NewTube(self, tube_id, initiator, tube_type, service, parameters,
+                state):
+        pass
+
+    @dbus.service.signal(CHANNEL_TYPE_TUBES, signature='ua(us)au')
+    def DBusNamesChanged(self, tube_id, added, removed):
+        pass
+
+    @dbus.service.signal(CHANNEL_TYPE_TUBES, signature='u')
+    def TubeClosed(self, tube_id):
+        pass
+
+    def get_stats(self):
+        stats = {'tube-messages': 0, 'tube-bytes': 0}
+        for tube in self._tubes.values():
+            stats['tube-messages'] += tube.messages
+            stats['tube-bytes'] += tube.bytes
+        return stats
+
+
+def _get_payload_size(args):
+    size = 0
+    for arg in args:
+        if isinstance(arg, basestring):
+            size += len(arg)
+        elif isinstance(arg, (list, tuple)):
+            size += _get_payload_size(arg)
+        elif isinstance(arg, dict):
+            size += _get_payload_size(arg.keys())
+            size += _get_payload_size(arg.values())
+        else:
+            size += 8
+    return size
+
+
+class _TubeRelay(object):
+    """Emulates the bus of a D-Bus tube
+
+    Every connection to the relay address is a real participant, with
+    the self handle. The simulated buddies are participants too, but
+    the messages sent to them are only counted.
+    """
+
+    def __init__(self, tube_id, buddies, self_handle, names_changed_cb):
+        self._tube_id = tube_id
+        self._self_handle = self_handle
+        self._names_changed_cb = names_changed_cb
+
+        self._connections = {}
+        self._names = {}
+        self._pending_replies = {}
+        self._count = 0
+        for handle in buddies:
+            self._names[handle] = ':tube.buddy%d' % handle
+
+        self.service = None
+        self.parameters = None
+        self.messages = 0
+        self.bytes = 0
+
+        self._server = dbus.server.Server(
+            'unix:tmpdir=%s' % tempfile.gettempdir())
+        self._server.on_connection_added.append(self.__connection_added_cb)
+        self.address = self._server.address
+
+    def get_names(self):
+        return [(handle, name) for handle, name in self._names.items()]
+
+    def __connection_added_cb(self, connection):
+        self._count += 1
+        name = ':tube.%d' % self._count
+        self._connections[name] = connection
+        connection.add_message_filter(partial(self.__message_cb, name))
+        connection.call_on_disconnection(
+            partial(self.__disconnected_cb, name))
+
+        # All the real participants are the owner
+        self._names[self._self_handle] = name
+        self._names_changed_cb(self._tube_id, [(self._self_handle, name)],
+                               [])
+
+    def __disconnected_cb(self, name, connection):
+        self._connections.pop(name, None)
+        if self._names.get(self._self_handle) == name:
+            del self._names[self._self_handle]
+            self._names_changed_cb(self._tube_id, [], [self._self_handle])
+
+    def __message_cb(self, name, connection, message):
+        if message.get_path() == '/org/freedesktop/DBus/Local':
+            return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+        args = message.get_args_list(byte_arrays=True)
+        self.messages += 1
+        self.bytes += _get_payload_size(args)
+
+        message_type = message.get_type()
+        destination = message.get_destination()
+        if message_type == dbus.lowlevel.MESSAGE_TYPE_METHOD_CALL:
+            self._relay_method_call(name, connection, message, args)
+        elif message_type == dbus.lowlevel.MESSAGE_TYPE_SIGNAL:
+            signal = dbus.lowlevel.SignalMessage(message.get_path(),
+                                                 message.get_interface(),
+                                                 message.get_member())
+            self._copy(message, args, signal, name)
+            for target_name, target in self._connections.items():
+                if destination is not None and target_name != destination:
+                    continue
+                if target_name != name:
+                    target.send_message(signal)
+        else:
+            self._relay_reply(name, message, args)
+
+        return dbus.lowlevel.HANDLER_RESULT_HANDLED
+
+    def _copy(self, message, args, target, sender):
+        target.set_sender(sender)
+        if message.get_destination() is not None:
+            target.set_destination(message.get_destination())
+        signature = message.get_signature()
+        if signature:
+            target.append(signature=signature, *args)
+
+    def _relay_method_call(self, name, connection, message, args):
+        destination = message.get_destination()
+        target = self._connections.get(destination)
+        if target is not None:
+            call = dbus.lowlevel.MethodCallMessage(destination,
+                                                   message.get_path(),
+                                                   message.get_interface(),
+                                                   message.get_member())
+            self._copy(message, args, call, name)
+            call.set_no_reply(message.get_no_reply())
+            serial = target.send_message(call)
+            if not message.get_no_reply():
+                self._pending_replies[(destination, serial)] = \
+                    (name, message)
+        elif message.get_no_reply():
+            return
+        elif destination in self._names.values():
+            reply = dbus.lowlevel.MethodReturnMessage(message)
+            reply.set_sender(destination)
+            connection.send_message(reply)
+        else:
+            reply = dbus.lowlevel.ErrorMessage(
+                message, 'org.freedesktop.DBus.Error.ServiceUnknown',
+                'No participant %s in the tube' % destination)
+            connection.send_message(reply)
+
+    def _relay_reply(self, name, message, args):
+        key = (name, message.get_reply_serial())
+        if key not in self._pending_replies:
+            return
+        caller_name, call = self._pending_replies.pop(key)
+        caller = self._connections.get(caller_name)
+        if caller is None:
+            return
+
+        if message.get_type() == dbus.lowlevel.MESSAGE_TYPE_ERROR:
+            error_message = ''
+            if args:
+                error_message = args[0]
+            reply = dbus.lowlevel.ErrorMessage(call, message.get_error_name(),
+                                               error_message)
+            reply.set_sender(name)
+        else:
+            reply = dbus.lowlevel.MethodReturnMessage(call)
+            self._copy(message, args, reply, name)
+        caller.send_message(reply)
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._server.disconnect()
+
+
+class _FakeControl(_FakeObject):
+    """Lets the benchmarks drive the fake"""
+
+    @dbus.service.method(FAKE_PRESENCE_INTERFACE, in_signature='u',
+                         out_signature='u')
+    def Churn(self, count):
+        room = self._fake.connection.get_room(FAKE_ACTIVITY_ID)
+        if room.text_channel is None:
+            return 0
+        return room.text_channel.churn(count)
+
+    @dbus.service.method(FAKE_PRESENCE_INTERFACE, in_signature='u',
+                         out_signature='')
+    def SetLatency(self, latency):
+        self._fake.latency = latency
+
+    @dbus.service.method(FAKE_PRESENCE_INTERFACE, in_signature='',
+                         out_signature='a{su}')
+    def GetStats(self):
+        stats = dict(self._fake.calls)
+        for room in self._fake.connection.get_rooms():
+            if room.tubes_channel is not None:
+                for key, value in room.tubes_channel.get_stats().items():
+                    stats[key] = stats.get(key, 0) + value
+        return dbus.Dictionary(stats, signature='su')
+
+    @dbus.service.method(FAKE_PRESENCE_INTERFACE, in_signature='',
+                         out_signature='')
+    def ResetStats(self):
+        self._fake.calls.clear()
+
+
+class _Fake(object):
+
+    def __init__(self, bus, buddies, latency, channel_specific_handles):
+        self.bus = bus
+        self.latency = latency
+        self.channel_specific_handles = channel_specific_handles
+        self.calls = {}
+
+        self._names = [
+            dbus.service.BusName(ACCOUNT_MANAGER_SERVICE, bus),
+            dbus.service.BusName(CONNECTION_SERVICE, bus),
+            dbus.service.BusName(FAKE_PRESENCE_INTERFACE, bus)]
+
+        self.account_manager = _FakeAccountManager(self,
+                                                   ACCOUNT_MANAGER_PATH)
+        self.account = _FakeAccount(self, ACCOUNT_PATH)
+        self.connection = _FakeConnection(self, buddies)
+        self.control = _FakeControl(self, FAKE_PRESENCE_PATH)
+
+    def run(self):
+        _logger.debug('Fake presence running')
+        GLib.MainLoop().run()
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def later(self, callback, *args):
+        """Call callback after the configured latency"""
+        if not self.latency:
+            callback(*args)
+            return
+
+        def timeout_cb():
+            callback(*args)
+            return False
+
+        GLib.timeout_add(self.latency, timeout_cb)
+
+
+class FakePresence(object):
+    """Runs a private session bus with the fake Telepathy stack
+
+    start() points DBUS_SESSION_BUS_ADDRESS to the private bus, so it must
+    be called before the process connects to the session bus.
+    """
+
+    def __init__(self, buddies=10, latency=0, channel_specific_handles=False):
+        self._buddies = buddies
+        self._latency = latency
+        self._channel_specific_handles = channel_specific_handles
+        self._bus_process = None
+        self._fake_process = None
+        self._old_address = None
+        self.address = None
+
+    def start(self, timeout=10):
+        self._bus_process = subprocess.Popen(
+            ['dbus-daemon', '--session', '--nofork', '--print-address'],
+            stdout=subprocess.PIPE)
+        self.address = self._bus_process.stdout.readline().strip()
+
+        self._old_address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+        os.environ['DBUS_SESSION_BUS_ADDRESS'] = self.address
+
+        args = [sys.executable, '-m', 'sugar3.test.fakepresence',
+                '--buddies', str(self._buddies),
+                '--latency', str(self._latency)]
+        if self._channel_specific_handles:
+            args.append('--channel-specific-handles')
+        self._fake_process = subprocess.Popen(args)
+
+        bus = dbus.bus.BusConnection(self.address)
+        deadline = time.time() + timeout
+        try:
+            while not bus.name_has_owner(FAKE_PRESENCE_INTERFACE):
+                if time.time() > deadline or \
+                        self._fake_process.poll() is not None:
+                    raise RuntimeError('The fake presence did not start')
+                time.sleep(0.05)
+        finally:
+            bus.close()
+
+    def get_control(self):
+        """Return a proxy to the org.laptop.Sugar.FakePresence interface"""
+        bus = dbus.SessionBus()
+        obj = bus.get_object(FAKE_PRESENCE_INTERFACE, FAKE_PRESENCE_PATH)
+        return dbus.Interface(obj, FAKE_PRESENCE_INTERFACE)
+
+    def stop(self):
+        for process in (self._fake_process, self._bus_process):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+        self._fake_process = None
+        self._bus_process = None
+
+        if self._old_address is None:
+            os.environ.pop('DBUS_SESSION_BUS_ADDRESS', None)
+        else:
+            os.environ['DBUS_SESSION_BUS_ADDRESS'] = self._old_address
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Stand-in Telepathy stack for sugar3.presence.')
+    parser.add_argument('--buddies', type=int, default=10,
+                        help='Number of simulated buddies')
+    parser.add_argument('--latency', type=int, default=0,
+                        help='Latency of the method calls, in ms')
+    parser.add_argument('--channel-specific-handles', action='store_true',
+                        help='Use channel specific handles in the rooms')
+    args = parser.parse_args()
+
+    DBusGMainLoop(set_as_default=True)
+    fake = _Fake(dbus.SessionBus(), args.buddies, args.latency,
+                 args.channel_specific_handles)
+    fake.run()
+
+
+if __name__ == '__main__':
+    main()
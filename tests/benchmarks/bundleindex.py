@@ -0,0 +1,101 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Time to enumerate installed activities by parsing every bundle, and
+with sugar3.bundle.bundleindex.BundleIndex, cold and warm.
+
+Usage: python tests/benchmarks/bundleindex.py [activities]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.bundleindex import BundleIndex
+
+_LOCALES = ['de', 'es', 'fr', 'it', 'ja', 'pt', 'pt_BR', 'ru', 'sw', 'zh_CN']
+
+_INFO = """[Activity]
+name = Activity %(i)d
+bundle_id = org.sugarlabs.Activity%(i)d
+exec = sugar-activity activity.Activity
+icon = activity-icon
+activity_version = %(i)d.1
+mime_types = text/plain;image/png;application/pdf
+tags = Tag1;Tag2;Tag3
+summary = Summary of activity %(i)d
+"""
+
+
+def _make_bundles(directory, count):
+    for i in range(count):
+        bundle_path = os.path.join(directory, 'Activity%d.activity' % i)
+        os.makedirs(os.path.join(bundle_path, 'activity'))
+        with open(os.path.join(bundle_path, 'activity',
+                               'activity.info'), 'w') as f:
+            f.write(_INFO % {'i': i})
+        for locale in _LOCALES:
+            locale_path = os.path.join(bundle_path, 'locale', locale)
+            os.makedirs(locale_path)
+            with open(os.path.join(locale_path, 'activity.linfo'), 'w') as f:
+                f.write('[Activity]\nname = %s %d\nsummary = %s\n' %
+                        (locale, i, locale))
+
+
+def _parse_all(directory):
+    return [ActivityBundle(os.path.join(directory, name))
+            for name in sorted(os.listdir(directory))]
+
+
+def _run(label, enumerate_bundles):
+    start = time.time()
+    bundles = enumerate_bundles()
+    elapsed = time.time() - start
+    print '%-8s %8.1f ms %6d bundles' % (label, elapsed * 1000, len(bundles))
+
+
+def main():
+    count = 300
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        directory = os.path.join(temp_dir, 'Activities')
+        _make_bundles(directory, count)
+        index_path = os.path.join(temp_dir, 'index.json')
+        os.environ['LANGUAGE'] = 'pt_BR'
+
+        def indexed():
+            index = BundleIndex(index_path)
+            bundles = index.get_bundles(directory)
+            index.save()
+            return bundles
+
+        _run('parse', lambda: _parse_all(directory))
+        _run('cold', indexed)
+        _run('warm', indexed)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Install time and disk usage of several versions of a bundle that only
+differ by a few files, with and without the deduplicating object store.
+
+Usage: python tests/benchmarks/dedup.py [versions]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+from sugar3.bundle.bundle import Bundle, reclaim_trash
+from sugar3.bundle.objectstore import ObjectStore
+
+_FILES = 200
+_FILE_SIZE = 64 * 1024
+_CHANGED_FILES = 5
+
+
+def _make_bundles(directory, versions):
+    contents = [os.urandom(_FILE_SIZE) for i_ in range(_FILES)]
+    paths = []
+    for version in range(versions):
+        for i in range(_CHANGED_FILES):
+            contents[i] = os.urandom(_FILE_SIZE)
+        path = os.path.join(directory, 'Sample-%d.xo' % version)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f:
+            root = 'Sample%d.activity' % version
+            for i, content in enumerate(contents):
+                f.writestr('%s/file%d' % (root, i), content)
+        paths.append(path)
+    return paths
+
+
+def _get_disk_usage(path):
+    inodes = set()
+    size = 0
+    for root, dirs_, files in os.walk(path):
+        for name in files:
+            stat_result = os.lstat(os.path.join(root, name))
+            if stat_result.st_ino not in inodes:
+                inodes.add(stat_result.st_ino)
+                size += stat_result.st_blocks * 512
+    return size
+
+
+def _run(label, paths, install_dir, deduplicate):
+    os.makedirs(install_dir)
+    elapsed = 0
+    for path in paths:
+        bundle = Bundle(path)
+        bundle._unzip(install_dir, deduplicate)
+        elapsed += bundle.get_install_stats()['time']
+    usage = _get_disk_usage(os.path.dirname(install_dir))
+    print '%-8s %8.1f ms per install %8.1f MB on disk' % \
+        (label, elapsed * 1000 / len(paths), usage / 1024. / 1024)
+
+
+def main():
+    versions = 5
+    if len(sys.argv) > 1:
+        versions = int(sys.argv[1])
+
+    temp_dir = tempfile.mkdtemp()
+    os.environ['SUGAR_HOME'] = os.path.join(temp_dir, 'dedup', 'home')
+    try:
+        paths = _make_bundles(temp_dir, versions)
+        print '%d versions of %d files, %d changed in each' % \
+            (versions, _FILES, _CHANGED_FILES)
+        _run('plain', paths, os.path.join(temp_dir, 'plain', 'install'),
+             False)
+        _run('dedup', paths, os.path.join(temp_dir, 'dedup', 'install'),
+             True)
+
+        count, size, saved = ObjectStore().get_stats()
+        print '%d objects, %.1f MB saved' % (count, saved / 1024. / 1024)
+    finally:
+        reclaim_trash(wait=True)
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
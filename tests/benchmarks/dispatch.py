@@ -0,0 +1,72 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Benchmark connect, send and disconnect of sugar3.dispatch.Signal.
+
+Usage: python tests/benchmarks/dispatch.py [receivers ...]
+"""
+
+import sys
+import time
+
+from sugar3.dispatch import Signal
+
+
+class _Receiver(object):
+
+    def __call__(self, signal, sender, **kwargs):
+        pass
+
+
+def _report(label, count, elapsed):
+    print '  %-12s %10.1f ms total %10.3f us each' % \
+        (label, elapsed * 1000, elapsed * 1000000 / count)
+
+
+def run(count):
+    signal = Signal()
+    senders = [object() for i_ in range(10)]
+    receivers = [_Receiver() for i_ in range(count)]
+
+    print '%d receivers' % count
+
+    start = time.time()
+    for i, receiver in enumerate(receivers):
+        signal.connect(receiver, sender=senders[i % len(senders)])
+    _report('connect', count, time.time() - start)
+
+    sends = max(10, 100000 / count)
+    start = time.time()
+    for i in range(sends):
+        signal.send(senders[i % len(senders)])
+    _report('send', sends, time.time() - start)
+
+    start = time.time()
+    for i, receiver in enumerate(receivers):
+        signal.disconnect(receiver, sender=senders[i % len(senders)])
+    _report('disconnect', count, time.time() - start)
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 1000, 100000]
+    for count in counts:
+        run(count)
+
+
+if __name__ == '__main__':
+    main()
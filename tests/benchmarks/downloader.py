@@ -0,0 +1,125 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Throughput of sugar3.network.GlibURLDownloader against a local
+GlibTCPServer running in another process, and the time between the
+frames of a 60 Hz timeout of the downloading process, standing for the
+UI, while the download runs.
+
+Usage: python tests/benchmarks/downloader.py [megabytes]
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from gi.repository import GLib
+
+from sugar3 import network
+
+_FRAME_INTERVAL = 16
+
+
+def _serve(directory, port_queue):
+    os.chdir(directory)
+    server = network.GlibTCPServer(('127.0.0.1', 0),
+                                   network.ChunkedGlibHTTPRequestHandler)
+    port_queue.put(server.socket.getsockname()[1])
+    GLib.MainLoop().run()
+
+
+def _make_file(directory, size):
+    block = os.urandom(1024 * 1024)
+    with open(os.path.join(directory, 'object.bin'), 'wb') as f:
+        for i_ in range(size / len(block)):
+            f.write(block)
+
+
+def run(url, segments, size):
+    frames = []
+
+    def frame_cb():
+        frames.append(time.time())
+        return True
+
+    results = []
+    downloader = network.GlibURLDownloader(url)
+    downloader.SEGMENTS = segments
+    downloader.connect('finished', lambda downloader, path, name:
+                       results.append(path))
+    downloader.connect('error', lambda downloader, error:
+                       results.append(None))
+    progress = []
+    downloader.connect('progress', lambda downloader, written:
+                       progress.append(written))
+
+    context = GLib.MainContext.default()
+    frame_sid = GLib.timeout_add(_FRAME_INTERVAL, frame_cb)
+    start = time.time()
+    downloader.start()
+    while not results:
+        context.iteration(True)
+    elapsed = time.time() - start
+    GLib.source_remove(frame_sid)
+
+    if results[0] is None:
+        print '%d segments: failed' % segments
+        return
+    os.remove(results[0])
+
+    intervals = sorted((b - a) * 1000 for a, b in zip(frames, frames[1:]))
+    if not intervals:
+        intervals = [elapsed * 1000]
+    print '%d segments: %8.1f MB/s %6d progress signals' % \
+        (segments, size / elapsed / 1024 / 1024, len(progress))
+    print '            frames: median %.1f ms, 95%% %.1f ms, max %.1f ms' % \
+        (intervals[len(intervals) / 2],
+         intervals[int(len(intervals) * 0.95)], intervals[-1])
+
+
+def main():
+    megabytes = 200
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    size = megabytes * 1024 * 1024
+
+    directory = tempfile.mkdtemp()
+    server = None
+    try:
+        _make_file(directory, size)
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(directory, port_queue))
+        server.start()
+        url = 'http://127.0.0.1:%d/object.bin' % port_queue.get()
+
+        print 'Downloading %d MB' % megabytes
+        for segments in (1, 4):
+            run(url, segments, size)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Requests per second served by sugar3.network.GlibTCPServer and
+ChunkedGlibHTTPRequestHandler to concurrent clients fetching small
+files over keep-alive connections, with and without the memory cache,
+and with conditional requests.
+
+Usage: python tests/benchmarks/fileserver.py [clients] [requests]
+"""
+
+import httplib
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from gi.repository import GLib
+
+from sugar3 import network
+
+_FILES = 100
+
+
+class _UncachedHandler(network.ChunkedGlibHTTPRequestHandler):
+
+    CACHE_MAX_FILE_SIZE = 0
+
+
+def _serve(directory, handler_class, port_queue):
+    os.chdir(directory)
+    server = network.GlibTCPServer(('127.0.0.1', 0), handler_class)
+    port_queue.put(server.socket.getsockname()[1])
+    GLib.MainLoop().run()
+
+
+def _make_files(directory):
+    for i in range(_FILES):
+        size = random.randint(4, 64) * 1024
+        with open(os.path.join(directory, 'asset%d' % i), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def _client(port, requests, conditional, errors):
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    etags = {}
+    try:
+        for i_ in range(requests):
+            path = '/asset%d' % random.randrange(_FILES)
+            headers = {}
+            if conditional and path in etags:
+                headers['If-None-Match'] = etags[path]
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status not in (200, 304):
+                errors.append(response.status)
+            etags[path] = response.getheader('ETag')
+    except Exception, e:
+        errors.append(e)
+    finally:
+        connection.close()
+
+
+def run(label, directory, handler_class, clients, requests, conditional):
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve,
+                                     args=(directory, handler_class,
+                                           port_queue))
+    server.start()
+    try:
+        port = port_queue.get()
+        errors = []
+        threads = [threading.Thread(target=_client,
+                                    args=(port, requests, conditional,
+                                          errors))
+                   for i_ in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        server.terminate()
+        server.join()
+
+    print '%-12s %8.0f requests/s %6d errors' % \
+        (label, clients * requests / elapsed, len(errors))
+
+
+def main():
+    clients = 50
+    requests = 200
+    if len(sys.argv) > 1:
+        clients = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        requests = int(sys.argv[2])
+
+    directory = tempfile.mkdtemp()
+    try:
+        _make_files(directory)
+        print '%d clients, %d requests each' % (clients, requests)
+        run('uncached', directory, _UncachedHandler, clients, requests,
+            False)
+        run('cached', directory, network.ChunkedGlibHTTPRequestHandler,
+            clients, requests, False)
+        run('conditional', directory, network.ChunkedGlibHTTPRequestHandler,
+            clients, requests, True)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Loopback throughput of sugar3.network.ChunkedGlibHTTPRequestHandler,
+with sendfile() and with the read/write fallback.
+
+Usage: python tests/benchmarks/network.py [megabytes]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from gi.repository import GLib
+
+from sugar3 import network
+
+
+class _SendfileHandler(network.ChunkedGlibHTTPRequestHandler):
+
+    wakeups = 0
+
+    def _sendfile_next_chunk(self, source, condition):
+        _SendfileHandler.wakeups += 1
+        return network.ChunkedGlibHTTPRequestHandler._sendfile_next_chunk(
+            self, source, condition)
+
+
+class _ReadWriteHandler(network.ChunkedGlibHTTPRequestHandler):
+
+    USE_SENDFILE = False
+    wakeups = 0
+
+    def _send_next_chunk(self, source, condition):
+        _ReadWriteHandler.wakeups += 1
+        return network.ChunkedGlibHTTPRequestHandler._send_next_chunk(
+            self, source, condition)
+
+
+def _make_file(directory, size):
+    path = os.path.join(directory, 'object.bin')
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for i_ in range(size / len(block)):
+            f.write(block)
+    return path
+
+
+def _download(url, result):
+    response = urllib2.urlopen(url)
+    received = 0
+    while True:
+        data = response.read(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    result.append(received)
+
+
+def run(label, handler_class, size):
+    server = network.GlibTCPServer(('127.0.0.1', 0), handler_class)
+    port = server.socket.getsockname()[1]
+    url = 'http://127.0.0.1:%d/object.bin' % port
+
+    result = []
+    thread = threading.Thread(target=_download, args=(url, result))
+    context = GLib.MainContext.default()
+
+    start = time.time()
+    thread.start()
+    while thread.is_alive():
+        context.iteration(False) or time.sleep(0.0001)
+    elapsed = time.time() - start
+
+    if not result or result[0] != size:
+        print '%-12s failed' % label
+        return
+    print '%-12s %8.1f MB/s %8d main loop wakeups' % \
+        (label, size / elapsed / 1024 / 1024, handler_class.wakeups)
+
+
+def main():
+    megabytes = 200
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    size = megabytes * 1024 * 1024
+
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        _make_file(directory, size)
+        # SimpleHTTPRequestHandler serves the current directory
+        os.chdir(directory)
+        print 'Serving %d MB' % megabytes
+        run('read/write', _ReadWriteHandler, size)
+        run('sendfile', _SendfileHandler, size)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
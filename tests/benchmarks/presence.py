@@ -0,0 +1,250 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Benchmark sugar3.presence against the fake Telepathy stack of
+sugar3.test.fakepresence: sharing an activity, joining one with many
+buddies, resolving their contacts with and without batching,
+membership churn and tube throughput. No network is needed.
+
+Usage: python tests/benchmarks/presence.py [--buddies N] [--latency MS]
+"""
+
+import argparse
+import time
+
+from gi.repository import GLib
+import dbus.service
+from dbus.mainloop.glib import DBusGMainLoop
+from telepathy.interfaces import CHANNEL_INTERFACE_GROUP, \
+    CHANNEL_TYPE_TUBES
+
+from sugar3 import util
+from sugar3.presence import presenceservice
+from sugar3.presence.activity import Activity
+from sugar3.presence.buddy import Buddy
+from sugar3.presence.connectionmanager import get_connection_manager
+from sugar3.presence.tubechannel import MessageChannel
+from sugar3.presence.tubeconn import TubeConnection
+from sugar3.test.fakepresence import FakePresence, FAKE_ACTIVITY_ID
+
+_IFACE = 'org.laptop.Sugar.Benchmark'
+_PATH = '/org/laptop/Sugar/Benchmark'
+
+
+class _SignalSender(dbus.service.Object):
+
+    @dbus.service.signal(_IFACE, signature='s')
+    def Message(self, message):
+        pass
+
+
+def _wait(condition, timeout=120):
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError('Timed out')
+        context.iteration(False) or time.sleep(0.001)
+
+
+def _report(label, elapsed, calls=None):
+    line = '%-24s %10.1f ms' % (label, elapsed * 1000)
+    if calls is not None:
+        line += ' %6d D-Bus calls' % calls
+    print line
+
+
+def _count_calls(before, after, names=None):
+    total = 0
+    for name, count in after.items():
+        if name.startswith('tube-'):
+            continue
+        if names is None or name in names:
+            total += count - before.get(name, 0)
+    return total
+
+
+def run_share(control):
+    manager = get_connection_manager()
+    account_path, connection = manager.get_preferred_connection()
+    properties = {'id': util.unique_id(),
+                  'type': 'org.laptop.Benchmark',
+                  'name': 'Benchmark',
+                  'color': '#FF0000,#00FF00',
+                  'private': False}
+    activity = Activity(account_path, connection, properties=properties)
+
+    results = []
+    before = control.GetStats()
+    start = time.time()
+    activity.share(lambda activity: results.append(None),
+                   lambda activity, error: results.append(error))
+    _wait(lambda: results)
+    _report('share', time.time() - start,
+            _count_calls(before, control.GetStats()))
+    if results[0] is not None:
+        raise RuntimeError('Share failed: %s' % results[0])
+
+
+def run_join(control):
+    pservice = presenceservice.get_instance()
+
+    before = control.GetStats()
+    start = time.time()
+    activity = pservice.get_activity(FAKE_ACTIVITY_ID)
+    joined = []
+    activity.connect('joined', lambda activity, success, error:
+                     joined.append(success))
+    activity.join()
+    _wait(lambda: joined)
+    _report('join', time.time() - start)
+
+    buddies = activity.get_joined_buddies()
+    nicks = [buddy.props.nick for buddy in buddies]
+    _report('join with %d nicks' % len(nicks), time.time() - start,
+            _count_calls(before, control.GetStats()))
+    return activity
+
+
+def run_contacts(control, count):
+    # What joining an activity with count buddies costs in contact
+    # requests, with the batching of sugar3.presence.buddy and without
+    manager = get_connection_manager()
+    account_path, connection_ = manager.get_preferred_connection()
+    contact_ids = ['buddy%03d@fake' % i for i in range(count)]
+
+    for batched in (True, False):
+        before = control.GetStats()
+        start = time.time()
+        buddies = []
+        for contact_id in contact_ids:
+            buddy = Buddy(account_path, contact_id)
+            if not batched:
+                buddy._batch.flush()
+            buddies.append(buddy)
+        nicks = [buddy.props.nick for buddy in buddies]
+        if None in nicks:
+            raise RuntimeError('Some contacts were not resolved')
+        _report('%d contacts, %s' % (count, 'batched' if batched
+                                     else 'one by one'),
+                time.time() - start,
+                _count_calls(before, control.GetStats(),
+                             ['RequestHandles', 'GetContactAttributes']))
+
+
+def run_churn(control, activity, count):
+    left = []
+    joined = []
+    activity.connect('buddy-left', lambda activity, buddy: left.append(buddy))
+    activity.connect('buddy-joined',
+                     lambda activity, buddy: joined.append(buddy))
+
+    for round_ in range(2):
+        del left[:]
+        del joined[:]
+        before = control.GetStats()
+        start = time.time()
+        churned = control.Churn(count)
+        _wait(lambda: len(left) >= churned and len(joined) >= churned)
+        _report('churn of %d, round %d' % (churned, round_ + 1),
+                time.time() - start,
+                _count_calls(before, control.GetStats(),
+                             ['GetHandleOwners', 'InspectHandles']))
+
+
+def _wait_tube_messages(control, messages):
+    def done():
+        time.sleep(0.01)
+        return control.GetStats().get('tube-messages', 0) >= messages
+    _wait(done)
+
+
+def run_tube(control, activity, count):
+    tubes = activity.telepathy_tubes_chan[CHANNEL_TYPE_TUBES]
+    group = activity.telepathy_text_chan[CHANNEL_INTERFACE_GROUP]
+    tube_id = tubes.OfferDBusTube(_IFACE, {})
+    tube_conn = TubeConnection(activity.telepathy_conn, tubes, tube_id,
+                               group_iface=group)
+    _wait(lambda: tube_conn.participants)
+
+    messages = ['{"x": %d, "y": %d, "tool": "pen"}' % (i % 640, i % 480)
+                for i in range(count)]
+
+    sender = _SignalSender(tube_conn, _PATH)
+    base = control.GetStats().get('tube-messages', 0)
+    start = time.time()
+    for message in messages:
+        sender.Message(message)
+    _wait_tube_messages(control, base + count)
+    elapsed = time.time() - start
+    _report('tube, %d signals' % count, elapsed)
+    print '%-24s %10.0f messages/s' % ('', count / elapsed)
+
+    channel = MessageChannel(tube_conn, 'benchmark')
+    pending = list(reversed(messages))
+
+    def send_pending():
+        while pending and channel.send(pending[-1]):
+            pending.pop()
+        if not pending:
+            channel.flush()
+
+    def drained_cb(channel):
+        send_pending()
+
+    channel.connect('drained', drained_cb)
+
+    base = control.GetStats().get('tube-messages', 0)
+    start = time.time()
+    send_pending()
+    _wait(lambda: not pending)
+    _wait_tube_messages(control, base + channel.frames_sent)
+    elapsed = time.time() - start
+    _report('tube, message channel', elapsed)
+    print '%-24s %10.0f messages/s, %d frames, %d bytes' % \
+        ('', count / elapsed, channel.frames_sent, channel.bytes_sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark sugar3.presence on a fake Telepathy stack.')
+    parser.add_argument('--buddies', type=int, default=40)
+    parser.add_argument('--latency', type=int, default=5,
+                        help='Latency of the fake method calls, in ms')
+    parser.add_argument('--churn', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    presence = FakePresence(buddies=args.buddies, latency=args.latency)
+    presence.start()
+    try:
+        DBusGMainLoop(set_as_default=True)
+        control = presence.get_control()
+
+        print '%d buddies, %d ms latency' % (args.buddies, args.latency)
+        run_share(control)
+        activity = run_join(control)
+        run_contacts(control, args.buddies)
+        run_churn(control, activity, args.churn)
+        run_tube(control, activity, args.messages)
+    finally:
+        presence.stop()
+
+
+if __name__ == '__main__':
+    main()
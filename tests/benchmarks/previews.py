@@ -0,0 +1,83 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Benchmark the rendering of journal thumbnails, with and without the
+preview mips stored by Activity.save().
+
+Usage: python tests/benchmarks/previews.py [count]
+"""
+
+import sys
+import time
+import StringIO
+
+import cairo
+
+from sugar3.activity.activity import PREVIEW_SIZE, PREVIEW_MIP_SIZES
+from sugar3.activity.activity import pack_preview_mips
+from sugar3.graphics.objectchooser import get_preview_pixbuf
+from sugar3.graphics.objectchooser import get_preview_pixbuf_from_metadata
+
+
+def _make_png(width, height):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(0.9, 0.9, 0.9)
+    cr.paint()
+    for i in range(0, width, 8):
+        cr.set_source_rgb(i * 1.0 / width, 0.3, 1 - i * 1.0 / width)
+        cr.move_to(i, 0)
+        cr.line_to(width - i, height)
+        cr.stroke()
+    data = StringIO.StringIO()
+    surface.write_to_png(data)
+    return data.getvalue()
+
+
+def _run(label, count, render):
+    start = time.time()
+    for i_ in range(count):
+        render()
+    elapsed = time.time() - start
+    print '%-16s %8.1f ms total %8.3f ms per thumbnail' % \
+        (label, elapsed * 1000, elapsed * 1000 / count)
+
+
+def main():
+    count = 1000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    previews = [(width, height, _make_png(width, height))
+                for width, height in PREVIEW_MIP_SIZES
+                if (width, height) != PREVIEW_SIZE]
+    plain = {'preview': _make_png(*PREVIEW_SIZE)}
+    mips = {'preview': plain['preview'],
+            'preview-mips': pack_preview_mips(previews)}
+
+    print 'Rendering %d thumbnails' % count
+    for width, height in PREVIEW_MIP_SIZES:
+        print '%dx%d' % (width, height)
+        _run('  without mips', count,
+             lambda: get_preview_pixbuf(plain['preview'], width, height))
+        _run('  with mips', count,
+             lambda: get_preview_pixbuf_from_metadata(mips, width, height))
+
+
+if __name__ == '__main__':
+    main()
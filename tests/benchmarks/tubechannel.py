@@ -0,0 +1,158 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Loopback benchmark of sugar3.presence.tubechannel.MessageChannel.
+
+Two connections to a private dbus-daemon stand for two participants of a
+tube. The same stream of small messages is sent once with one D-Bus
+signal per message, as activities usually do, and once through message
+channels.
+
+Usage: python tests/benchmarks/tubechannel.py [messages]
+"""
+
+import subprocess
+import sys
+import time
+import json
+
+from gi.repository import GLib
+import dbus
+import dbus.bus
+import dbus.service
+from dbus.mainloop.glib import DBusGMainLoop
+
+from sugar3.presence.tubechannel import MessageChannel
+from sugar3.presence.tubechannel import MESSAGE_CHANNEL_PATH
+
+_IFACE = 'org.laptop.Sugar.Benchmark'
+_PATH = '/org/laptop/Sugar/Benchmark'
+
+
+class _SignalSender(dbus.service.Object):
+
+    @dbus.service.signal(_IFACE, signature='s')
+    def Message(self, message):
+        pass
+
+
+def _start_bus():
+    process = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                                '--print-address'],
+                               stdout=subprocess.PIPE)
+    address = process.stdout.readline().strip()
+    return process, address
+
+
+def _connect(address):
+    connection = dbus.bus.BusConnection(address)
+    connection.participants = {}
+    connection.bus_name_to_handle = {}
+    return connection
+
+
+def _make_messages(count):
+    return [json.dumps({'x': i % 640, 'y': i % 480, 'color': '#FF8F00',
+                        'tool': 'pen', 'seq': i})
+            for i in range(count)]
+
+
+def _wait(condition, timeout=60):
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        context.iteration(True)
+
+
+def _report(label, count, elapsed, wire_bytes):
+    print '%-16s %10.0f messages/s %12d bytes' % \
+        (label, count / elapsed, wire_bytes)
+
+
+def run_signals(sender, receiver, messages):
+    received = []
+    receiver.add_signal_receiver(received.append, 'Message', _IFACE,
+                                 path=_PATH)
+    sender_object = _SignalSender(sender, _PATH)
+
+    start = time.time()
+    for message in messages:
+        sender_object.Message(message)
+    _wait(lambda: len(received) == len(messages))
+    elapsed = time.time() - start
+
+    # Rough size of a D-Bus signal carrying the message: fixed header,
+    # path, interface, member, sender and signature fields, and the body
+    overhead = 16 + len(_PATH) + len(_IFACE) + len('Message') + 48
+    wire_bytes = sum(overhead + len(message) + 5 for message in messages)
+    _report('signals', len(received), elapsed, wire_bytes)
+
+
+def run_channel(sender, receiver, messages):
+    received = []
+    sender_channel = MessageChannel(sender, 'benchmark')
+    receiver_channel = MessageChannel(receiver, 'benchmark')
+    receiver_channel.connect('message-received',
+                             lambda channel, handle, message:
+                             received.append(message))
+
+    def drained_cb(channel):
+        send_pending()
+
+    pending = list(reversed(messages))
+
+    def send_pending():
+        while pending:
+            if not sender_channel.send(pending[-1]):
+                return
+            pending.pop()
+
+    sender_channel.connect('drained', drained_cb)
+
+    start = time.time()
+    send_pending()
+    _wait(lambda: len(received) == len(messages))
+    elapsed = time.time() - start
+
+    overhead = 16 + len(MESSAGE_CHANNEL_PATH + '/benchmark') + \
+        len('Frame') + 64
+    wire_bytes = sender_channel.bytes_sent + \
+        overhead * sender_channel.frames_sent
+    _report('channel', len(received), elapsed, wire_bytes)
+    print '%-16s %10d frames' % ('', sender_channel.frames_sent)
+
+
+def main():
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    DBusGMainLoop(set_as_default=True)
+    process, address = _start_bus()
+    try:
+        messages = _make_messages(count)
+        print 'Sending %d messages' % count
+        run_signals(_connect(address), _connect(address), messages)
+        run_channel(_connect(address), _connect(address), messages)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Time the caller of an uninstall is blocked for, removing a large bundle
+tree in place and moving it to the trash with sugar3.bundle.bundle.
+
+Usage: python tests/benchmarks/uninstall.py [files]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sugar3.bundle import bundle
+
+
+def _make_tree(path, count):
+    data = os.urandom(16 * 1024)
+    for i in range(count):
+        directory = os.path.join(path, 'dir%d' % (i / 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file%d' % i), 'wb') as f:
+            f.write(data)
+
+
+def _run(label, remove, path):
+    start = time.time()
+    remove(path)
+    elapsed = time.time() - start
+    print '%-8s %8.1f ms blocked' % (label, elapsed * 1000)
+
+
+def main():
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    temp_dir = tempfile.mkdtemp()
+    os.environ['SUGAR_HOME'] = temp_dir
+    try:
+        path = os.path.join(temp_dir, 'Large.activity')
+        print 'Removing %d files' % count
+
+        _make_tree(path, count)
+        _run('rmtree', shutil.rmtree, path)
+
+        _make_tree(path, count)
+        _run('trash', bundle.move_to_trash, path)
+
+        start = time.time()
+        bundle.reclaim_trash(wait=True)
+        print '%-8s %8.1f ms in the background' % \
+            ('reclaim', (time.time() - start) * 1000)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
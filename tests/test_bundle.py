@@ -15,12 +15,20 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import json
+import shutil
+import tempfile
 import unittest
+import zipfile
 import subprocess
 
+from sugar3.bundle.bundle import Bundle, ZipExtractException
+from sugar3.bundle.bundle import move_to_trash, reclaim_trash
 from sugar3.bundle.helpers import bundle_from_dir, bundle_from_archive
-from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.activitybundle import ActivityBundle, batch_install
+from sugar3.bundle.bundleindex import BundleIndex
 from sugar3.bundle.contentbundle import ContentBundle
+from sugar3.bundle.objectstore import ObjectStore
 
 tests_dir = os.path.dirname(__file__)
 data_dir = os.path.join(tests_dir, "data")
@@ -29,6 +37,24 @@ SAMPLE_CONTENT_PATH = os.path.join(data_dir, 'sample.content')
 
 
 class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the profile and the install directories of the user out of
+        # reach of the trash
+        self._environ = dict(os.environ)
+        self._home_dir = tempfile.mkdtemp()
+        os.environ['SUGAR_HOME'] = self._home_dir
+        os.environ['SUGAR_ACTIVITIES_PATH'] = os.path.join(self._home_dir,
+                                                           'Activities')
+        os.environ['SUGAR_LIBRARY_PATH'] = os.path.join(self._home_dir,
+                                                        'Library')
+
+    def tearDown(self):
+        reclaim_trash(wait=True)
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self._home_dir)
+
     def test_bundle_from_dir(self):
         bundle = bundle_from_dir(SAMPLE_ACTIVITY_PATH)
         self.assertIsInstance(bundle, ActivityBundle)
@@ -47,3 +73,262 @@ class TestBundle(unittest.TestCase):
         subprocess.check_call(["zip", "-r", "sample-1.xol", "sample.content"])
         bundle = bundle_from_archive("./sample-1.xol")
         self.assertIsInstance(bundle, ContentBundle)
+
+    def test_activity_bundle_info_record(self):
+        bundle = ActivityBundle(SAMPLE_ACTIVITY_PATH)
+        record = json.loads(json.dumps(bundle.get_info_record()))
+        cached = ActivityBundle(SAMPLE_ACTIVITY_PATH, info_record=record)
+        self.assertEqual(cached.get_bundle_id(), bundle.get_bundle_id())
+        self.assertEqual(cached.get_name(), bundle.get_name())
+        self.assertEqual(cached.get_activity_version(),
+                         bundle.get_activity_version())
+        self.assertEqual(cached.get_command(), bundle.get_command())
+
+        record['mtime'] = 0
+        self.assertFalse(cached._load_info_record(record, True))
+
+    def test_zip_bundle_members(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'sample.zip')
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f:
+                f.writestr('mimetype', 'application/zip')
+                f.writestr('sample/a/b/data.txt', 'x' * 100000)
+                f.writestr('sample/c/', '')
+            bundle = Bundle(path)
+
+            self.assertEqual(bundle.get_file('a/b/data.txt').read(),
+                             'x' * 100000)
+            self.assertIsNone(bundle.get_file('a/missing.txt'))
+            self.assertTrue(bundle.is_file('a/b/data.txt'))
+            self.assertFalse(bundle.is_file('a/b'))
+            for directory in ('a', 'a/', 'a/b', 'c'):
+                self.assertTrue(bundle.is_dir(directory))
+            for directory in ('a/b/data.txt', 'b', 'a/c'):
+                self.assertFalse(bundle.is_dir(directory))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_zip_bundle_unzip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'sample.zip')
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f:
+                info = zipfile.ZipInfo('sample/bin/run')
+                info.external_attr = 0100755 << 16
+                f.writestr(info, '#!/bin/sh\n')
+                f.writestr('sample/data', 'x' * 2 * 1024 * 1024)
+            install_dir = os.path.join(temp_dir, 'install')
+            install_path = os.path.join(install_dir, 'sample')
+            os.makedirs(install_path)
+            open(os.path.join(install_path, 'stale'), 'w').close()
+
+            Bundle(path)._unzip(install_dir)
+
+            self.assertEqual(os.listdir(install_dir), ['sample'])
+            self.assertEqual(sorted(os.listdir(install_path)),
+                             ['bin', 'data'])
+            run_path = os.path.join(install_path, 'bin', 'run')
+            self.assertEqual(os.stat(run_path).st_mode & 0777, 0755)
+            self.assertEqual(
+                os.path.getsize(os.path.join(install_path, 'data')),
+                2 * 1024 * 1024)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_zip_bundle_symlink_chain(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'evil.zip')
+            with zipfile.ZipFile(path, 'w') as f:
+                for name, target in (('Evil.activity/a/b', '..'),
+                                     ('Evil.activity/c',
+                                      'a/b/a/b/../../..')):
+                    info = zipfile.ZipInfo(name)
+                    info.external_attr = 0120777 << 16
+                    f.writestr(info, target)
+                f.writestr('Evil.activity/c/escaped.txt', 'escaped')
+            install_dir = os.path.join(temp_dir, 'a', 'b', 'install')
+            os.makedirs(install_dir)
+
+            self.assertRaises(ZipExtractException, Bundle(path)._unzip,
+                              install_dir)
+            for dir_path, dir_names_, file_names in os.walk(temp_dir):
+                self.assertNotIn('escaped.txt', file_names)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_zip_bundle_corrupt(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'corrupt.zip')
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f:
+                f.writestr('sample/data', 'x' * 100000)
+                info = f.getinfo('sample/data')
+            # Make the deflate data invalid
+            with open(path, 'r+b') as f:
+                f.seek(info.header_offset + 30 + len(info.filename))
+                f.write('\xff' * 16)
+
+            self.assertRaises(ZipExtractException, Bundle(path)._unzip,
+                              os.path.join(temp_dir, 'install'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_bundle_index(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            activities_dir = os.path.join(temp_dir, 'Activities')
+            bundle_path = os.path.join(activities_dir, 'sample.activity')
+            # Leave out what test_activity_bundle_from_archive generates
+            shutil.copytree(SAMPLE_ACTIVITY_PATH, bundle_path,
+                            ignore=shutil.ignore_patterns('locale', 'dist'))
+            linfo_dir = os.path.join(bundle_path, 'locale', 'es')
+            os.makedirs(linfo_dir)
+            linfo_path = os.path.join(linfo_dir, 'activity.linfo')
+            with open(linfo_path, 'w') as f:
+                f.write('[Activity]\nname = Muestra\n')
+            index_path = os.path.join(temp_dir, 'index.json')
+
+            os.environ['LANGUAGE'] = 'es'
+            index = BundleIndex(index_path)
+            bundles = index.get_bundles(activities_dir)
+            self.assertEqual([b.get_name() for b in bundles], ['Muestra'])
+            index.save()
+
+            os.environ['LANGUAGE'] = 'C'
+            index = BundleIndex(index_path)
+            bundle = index.get_bundle(bundle_path)
+            self.assertEqual(bundle._languages, '*')
+            self.assertEqual(bundle.get_name(), 'Sample')
+
+            # An edited activity.linfo invalidates the entry
+            with open(linfo_path, 'w') as f:
+                f.write('[Activity]\nname = Ejemplo\n')
+            mtime = os.stat(linfo_path).st_mtime + 1
+            os.utime(linfo_path, (mtime, mtime))
+            os.environ['LANGUAGE'] = 'es'
+            bundle = index.get_bundle(bundle_path)
+            self.assertEqual(bundle.get_name(), 'Ejemplo')
+
+            shutil.rmtree(bundle_path)
+            self.assertEqual(index.get_bundles(activities_dir), [])
+            index.save()
+            self.assertEqual(BundleIndex(index_path)._records, {})
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_batch_install(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            bin_dir = os.path.join(temp_dir, 'bin')
+            os.makedirs(bin_dir)
+            log_path = os.path.join(temp_dir, 'updates')
+            script_path = os.path.join(bin_dir, 'update-mime-database')
+            with open(script_path, 'w') as f:
+                f.write('#!/bin/sh\necho "$1" >> %s\n' % log_path)
+            os.chmod(script_path, 0755)
+            os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+            os.environ['XDG_DATA_HOME'] = os.path.join(temp_dir, 'data')
+
+            bundles = []
+            for i in range(3):
+                path = os.path.join(temp_dir, 'sample%d.activity' % i)
+                shutil.copytree(SAMPLE_ACTIVITY_PATH, path)
+                with open(os.path.join(path, 'activity',
+                                       'mimetypes.xml'), 'w') as f:
+                    f.write('<mime-info/>\n')
+                bundle = ActivityBundle(path)
+                bundle._bundle_id += str(i)
+                bundles.append(bundle)
+
+            results = []
+            with batch_install():
+                for bundle in bundles:
+                    bundle.install_mime_type(bundle.get_path())
+                with batch_install(results.append):
+                    bundles[0].uninstall()
+                packages_dir = os.path.join(temp_dir, 'data', 'mime',
+                                            'packages')
+                self.assertEqual(os.listdir(packages_dir), [])
+
+            self.assertEqual(results, [True])
+            self.assertEqual(sorted(os.listdir(packages_dir)),
+                             ['org.sugarlabs.Sample1.xml',
+                              'org.sugarlabs.Sample2.xml'])
+            with open(log_path) as f:
+                self.assertEqual(len(f.readlines()), 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_trash(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            activities_path = os.environ['SUGAR_ACTIVITIES_PATH']
+            trash_path = os.path.join(self._home_dir, 'default', 'trash')
+            path = os.path.join(temp_dir, 'sample.activity')
+            shutil.copytree(SAMPLE_ACTIVITY_PATH, path)
+
+            move_to_trash(path)
+            self.assertFalse(os.path.exists(path))
+
+            # Left over by an interrupted session
+            leftover = os.path.join(trash_path, 'leftover')
+            shutil.copytree(SAMPLE_ACTIVITY_PATH,
+                            os.path.join(leftover, 'sample.activity'))
+            # Interrupted extractions, only the old ones are collected,
+            # not the directories of the user
+            for name, age in (('.sugar-install-2ab_c9', 7200),
+                              ('.sugar-trash-q1w2e3', 7200),
+                              ('.sugar-install-xyz123', 0),
+                              ('.notes-backup', 7200),
+                              ('.hidden', 7200)):
+                leftover = os.path.join(activities_path, name)
+                os.makedirs(os.path.join(leftover, 'sample.activity'))
+                mtime = os.stat(leftover).st_mtime - age
+                os.utime(leftover, (mtime, mtime))
+
+            reclaim_trash(wait=True)
+            self.assertEqual(os.listdir(trash_path), [])
+            self.assertEqual(sorted(os.listdir(activities_path)),
+                             ['.hidden', '.notes-backup',
+                              '.sugar-install-xyz123'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deduplicated_install(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shared = os.urandom(2 * 1024 * 1024)
+            paths = []
+            for version in (1, 2):
+                path = os.path.join(temp_dir, 'sample-%d.zip' % version)
+                with zipfile.ZipFile(path, 'w') as f:
+                    f.writestr('sample%d/shared' % version, shared)
+                    f.writestr('sample%d/small' % version, 'same')
+                    f.writestr('sample%d/version' % version, str(version))
+                paths.append(path)
+            install_dir = os.path.join(temp_dir, 'install')
+
+            bundles = [Bundle(zip_path) for zip_path in paths]
+            for bundle in bundles:
+                bundle._unzip(install_dir, deduplicate=True)
+
+            stats = bundles[1].get_install_stats()
+            self.assertEqual(stats['files'], 3)
+            self.assertEqual(stats['deduplicated_files'], 2)
+            self.assertEqual(stats['deduplicated_size'], len(shared) + 4)
+            shared_path = os.path.join(install_dir, 'sample2', 'shared')
+            self.assertEqual(os.stat(shared_path).st_nlink, 3)
+            with open(shared_path) as f:
+                self.assertEqual(f.read(), shared)
+
+            store = ObjectStore()
+            self.assertEqual(store.get_stats(), (4, len(shared) + 6,
+                                                 len(shared) + 4))
+
+            bundles[0]._uninstall(os.path.join(install_dir, 'sample1'))
+            reclaim_trash(wait=True)
+            self.assertEqual(store.get_stats(), (3, len(shared) + 5, 0))
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,141 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gc
+import unittest
+
+from sugar3.dispatch import Signal
+
+
+class _Receiver(object):
+
+    def __init__(self, calls):
+        self._calls = calls
+
+    def __call__(self, signal, sender, **kwargs):
+        self._calls.append(self)
+
+    def method(self, signal, sender, **kwargs):
+        self._calls.append(self)
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.signal = Signal()
+        self.calls = []
+
+    def test_send_order(self):
+        sender = object()
+        first = _Receiver(self.calls)
+        second = _Receiver(self.calls)
+        third = _Receiver(self.calls)
+        self.signal.connect(first)
+        self.signal.connect(second, sender=sender)
+        self.signal.connect(third)
+
+        self.signal.send(sender)
+        self.assertEqual(self.calls, [first, second, third])
+
+        del self.calls[:]
+        self.signal.send(None)
+        self.assertEqual(self.calls, [first, third])
+
+    def test_connect_twice(self):
+        receiver = _Receiver(self.calls)
+        self.signal.connect(receiver)
+        self.signal.connect(receiver)
+        self.signal.send(None)
+        self.assertEqual(self.calls, [receiver])
+        self.assertEqual(len(self.signal.receivers), 1)
+
+    def test_disconnect(self):
+        receiver = _Receiver(self.calls)
+        other = _Receiver(self.calls)
+        self.signal.connect(receiver)
+        self.signal.connect(other.method, dispatch_uid='other')
+        self.signal.send(None)
+
+        self.signal.disconnect(receiver)
+        self.signal.disconnect(dispatch_uid='other')
+        self.signal.send(None)
+        self.assertEqual(self.calls, [receiver, other])
+        self.assertEqual(self.signal.receivers, [])
+
+    def test_dead_receivers(self):
+        receiver = _Receiver(self.calls)
+        method_receiver = _Receiver(self.calls)
+        strong = _Receiver(self.calls)
+        self.signal.connect(receiver)
+        self.signal.connect(method_receiver.method)
+        self.signal.connect(strong, weak=False)
+        self.signal.send(None)
+
+        del self.calls[:]
+        del receiver, method_receiver
+        gc.collect()
+        self.assertEqual(len(self.signal.receivers), 1)
+
+        self.signal.send(None)
+        self.assertEqual(self.calls, [strong])
+
+    def test_send_deferred(self):
+        from gi.repository import GLib
+
+        signal = Signal(coalesce_key='object_id')
+        received = []
+
+        def receiver(signal, sender, object_id, value):
+            received.append((object_id, value))
+
+        signal.connect(receiver)
+        signal.send_deferred(None, object_id='a', value=1)
+        signal.send_deferred(None, object_id='b', value=2)
+        signal.send_deferred(None, object_id='a', value=3)
+        self.assertEqual(received, [])
+
+        context = GLib.MainContext.default()
+        while context.pending():
+            context.iteration(False)
+
+        self.assertEqual(received, [('a', 3), ('b', 2)])
+        self.assertEqual(signal.deferred_count, 3)
+        self.assertEqual(signal.coalesced_count, 1)
+        self.assertEqual(signal.flushed_count, 2)
+
+    def test_cancel_deferred(self):
+        signal = Signal(coalesce_key='object_id')
+        received = []
+
+        def receiver(signal, sender, object_id):
+            received.append(object_id)
+
+        signal.connect(receiver)
+        signal.send_deferred(None, object_id='a')
+        signal.send_deferred(None, object_id='b')
+        # Unhashable keys are delivered without being merged
+        signal.send_deferred(None, object_id=['c'])
+        signal.send_deferred(None, object_id=['c'])
+        self.assertTrue(signal.cancel_deferred(None, 'a'))
+        self.assertFalse(signal.cancel_deferred(None, 'a'))
+        self.assertFalse(signal.cancel_deferred(None, ['c']))
+        signal.flush_deferred()
+
+        self.assertEqual(received, ['b', ['c'], ['c']])
+
+
+if __name__ == '__main__':
+    unittest.main()
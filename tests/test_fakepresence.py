@@ -0,0 +1,74 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+import dbus
+import dbus.bus
+from telepathy.interfaces import CHANNEL_INTERFACE_GROUP, \
+    CHANNEL_TYPE_TEXT, \
+    CONNECTION
+from telepathy.constants import HANDLE_TYPE_CONTACT, \
+    HANDLE_TYPE_ROOM
+
+from sugar3.test.fakepresence import FakePresence, FAKE_ACTIVITY_ID, \
+    CONNECTION_PATH, CONNECTION_SERVICE, \
+    CONN_INTERFACE_ACTIVITY_PROPERTIES, \
+    FAKE_PRESENCE_INTERFACE, FAKE_PRESENCE_PATH
+
+
+class TestFakePresence(unittest.TestCase):
+
+    def setUp(self):
+        self._presence = FakePresence(buddies=5)
+        self._presence.start()
+        # Not dbus.SessionBus(), it may be connected to another bus
+        self._bus = dbus.bus.BusConnection(self._presence.address)
+
+    def tearDown(self):
+        self._bus.close()
+        self._presence.stop()
+
+    def test_join(self):
+        connection = self._bus.get_object(CONNECTION_SERVICE,
+                                          CONNECTION_PATH)
+        room_handle = connection.GetActivity(
+            FAKE_ACTIVITY_ID,
+            dbus_interface=CONN_INTERFACE_ACTIVITY_PROPERTIES)
+        channel_path = connection.RequestChannel(
+            CHANNEL_TYPE_TEXT, HANDLE_TYPE_ROOM, room_handle, True,
+            dbus_interface=CONNECTION)
+        channel = self._bus.get_object(CONNECTION_SERVICE, channel_path)
+
+        members, local_pending_, remote_pending_ = channel.GetAllMembers(
+            dbus_interface=CHANNEL_INTERFACE_GROUP)
+        contact_ids = connection.InspectHandles(
+            HANDLE_TYPE_CONTACT, members, dbus_interface=CONNECTION)
+        self.assertEqual(sorted(contact_ids),
+                         ['buddy%03d@fake' % i for i in range(5)])
+
+        control = dbus.Interface(
+            self._bus.get_object(FAKE_PRESENCE_INTERFACE,
+                                 FAKE_PRESENCE_PATH),
+            FAKE_PRESENCE_INTERFACE)
+        self.assertEqual(control.Churn(2), 2)
+        stats = control.GetStats()
+        self.assertEqual(stats['GetActivity'], 1)
+        self.assertEqual(stats['GetAllMembers'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
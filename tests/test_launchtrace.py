@@ -0,0 +1,122 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from sugar3.activity import launchtrace
+
+
+class TestLaunchTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.trace_dir = tempfile.mkdtemp()
+        self._old_value = os.environ.get(launchtrace.TRACE_ENV)
+        os.environ[launchtrace.TRACE_ENV] = self.trace_dir
+
+    def tearDown(self):
+        if self._old_value is None:
+            del os.environ[launchtrace.TRACE_ENV]
+        else:
+            os.environ[launchtrace.TRACE_ENV] = self._old_value
+        shutil.rmtree(self.trace_dir)
+
+    def _read_events(self, trace, pid=None):
+        name = '%s.%d.events' % (trace.launch_id, pid or os.getpid())
+        with open(os.path.join(self.trace_dir, name)) as f:
+            return [json.loads(line) for line in f]
+
+    def _read_merged(self, trace):
+        with open(os.path.join(self.trace_dir,
+                               trace.launch_id + '.json')) as f:
+            return json.load(f)
+
+    def test_spans(self):
+        trace = launchtrace.LaunchTrace()
+        trace.begin('load', bundle='org.laptop.Test')
+        trace.mark('window-shown')
+        trace.end('load')
+        with trace.span('datastore'):
+            pass
+        # Not begun, ignored
+        trace.end('unknown')
+        trace.flush()
+
+        events = self._read_events(trace)
+        self.assertEqual([(event['name'], event['ph']) for event in events],
+                         [('window-shown', 'i'), ('load', 'X'),
+                          ('datastore', 'X')])
+        load = events[1]
+        self.assertEqual(load['args'], {'bundle': 'org.laptop.Test'})
+        self.assertTrue(load['ts'] <= events[0]['ts'])
+        self.assertTrue(load['ts'] + load['dur'] >= events[0]['ts'])
+        for event in events:
+            self.assertEqual(event['pid'], os.getpid())
+            self.assertEqual(event['cat'], 'launch')
+
+    def test_process_name_written_once(self):
+        trace = launchtrace.LaunchTrace(process_name='activity')
+        trace.mark('first')
+        trace.flush()
+        trace.mark('second')
+        trace.flush()
+
+        events = self._read_events(trace)
+        metadata = [event for event in events if event['ph'] == 'M']
+        self.assertEqual(len(metadata), 1)
+        self.assertEqual(metadata[0]['name'], 'process_name')
+        self.assertEqual(metadata[0]['args'], {'name': 'activity'})
+        self.assertEqual(len(events), 3)
+
+    def test_merge(self):
+        launch_id = 'launch'
+        pid = os.fork()
+        if pid == 0:
+            try:
+                trace = launchtrace.LaunchTrace(launch_id, 'shell')
+                trace.mark('launch-requested')
+                trace.flush()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        trace = launchtrace.LaunchTrace(launch_id, 'activity')
+        with trace.span('startup'):
+            pass
+        trace.flush()
+
+        self.assertEqual(len(self._read_events(trace, pid)), 2)
+        merged = self._read_merged(trace)
+        self.assertEqual(merged['otherData'], {'launch_id': launch_id})
+        events = merged['traceEvents']
+        self.assertEqual(sorted(event['name'] for event in events),
+                         ['launch-requested', 'process_name',
+                          'process_name', 'startup'])
+        self.assertEqual(set(event['pid'] for event in events),
+                         set([pid, os.getpid()]))
+        timestamps = [event.get('ts', 0) for event in events]
+        self.assertEqual(timestamps, sorted(timestamps))
+        # Only the merged trace and the events files are left
+        self.assertEqual(sorted(os.listdir(self.trace_dir)),
+                         sorted(['launch.json', 'launch.%d.events' % pid,
+                                 'launch.%d.events' % os.getpid()]))
+
+
+if __name__ == '__main__':
+    unittest.main()
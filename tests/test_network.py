@@ -0,0 +1,487 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import socket
+import httplib
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from gi.repository import GObject
+
+from sugar3 import network
+
+
+class _Handler(network.ChunkedGlibHTTPRequestHandler):
+
+    root_dir = None
+    # The status of every response is appended to it, if not None
+    statuses = None
+
+    def translate_path(self, path):
+        return os.path.join(self.root_dir, path.split('?')[0].lstrip('/'))
+
+    def send_response(self, code, message=None):
+        if self.statuses is not None:
+            self.statuses.append(code)
+        network.ChunkedGlibHTTPRequestHandler.send_response(self, code,
+                                                            message)
+
+
+class _ServerTestCase(unittest.TestCase):
+    """Serve files of a temporary directory from the main loop"""
+
+    def setUp(self):
+        GObject.threads_init()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def start_server(self, **attributes):
+        """Return the port of a new GlibTCPServer
+
+        attributes -- class attributes of its request handler
+        """
+        attributes['root_dir'] = self.temp_dir
+        handler_class = type('Handler', (_Handler, ), attributes)
+        server = network.GlibTCPServer(('127.0.0.1', 0), handler_class)
+        self.addCleanup(server.server_close)
+        return server.server_address[1]
+
+    def write_file(self, name, data):
+        with open(os.path.join(self.temp_dir, name), 'wb') as f:
+            f.write(data)
+
+    def run_client(self, client, *args):
+        """Call client in a thread while the main loop runs
+
+        Returns what it returns, raises what it raises.
+        """
+        loop = GObject.MainLoop()
+        result = []
+
+        def run():
+            try:
+                result.append((client(*args), None))
+            except Exception:
+                result.append((None, sys.exc_info()))
+            GObject.idle_add(loop.quit)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.run_main_loop(loop)
+
+        value, exc_info = result[0]
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
+
+    def run_main_loop(self, loop, timeout=30):
+        """Run loop until it is quit, fail if it takes timeout seconds"""
+        timed_out = []
+
+        def timeout_cb():
+            timed_out.append(True)
+            loop.quit()
+            return False
+
+        timeout_sid = GObject.timeout_add_seconds(timeout, timeout_cb)
+        loop.run()
+        if timed_out:
+            self.fail('Timed out')
+        GObject.source_remove(timeout_sid)
+
+
+class TestRanges(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(network._parse_range('bytes=0-99', 1000), (0, 100))
+        self.assertEqual(network._parse_range('bytes=100-', 1000),
+                         (100, 1000))
+        self.assertEqual(network._parse_range('bytes=-10', 1000),
+                         (990, 1000))
+        self.assertEqual(network._parse_range('bytes=990-5000', 1000),
+                         (990, 1000))
+
+    def test_parse_range_ignored(self):
+        for value in ('bytes=5-2', 'bytes=0-1,3-4', 'items=0-1',
+                      'bytes=abc', 'bytes=-'):
+            self.assertIsNone(network._parse_range(value, 1000))
+
+    def test_parse_range_unsatisfiable(self):
+        self.assertRaises(ValueError, network._parse_range,
+                          'bytes=1000-', 1000)
+        self.assertRaises(ValueError, network._parse_range, 'bytes=-0', 1000)
+
+    def test_parse_content_range(self):
+        self.assertEqual(network._parse_content_range('bytes 100-999/1000'),
+                         (100, 1000, 1000))
+        self.assertEqual(network._parse_content_range('bytes */1000'),
+                         (None, None, 1000))
+        self.assertEqual(network._parse_content_range('bytes 0-9/*'),
+                         (0, 10, None))
+
+
+class TestEtag(unittest.TestCase):
+
+    def test_etag_changes(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'file')
+            with open(path, 'w') as f:
+                f.write('a')
+            os.utime(path, (1000.25, 1000.25))
+            etag = network._get_etag(os.stat(path))
+            self.assertEqual(etag, network._get_etag(os.stat(path)))
+
+            # Rewritten within the same second, at the same size
+            with open(path, 'w') as f:
+                f.write('b')
+            os.utime(path, (1000.5, 1000.5))
+            self.assertNotEqual(etag, network._get_etag(os.stat(path)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+def _get(port, name):
+    url = 'http://127.0.0.1:%d/%s' % (port, name)
+    return urllib2.urlopen(url).read()
+
+
+def _get_status(port, name, headers):
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', '/' + name, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+class TestFileServer(_ServerTestCase):
+
+    def test_large_file(self):
+        data = os.urandom(3 * 1024 * 1024 + 1234)
+        self.write_file('large', data)
+        for use_sendfile in (True, False):
+            port = self.start_server(USE_SENDFILE=use_sendfile)
+            self.assertEqual(self.run_client(_get, port, 'large'), data)
+
+    def test_cached_file(self):
+        data = os.urandom(200 * 1024 + 1)
+        self.write_file('small', data)
+        port = self.start_server()
+        self.assertEqual(self.run_client(_get, port, 'small'), data)
+
+        path = os.path.join(self.temp_dir, 'small')
+        key = network._get_cache_key(path, os.stat(path))
+        self.assertIn(key, network._file_cache)
+        self.assertEqual(self.run_client(_get, port, 'small'), data)
+
+    def test_cached_file_replaced(self):
+        data = os.urandom(1024)
+        self.write_file('small', data)
+        path = os.path.join(self.temp_dir, 'small')
+        os.utime(path, (1000, 1000))
+        port = self.start_server()
+        self.assertEqual(self.run_client(_get, port, 'small'), data)
+
+        # Same size and modification time, only the inode differs
+        new_data = os.urandom(1024)
+        self.write_file('small.new', new_data)
+        os.utime(path + '.new', (1000, 1000))
+        os.rename(path + '.new', path)
+        self.assertEqual(self.run_client(_get, port, 'small'), new_data)
+
+    def test_weak_if_none_match(self):
+        self.write_file('small', 'small file')
+        port = self.start_server()
+        etag = network._get_etag(os.stat(os.path.join(self.temp_dir,
+                                                      'small')))
+        for if_none_match in (etag, 'W/' + etag, '"other", W/' + etag):
+            status = self.run_client(_get_status, port, 'small',
+                                     {'If-None-Match': if_none_match})
+            self.assertEqual(status, 304)
+        status = self.run_client(_get_status, port, 'small',
+                                 {'If-None-Match': 'W/"other"'})
+        self.assertEqual(status, 200)
+
+
+def _request(name, close=False):
+    request = 'GET /%s HTTP/1.1\r\nHost: localhost\r\n' % name
+    if close:
+        request += 'Connection: close\r\n'
+    return request + '\r\n'
+
+
+def _read_response(sock):
+    response = httplib.HTTPResponse(sock)
+    response.begin()
+    return response.read()
+
+
+def _get_pipelined(port, names):
+    # The last request closes the connection, returns the bodies and
+    # what could be read after the last one
+    sock = socket.create_connection(('127.0.0.1', port), 10)
+    try:
+        sock.sendall(''.join(_request(name, i == len(names) - 1)
+                             for i, name in enumerate(names)))
+        bodies = [_read_response(sock) for name_ in names]
+        return bodies, sock.recv(1)
+    finally:
+        sock.close()
+
+
+def _get_kept_alive(port, names):
+    # One request after the other on the same connection, returns the
+    # bodies and what could be read after the last one
+    sock = socket.create_connection(('127.0.0.1', port), 10)
+    try:
+        bodies = []
+        for name in names:
+            sock.sendall(_request(name))
+            bodies.append(_read_response(sock))
+        return bodies, sock.recv(1)
+    finally:
+        sock.close()
+
+
+class TestKeepAlive(_ServerTestCase):
+
+    def setUp(self):
+        _ServerTestCase.setUp(self)
+        self.small = 'small file'
+        self.large = os.urandom(300 * 1024)
+        self.write_file('small', self.small)
+        self.write_file('large', self.large)
+
+    def test_pipelined(self):
+        port = self.start_server()
+        bodies, rest = self.run_client(_get_pipelined, port,
+                                       ['small', 'large', 'small'])
+        self.assertEqual(bodies, [self.small, self.large, self.small])
+        # Closed after the request with Connection: close
+        self.assertEqual(rest, '')
+
+    def test_timeout(self):
+        port = self.start_server(KEEP_ALIVE_TIMEOUT=1)
+        bodies, rest = self.run_client(_get_kept_alive, port,
+                                       ['large', 'small'])
+        self.assertEqual(bodies, [self.large, self.small])
+        self.assertEqual(rest, '')
+
+
+class TestDownloader(_ServerTestCase):
+
+    def setUp(self):
+        _ServerTestCase.setUp(self)
+        self.statuses = []
+        self.port = self.start_server(statuses=self.statuses)
+        self.download_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.download_dir)
+        _ServerTestCase.tearDown(self)
+
+    def _create_downloader(self, name):
+        url = 'http://127.0.0.1:%d/%s' % (self.port, name)
+        return network.GlibURLDownloader(url, destdir=self.download_dir)
+
+    def _download(self, downloader, **kwargs):
+        """Run downloader until it is done, return the downloaded bytes"""
+        loop = GObject.MainLoop()
+        result = []
+
+        def finished_cb(downloader, path, suggested_name):
+            with open(path, 'rb') as f:
+                result.append(f.read())
+            loop.quit()
+
+        def error_cb(downloader, error):
+            result.append(error)
+            loop.quit()
+
+        downloader.connect('finished', finished_cb)
+        downloader.connect('error', error_cb)
+        downloader.start(**kwargs)
+        self.run_main_loop(loop)
+        return result[0]
+
+    def test_segments(self):
+        data = os.urandom(4 * 64 * 1024 + 1234)
+        self.write_file('large', data)
+        downloader = self._create_downloader('large')
+        downloader.MIN_SEGMENT_SIZE = 64 * 1024
+        downloader.SEGMENTS = 4
+
+        self.assertEqual(self._download(downloader), data)
+        # The rest of the file from the first segment on, then the other
+        # three segments
+        self.assertEqual(self.statuses, [206] * 4)
+
+    def _write_partial(self, data):
+        path = os.path.join(self.download_dir, 'file')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_resume(self):
+        data = os.urandom(100 * 1024)
+        self.write_file('file', data)
+        path = self._write_partial(data[:30 * 1024])
+        downloader = self._create_downloader('file')
+
+        self.assertEqual(self._download(downloader, destfile=path,
+                                        resume=True), data)
+        # Only the rest was sent
+        self.assertEqual(self.statuses, [206])
+
+    def test_resume_complete(self):
+        data = os.urandom(100 * 1024)
+        self.write_file('file', data)
+        path = self._write_partial(data)
+        downloader = self._create_downloader('file')
+
+        self.assertEqual(self._download(downloader, destfile=path,
+                                        resume=True), data)
+        # Answered with bytes */size, nothing was sent again
+        self.assertEqual(self.statuses, [416])
+        self.assertEqual(downloader.get_total_size(), len(data))
+
+    def test_resume_changed(self):
+        data = os.urandom(100 * 1024)
+        self.write_file('file', data)
+        path = self._write_partial(os.urandom(30 * 1024))
+        downloader = self._create_downloader('file')
+
+        self.assertEqual(self._download(downloader, destfile=path,
+                                        resume=True, etag='"old"'), data)
+        # If-Range did not match, the whole file was sent
+        self.assertEqual(self.statuses, [200])
+        self.assertEqual(downloader.get_etag(), network._get_etag(
+            os.stat(os.path.join(self.temp_dir, 'file'))))
+
+
+class TestDownloadManager(_ServerTestCase):
+
+    def setUp(self):
+        _ServerTestCase.setUp(self)
+        self.port = self.start_server()
+        self.download_dir = tempfile.mkdtemp()
+        self.data = {}
+        for name in ('a', 'b', 'c', 'd'):
+            self.data[name] = os.urandom(100 * 1024)
+            self.write_file(name, self.data[name])
+
+    def tearDown(self):
+        shutil.rmtree(self.download_dir)
+        _ServerTestCase.tearDown(self)
+
+    def _create_manager(self, **kwargs):
+        manager = network.DownloadManager(destdir=self.download_dir,
+                                          **kwargs)
+        self.addCleanup(manager.close)
+        return manager
+
+    def _add(self, manager, name, finished, host='127.0.0.1', **kwargs):
+        url = 'http://%s:%d/%s' % (host, self.port, name)
+        downloader = manager.add(url, **kwargs)
+
+        def finished_cb(downloader, path, suggested_name):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data[name])
+            finished.append(name)
+
+        downloader.connect('finished', finished_cb)
+        downloader.connect('error', lambda downloader, error:
+                           finished.append(error))
+        return downloader
+
+    def _run_until_drained(self, manager):
+        loop = GObject.MainLoop()
+        manager.connect('drained', lambda manager: loop.quit())
+        self.run_main_loop(loop)
+
+    def test_priorities(self):
+        manager = self._create_manager(max_transfers=1)
+        finished = []
+        for name, priority in (('a', 0), ('b', 0), ('c', 5), ('d', 1)):
+            self._add(manager, name, finished, priority=priority)
+
+        self._run_until_drained(manager)
+        # a started right away, the others by priority
+        self.assertEqual(finished, ['a', 'c', 'd', 'b'])
+
+    def test_per_host_limit(self):
+        manager = self._create_manager(max_transfers=4, max_per_host=1)
+        finished = []
+        # Two hosts for the same server
+        hosts = ('127.0.0.1:%d' % self.port, 'localhost:%d' % self.port)
+        self._add(manager, 'a', finished)
+        self._add(manager, 'b', finished)
+        self._add(manager, 'c', finished, host='localhost')
+        self.assertEqual(sorted(manager._running.values()), sorted(hosts))
+        self.assertEqual(manager.get_pending(), 3)
+
+        self._run_until_drained(manager)
+        self.assertEqual(sorted(finished), ['a', 'b', 'c'])
+
+    def test_progress(self):
+        manager = self._create_manager(max_transfers=2)
+        progress = []
+        manager.connect('progress', lambda manager, written, total:
+                        progress.append((written, total)))
+        drained = []
+        manager.connect('drained', lambda manager: drained.append(True))
+        finished = []
+        for name in ('a', 'b', 'c'):
+            self._add(manager, name, finished)
+
+        self._run_until_drained(manager)
+        self.assertEqual(sorted(finished), ['a', 'b', 'c'])
+        self.assertEqual(drained, [True])
+        written = [written for written, total_ in progress]
+        self.assertEqual(written, sorted(written))
+        size = 3 * 100 * 1024
+        self.assertEqual(progress[-1], (size, size))
+
+    def test_close(self):
+        manager = self._create_manager(max_transfers=1)
+        drained = []
+        manager.connect('drained', lambda manager: drained.append(True))
+        finished = []
+        for name in ('a', 'b', 'c'):
+            self._add(manager, name, finished)
+
+        manager.close()
+        self.assertEqual(manager.get_pending(), 0)
+        self.assertEqual(drained, [True])
+
+        # The running download leaves nothing behind, the queued ones
+        # never started
+        loop = GObject.MainLoop()
+        GObject.timeout_add(500, loop.quit)
+        self.run_main_loop(loop)
+        self.assertEqual(finished, [])
+        self.assertEqual(os.listdir(self.download_dir), [])
@@ -0,0 +1,58 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from sugar3.activity.activity import PREVIEW_SIZE
+from sugar3.activity.activity import pack_preview_mips, unpack_preview_mips
+from sugar3.activity.activity import select_preview
+
+_SMALL = (80, 60, 'small')
+_LARGE = (600, 450, 'large' * 100)
+
+
+class TestPreviewMips(unittest.TestCase):
+
+    def test_round_trip(self):
+        packed = pack_preview_mips([_LARGE, _SMALL])
+        self.assertEqual(unpack_preview_mips(packed), [_SMALL, _LARGE])
+        self.assertEqual(unpack_preview_mips(pack_preview_mips([])), [])
+
+    def test_truncated(self):
+        packed = pack_preview_mips([_SMALL, _LARGE])
+        for length in (0, 3, 8, 20, len(packed) - 1):
+            self.assertRaises(ValueError, unpack_preview_mips,
+                              packed[:length])
+
+    def test_corrupt(self):
+        packed = pack_preview_mips([_SMALL])
+        self.assertRaises(ValueError, unpack_preview_mips,
+                          'XXXX' + packed[4:])
+
+    def test_select_preview(self):
+        metadata = {'preview': 'default',
+                    'preview-mips': pack_preview_mips([_SMALL, _LARGE])}
+        self.assertEqual(select_preview(metadata, 40, 30), 'small')
+        # The default size is not in the mips, it comes from 'preview'
+        self.assertEqual(select_preview(metadata, *PREVIEW_SIZE), 'default')
+        self.assertEqual(select_preview(metadata, 1000, 1000), _LARGE[2])
+
+    def test_select_preview_fallback(self):
+        self.assertEqual(select_preview({'preview': 'default'}, 40, 30),
+                         'default')
+        metadata = {'preview': 'default', 'preview-mips': 'corrupt'}
+        self.assertEqual(select_preview(metadata, 40, 30), 'default')
+        self.assertIsNone(select_preview({}, 40, 30))
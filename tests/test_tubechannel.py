@@ -0,0 +1,45 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from sugar3.presence.tubechannel import encode_frame, decode_frame
+from sugar3.presence.tubechannel import _split_frames
+
+
+class TestMessageChannel(unittest.TestCase):
+
+    def test_frame_round_trip(self):
+        messages = ['a', '', 'b' * 4096]
+        self.assertEqual(decode_frame(encode_frame(messages)), messages)
+        self.assertEqual(decode_frame(encode_frame(messages, 1024)),
+                         messages)
+        self.assertRaises(ValueError, decode_frame,
+                          encode_frame(messages)[:-1])
+
+    def test_split_frames_keeps_order(self):
+        entries = [(None, 'a'), (None, 'b'), (2, 'c'), (None, 'd'),
+                   (2, 'e'), (2, 'f')]
+        frames = list(_split_frames(entries, 65536))
+        self.assertEqual(frames, [(None, ['a', 'b']), (2, ['c']),
+                                  (None, ['d']), (2, ['e', 'f'])])
+
+    def test_split_frames_size(self):
+        entries = [(None, 'x' * 10)] * 5 + [(None, 'y' * 100)]
+        frames = list(_split_frames(entries, 30))
+        self.assertEqual([len(messages) for handle_, messages in frames],
+                         [2, 2, 1, 1])
+        self.assertEqual(frames[-1], (None, ['y' * 100]))